@@ -1,12 +1,17 @@
-import pandas as pd
-import joblib
-import shap
-import random
 import argparse
-import matplotlib.pyplot as plt
-from model_config import FEATURES_TO_EXCLUDE, MANUAL_CATEGORICAL_FEATURES
+import contextlib
+import io
+import json
+import random
+import re
+import sys
 from feature_names import FEATURE_NAME_MAP
-from data_loader import load_and_concat_csvs
+from model_config import PROBLEM_THRESHOLD_MS
+from telemetry import stage, reset_telemetry, print_stage_timings
+
+# Heavy modules (pandas, joblib/lightgbm, shap, matplotlib) are imported inside the
+# functions that need them, so a text-only report doesn't pay for plotting imports
+# and `import aislow` stays cheap when used as a library.
 
 
 # --- 1. Configuration ---
@@ -14,254 +19,844 @@ TARGET_COLUMN = 'SpeedIndex'
 MODEL_FILE_NAME = 'aislow_desktop.pkl'
 TEST_CSV_FILE = 'testpages.csv'  # Used when ANALYSIS_MODE = 'test'
 ETSY_CSV_FILE = 'etsypages.csv'  # Used when ANALYSIS_MODE = 'etsy'
+PAGE_CSV_FILES = {'test': TEST_CSV_FILE, 'etsy': ETSY_CSV_FILE}
+
+# Defaults repeated from batch_explain/explain_server/report_output so building the parser imports nothing heavy
+DEFAULT_CHUNK_SIZE = 2000
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+DEFAULT_MAX_BATCH_SIZE = 256
+DEFAULT_MAX_WAIT_MS = 5.0
+DEFAULT_CACHE_SIZE_MB = 256
+DEFAULT_NEIGHBORS = 3
+DEFAULT_PLOT_WORKERS = 1
+ROLLUP_SITES_SHOWN = 10  # Text report of a rollup over every domain: the sites with the most pages
+BENCHMARK_LEVEL_NAMES = {'p10': '10th percentile', 'p25': '25th percentile', 'p50': 'median'}  # What-if levels
+
+
+def build_parser():
+    """Command line arguments for aislow.py."""
+    parser = argparse.ArgumentParser(description='Analyze page speed and identify performance issues.')
+    parser.add_argument(
+        '--mode',
+        choices=['median', 'test', 'etsy', 'batch', 'rollup', 'serve'],
+        default='test',
+        help='Analysis mode: "median" (median page from training data), "test" (random from testpages.csv), "etsy" (random from etsypages.csv), "batch" (every page in --input), "rollup" (site-wide explanation of the pages in --input, default etsypages.csv), or "serve" (HTTP explanation server). Default: test'
+    )
+    parser.add_argument(
+        '--plot',
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help='Save a SHAP waterfall PNG for the analyzed page (--no-plot for a text-only report). Default: --plot'
+    )
+    parser.add_argument(
+        '--plot-limit',
+        type=int,
+        default=0,
+        help='Batch mode: save waterfall PNGs of the first N pages, next to --output (0 = none). Default: 0'
+    )
+    parser.add_argument(
+        '--plot-top',
+        type=int,
+        default=0,
+        help='Batch mode: save waterfall PNGs of the N pages with the slowest predicted SpeedIndex instead. Default: 0'
+    )
+    parser.add_argument(
+        '--plot-workers',
+        type=int,
+        default=DEFAULT_PLOT_WORKERS,
+        help=f'Batch mode: processes rendering the waterfall PNGs while pages are explained. Default: {DEFAULT_PLOT_WORKERS}'
+    )
+    parser.add_argument(
+        '--input',
+        help='Batch/rollup mode: CSV file with the pages to explain (same columns as the training data)'
+    )
+    parser.add_argument(
+        '--site',
+        help='Rollup mode: domain to explain, subdomains included (e.g. etsy.com). Without --site or --url-pattern every domain in --input is rolled up'
+    )
+    parser.add_argument(
+        '--url-pattern',
+        help=r'Rollup mode: regular expression the page URLs must match instead of --site (e.g. "etsy\.com/listing/")'
+    )
+    parser.add_argument(
+        '--output',
+        default='aislow_batch.jsonl',
+        help='Batch mode: JSON Lines file to write, one record per page (Parquet if it ends in .parquet). Default: aislow_batch.jsonl'
+    )
+    parser.add_argument(
+        '--chunk-size',
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help=f'Batch/rollup mode: pages explained per SHAP/predict call. Default: {DEFAULT_CHUNK_SIZE}'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='Batch/rollup mode: worker processes to shard SHAP work across. Default: 1 (serial)'
+    )
+    parser.add_argument('--host', default=DEFAULT_HOST, help=f'Serve mode: interface to listen on. Default: {DEFAULT_HOST}')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f'Serve mode: TCP port. Default: {DEFAULT_PORT}')
+    parser.add_argument(
+        '--max-batch-size',
+        type=int,
+        default=DEFAULT_MAX_BATCH_SIZE,
+        help=f'Serve mode: most rows explained in one micro-batch. Default: {DEFAULT_MAX_BATCH_SIZE}'
+    )
+    parser.add_argument(
+        '--max-wait-ms',
+        type=float,
+        default=DEFAULT_MAX_WAIT_MS,
+        help=f'Serve mode: how long a request waits for others to join its micro-batch. Default: {DEFAULT_MAX_WAIT_MS:g}'
+    )
+    parser.add_argument(
+        '--cache',
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help='Reuse explanations of byte-identical pages under the same model (memory + .aislow_cache/explanations.sqlite). Default: --cache'
+    )
+    parser.add_argument(
+        '--cache-size-mb',
+        type=float,
+        default=DEFAULT_CACHE_SIZE_MB,
+        help=f'Disk size limit of the explanation cache; least recently used entries are evicted. Default: {DEFAULT_CACHE_SIZE_MB}'
+    )
+    parser.add_argument(
+        '--neighbors',
+        type=int,
+        default=DEFAULT_NEIGHBORS,
+        help=f'Single page: list this many similar pages from the fast CSVs and what separates them (0 = off). Default: {DEFAULT_NEIGHBORS}'
+    )
+    parser.add_argument(
+        '--benchmarks',
+        choices=['cohort', 'global'],
+        default='cohort',
+        help='What-if targets: "cohort" (percentiles of similar pages: CDN use, request count, third-party density; see cohorts.py) or "global" (percentiles of all training pages). Default: cohort'
+    )
+    parser.add_argument(
+        '--shap',
+        choices=['tree', 'interventional'],
+        default='tree',
+        help='Single page: "tree" (exact path-dependent TreeSHAP) or "interventional" (SHAP against a summarized background of training pages, saved by shap_background.py). Default: tree'
+    )
+    parser.add_argument(
+        '--background-size',
+        type=int,
+        default=0,
+        help='Interventional SHAP: background pages to summarize the training data to (0 = the saved background). Default: 0'
+    )
+    parser.add_argument(
+        '--background-method',
+        choices=['kmeans', 'stratified'],
+        help='Interventional SHAP: how to summarize the training data (default: the saved background\'s method)'
+    )
+    parser.add_argument(
+        '--target',
+        default=TARGET_COLUMN,
+        help=f'Single page: metric to explain, from the model bundle saved by train_model.py --targets (e.g. TotalBlockingTime). Default: {TARGET_COLUMN}'
+    )
+    parser.add_argument(
+        '--format',
+        choices=['text', 'json'],
+        default='text',
+        help='Output: "text" (human report) or "json" (the explanation plus per-stage timings and memory on stdout; progress messages go to stderr). Default: text'
+    )
+    parser.add_argument(
+        '--timings',
+        action='store_true',
+        help='Text output: end with a table of per-stage timings and peak memory'
+    )
+    return parser
+
+
+# Helper function to get friendly names
+def get_name(name):
+    return FEATURE_NAME_MAP.get(name, name)
+
+
+# Helper function to format feature values (numbers get thousands separators)
+def format_value(value):
+    if value is None:
+        return "n/a"
+    if isinstance(value, bool):
+        return str(value)
+    return f"{value:,.0f}"
 
-# Parse command line arguments
-parser = argparse.ArgumentParser(description='Analyze page speed and identify performance issues.')
-parser.add_argument(
-    '--mode',
-    choices=['median', 'test', 'etsy'],
-    default='test',
-    help='Analysis mode: "median" (median page from training data), "test" (random from testpages.csv), or "etsy" (random from etsypages.csv). Default: test'
-)
-args = parser.parse_args()
-ANALYSIS_MODE = args.mode
 
 # --- 2. Load Model and Training Data ---
-#print("Loading model and training data...")
-try:
-    model = joblib.load(MODEL_FILE_NAME)
-except FileNotFoundError:
-    print(f"ERROR: Could not find model file '{MODEL_FILE_NAME}'.")
-    exit()
-
-# Always load training data for SHAP background context
-#print("Loading training data for SHAP background...")
-df_background = load_and_concat_csvs(verbose=False)
-#print(f"  Loaded {len(df_background)} training pages for background context")
-
-# Calculate and display average SpeedIndex
-avg_speedindex = df_background[TARGET_COLUMN].mean()
-median_speedindex = df_background[TARGET_COLUMN].median()
-print(f"Training data: {len(df_background)} pages")
-print(f"  Average SpeedIndex: {avg_speedindex:.0f} ms")
-print(f"  Median SpeedIndex: {median_speedindex:.0f} ms")
+def load_model(model_file=MODEL_FILE_NAME):
+    """
+    Load the trained model.
+
+    Raises:
+        FileNotFoundError: If the model file doesn't exist
+    """
+    with stage('model_load'):
+        import joblib
+
+        return joblib.load(model_file)
+
+
+def load_model_artifacts(model, model_file=MODEL_FILE_NAME, target_column=TARGET_COLUMN):
+    """
+    Load the precomputed sidecar (p10/p25/p50 benchmarks, background stats, feature order).
+
+    Only falls back to parsing the training CSVs if it's missing or was built for another model
+    (target_column is the metric the model predicts, for the rebuilt background stats).
+
+    Returns:
+        tuple: (artifacts dict, training DataFrame or None if the sidecar was used)
+    """
+    from model_artifacts import load_artifacts, build_artifacts
+
+    with stage('artifacts_load'):
+        artifacts = load_artifacts(model_file, verbose=True)
+    df_background = None
+    if artifacts is None:
+        from data_loader import load_and_concat_csvs
+
+        with stage('csv_load'):
+            df_background = load_and_concat_csvs(remove_duplicates=True, verbose=False)
+        with stage('artifacts_build'):
+            artifacts = build_artifacts(model, model_file, df_background, target_column)
+    return artifacts, df_background
+
+
+def print_background_stats(artifacts):
+    """Display the training data's average and median of the model's target."""
+    background_stats = artifacts['background_stats']
+    target_name = artifacts['target']
+    print(f"Training data: {background_stats['pages']} pages")
+    print(f"  Average {target_name}: {background_stats['mean']:.0f} ms")
+    print(f"  Median {target_name}: {background_stats['median']:.0f} ms")
+
 
 # --- 3. Load Page to Analyze ---
-if ANALYSIS_MODE == 'test':
-    #print(f"\nAnalysis Mode: TEST")
-    #print(f"Loading test page from '{TEST_CSV_FILE}'...")
-    try:
-        df_test = pd.read_csv(TEST_CSV_FILE)
-        #print(f"  Found {len(df_test)} test pages")
-        
-        # Select a random page from test data
-        random.seed()  # Use system time for true randomness
-        test_row_index = random.randint(0, len(df_test) - 1)
-        
-        # Extract the single page we want to analyze
-        df_to_analyze = df_test.iloc[[test_row_index]].copy()
-        real_speedindex = df_to_analyze.iloc[0][TARGET_COLUMN]
-        page_url = df_to_analyze.iloc[0]['page']
-        
-        #print(f"\nSelected RANDOM test page (Row {test_row_index}, SI: {real_speedindex:.0f} ms)")
-        #print(f"URL: {page_url}")
-        
-    except FileNotFoundError:
-        print(f"ERROR: Could not find file '{TEST_CSV_FILE}'.")
-        exit()
-elif ANALYSIS_MODE == 'etsy':
-    #print(f"\nAnalysis Mode: ETSY")
-    #print(f"Loading Etsy page from '{ETSY_CSV_FILE}'...")
-    try:
-        df_etsy = pd.read_csv(ETSY_CSV_FILE)
-        #print(f"  Found {len(df_etsy)} Etsy pages")
-        
-        # Select a random page from Etsy data
+def select_page(mode, df_background=None, target_column=TARGET_COLUMN):
+    """
+    Pick the single page to analyze.
+
+    Args:
+        mode: 'test' or 'etsy' (random page from that CSV) or 'median' (median training page)
+        df_background: Training data, if already loaded (median mode only)
+        target_column: Metric the median page is picked by
+
+    Returns:
+        pd.DataFrame: One raw page row
+
+    Raises:
+        FileNotFoundError: If the CSV for the mode doesn't exist
+    """
+    import pandas as pd
+
+    if mode in PAGE_CSV_FILES:
+        with stage('csv_load'):
+            df_pages = pd.read_csv(PAGE_CSV_FILES[mode])
+
+        # Select a random page
         random.seed()  # Use system time for true randomness
-        etsy_row_index = random.randint(0, len(df_etsy) - 1)
-        
-        # Extract the single page we want to analyze
-        df_to_analyze = df_etsy.iloc[[etsy_row_index]].copy()
-        real_speedindex = df_to_analyze.iloc[0][TARGET_COLUMN]
-        page_url = df_to_analyze.iloc[0]['page']
-        
-        #print(f"\nSelected RANDOM Etsy page (Row {etsy_row_index}, SI: {real_speedindex:.0f} ms)")
-        #print(f"URL: {page_url}")
-        
-    except FileNotFoundError:
-        print(f"ERROR: Could not find file '{ETSY_CSV_FILE}'.")
-        exit()
-else:
-    #print(f"\nAnalysis Mode: MEDIAN")
-    # Use training data to find median page
-    df_to_analyze = df_background.copy()
-    median_speedindex_value = df_to_analyze[TARGET_COLUMN].median()
-    row_index_to_explain = (df_to_analyze[TARGET_COLUMN] - median_speedindex_value).abs().idxmin()
-    
-    # Extract just that one row
-    df_to_analyze = df_to_analyze.iloc[[row_index_to_explain]].copy()
-    real_speedindex = df_to_analyze.iloc[0][TARGET_COLUMN]
-    page_url = df_to_analyze.iloc[0]['page']
-    
-    #print(f"\nSelected MEDIAN page from training data (Row {row_index_to_explain}, SI: {real_speedindex:.0f} ms)")
-    #print(f"Dataset median SI: {median_speedindex_value:.0f} ms")
-    #print(f"URL: {page_url}")
-
-# --- 4. Prepare Data ---
-#print("\nPreparing data...")
-
-# Build list of columns to drop (same as training)
-columns_to_drop = [TARGET_COLUMN, 'page'] + FEATURES_TO_EXCLUDE
-columns_to_drop = [col for col in columns_to_drop if col in df_background.columns]
-
-# Prepare background data for SHAP
-X_background = df_background.drop(columns=columns_to_drop)
-
-# Prepare the single page to analyze
-X_to_analyze = df_to_analyze.drop(columns=[col for col in columns_to_drop if col in df_to_analyze.columns])
-
-# Calculate p25 benchmarks BEFORE converting to categories (so we capture all numeric features)
-p25_metrics = {}
-for col in X_background.columns:
-    # Only for numeric columns (before category conversion)
-    if X_background[col].dtype in ['int64', 'float64']:
-        p25_metrics[col] = X_background[col].quantile(0.25)
-
-# Convert categories (must be identical to training) for BOTH datasets
-for col in MANUAL_CATEGORICAL_FEATURES:
-    if col in X_background.columns:
-        X_background[col] = X_background[col].astype('category')
-    if col in X_to_analyze.columns:
-        X_to_analyze[col] = X_to_analyze[col].astype('category')
-
-# --- 5. Run SHAP Analysis ---
-#print("Calculating SHAP values...")
-#print("(This can take a moment)")
-
-# Create explainer with just the model (SHAP will calculate its own baseline)
-explainer = shap.TreeExplainer(model)
-
-# Run SHAP on the background data to get all explanations, then extract the one we want
-if ANALYSIS_MODE == 'test':
-    # For test mode, we need to run SHAP on the test page
-    # But we want the baseline from training data, so we need to be clever
-    # Run on both background (for baseline) and test page
-    all_shap = explainer(X_background)  # Get baseline from training
-    test_shap = explainer(X_to_analyze)  # Explain test page
-    explanation = test_shap[0]
-else:
-    # For median mode, run on full background and extract the median row
-    # Find which row in X_background corresponds to our median page
-    median_row_in_background = df_background.index.get_loc(df_to_analyze.index[0])
-    all_shap = explainer(X_background)
-    explanation = all_shap[median_row_in_background]
-
-predicted_speedindex = model.predict(X_to_analyze)[0]
-base_value = explanation.base_values
-
-# Combine feature names, their data values, and their SHAP impact
-features = []
-for name, impact, value in zip(X_to_analyze.columns, explanation.values, explanation.data):
-    features.append({'name': name, 'impact': impact, 'value': value})
-
-# Sort by the *absolute* impact
-features.sort(key=lambda x: abs(x['impact']), reverse=True)
-problems = [f for f in features if f['impact'] > 50] # 50ms is the threshold for significance
-strengths = [f for f in features if f['impact'] < 50]
+        row_index = random.randint(0, len(df_pages) - 1)
+        return df_pages.iloc[[row_index]].copy()
+
+    # The median page needs raw training rows, which the sidecar doesn't keep
+    if df_background is None:
+        from data_loader import load_and_concat_csvs
+
+        with stage('csv_load'):
+            df_background = load_and_concat_csvs(remove_duplicates=True, verbose=False)
+
+    # Use training data to find median page (index lookup only, no copy of the background)
+    median_target_value = df_background[target_column].median()
+    row_index_to_explain = (df_background[target_column] - median_target_value).abs().idxmin()
+    return df_background.loc[[row_index_to_explain]].copy()
+
+
+# --- 4 & 5. Prepare Data and Run SHAP Analysis ---
+def explain_page(model, df_to_analyze, feature_order, predictor=None, cache=None, target_column=TARGET_COLUMN,
+                 explainer=None):
+    """
+    Explain a single page.
+
+    SHAP values come from LightGBM's exact TreeSHAP (pred_contrib), the same values
+    shap.TreeExplainer returns. The baseline E[f(x)] comes from the trees themselves,
+    so there's no need to explain the whole background. With an explainer, SHAP values
+    are interventional instead: relative to a summarized background of training pages.
+
+    Args:
+        model: Trained LGBMRegressor
+        df_to_analyze: One raw page row
+        feature_order: Model feature names in training order
+        predictor: Optional faster stand-in for model.predict (tree_predictor.FlatTreeEnsemble)
+        cache: Optional explanation_cache.ExplanationCache; a hit skips all model work
+        target_column: Metric the model predicts (its actual value is shown next to the prediction)
+        explainer: Optional shap_background.InterventionalExplainer (None = TreeSHAP)
+
+    Returns:
+        dict: Page info, prediction, SHAP values and the sorted problems/strengths
+    """
+    import numpy as np
+    from batch_explain import prepare_features, compute_contributions
+    from feature_schema import get_schema
+
+    # Prepare the single page to analyze, with columns in the model's feature order
+    with stage('category_conversion'):
+        X_to_analyze = prepare_features(df_to_analyze, get_schema(model))
+        raw_values = df_to_analyze[feature_order].to_numpy(dtype=object)
+
+    cache_key = cache_entry = None
+    if cache is not None:
+        with stage('cache_lookup'):
+            cache_key = cache.row_keys(X_to_analyze)[0]
+            cache_entry = cache.get(cache_key)
+    if cache_entry is not None:
+        shap_values = np.array([cache_entry['shap_values']])
+        base_value = cache_entry['base_value']
+        predicted_speedindex = cache_entry['prediction']
+    else:
+        with stage('shap'):
+            if explainer is not None:
+                shap_values, base_value = explainer.shap_values(X_to_analyze)
+            else:
+                shap_values, base_value = compute_contributions(model, X_to_analyze)
+        with stage('predict'):
+            predicted_speedindex = float((predictor or model).predict(X_to_analyze)[0])
+        cache_entry = {'shap_values': shap_values[0].tolist(), 'base_value': base_value,
+                       'prediction': predicted_speedindex}
+        if cache is not None:
+            cache.put(cache_key, cache_entry)
+
+    # Combine feature names, their data values, and their SHAP impact
+    features = []
+    for name, impact, value in zip(feature_order, shap_values[0], raw_values[0]):
+        features.append({'name': name, 'impact': impact, 'value': value})
+
+    # Sort by the *absolute* impact
+    features.sort(key=lambda x: abs(x['impact']), reverse=True)
+
+    return {
+        'page_url': df_to_analyze.iloc[0]['page'],
+        'target': target_column,
+        'real_speedindex': df_to_analyze.iloc[0].get(target_column),
+        'predicted_speedindex': predicted_speedindex,
+        'base_value': base_value,
+        'X': X_to_analyze,
+        'raw_values': raw_values,
+        'shap_values': shap_values[0],
+        'features': features,
+        'problems': [f for f in features if f['impact'] > PROBLEM_THRESHOLD_MS],
+        'strengths': [f for f in features if f['impact'] < PROBLEM_THRESHOLD_MS],
+        'cache_key': cache_key,
+        'cache_entry': cache_entry,
+        'background': None,
+    }
 
-# Helper function to get friendly names
-def get_name(name):
-    return FEATURE_NAME_MAP.get(name, name)
 
 # --- 6. Generate SHAP Waterfall Plot ---
-# Generate a unique filename based on the page URL
-page_slug = page_url.replace('https://', '').replace('http://', '').replace('/', '_').replace('?', '_').replace('&', '_')[:100]
-output_filename = f"shap_waterfall_{page_slug}.png"
-
-# Create the waterfall plot
-plt.figure(figsize=(10, 8))
-shap.plots.waterfall(explanation, max_display=15, show=False)
-plt.tight_layout()
-plt.savefig(output_filename, dpi=150, bbox_inches='tight')
-plt.close()
-#print(f"SHAP waterfall plot saved to: {output_filename}")
+def save_waterfall_plot(analysis, output_filename=None):
+    """
+    Save the SHAP waterfall plot for an analyzed page.
 
-# --- 7. Print Text Report ---
-print("\n\n---------------------------------------")
-print("---------     EH, I SLOW?     ---------")
-print("---------------------------------------")
-print(f"Page: {page_url}")
-print(f"SpeedIndex: {real_speedindex:.0f}ms (actual)")
-print(f"Predicted SpeedIndex: {predicted_speedindex:.0f}ms")
-error_ms = abs(real_speedindex - predicted_speedindex)
-print(f"Prediction error: {error_ms:.0f}ms")
-
-print("\n--- Top Problems (Areas for Improvement) ---")
-if not problems:
-    print("No significant problems found.")
-else:
-    for f in problems[:5]:
-        print(f"  * {get_name(f['name'])} = {f['value']:,.0f}")
-        print(f"    └─ Impact: +{f['impact']:.0f} ms")
-
-print("\n--- Top Strengths (What's Working Well) ---")
-if not strengths:
-    print("No significant strengths found.")
-else:
-    for f in strengths[:3]:
-        print(f"  * {get_name(f['name'])} = {f['value']:,.0f}")
-        print(f"    └─ Impact: {f['impact']:.0f} ms")
+    Args:
+        analysis: dict from explain_page()
+        output_filename: PNG path; defaults to a name based on the page URL
 
-# --- 8. "What-If" Simulation ---
-print("\n--- What-If Simulation ---")
+    Returns:
+        str: Path of the saved PNG
+    """
+    from report_output import get_plot_filename, render_waterfall
 
-if not problems:
-    print("No problems to simulate.")
-    exit()
+    if output_filename is None:
+        # Generate a unique filename based on the page URL
+        output_filename = get_plot_filename(analysis['page_url'])
+    return render_waterfall(analysis['shap_values'], analysis['base_value'],
+                            analysis['X'].iloc[0].to_numpy(dtype=object), list(analysis['X'].columns),
+                            output_filename)
 
-top_problem = problems[0]
-top_problem_name = top_problem['name']
-top_problem_value = top_problem['value']
 
-X_modified = X_to_analyze.copy()
-scenario_text = ""
+# --- 7. Print Text Report ---
+def print_report(analysis):
+    """Print the human-readable report for an analyzed page."""
+    import pandas as pd
+
+    problems = analysis['problems']
+    strengths = analysis['strengths']
+    real_speedindex = analysis['real_speedindex']
+    predicted_speedindex = analysis['predicted_speedindex']
+
+    print("\n\n---------------------------------------")
+    print("---------     EH, I SLOW?     ---------")
+    print("---------------------------------------")
+    target_name = analysis['target']
+    print(f"Page: {analysis['page_url']}")
+    if pd.isna(real_speedindex):
+        print(f"{target_name}: not measured")
+        print(f"Predicted {target_name}: {predicted_speedindex:.0f}ms")
+    else:
+        print(f"{target_name}: {real_speedindex:.0f}ms (actual)")
+        print(f"Predicted {target_name}: {predicted_speedindex:.0f}ms")
+        error_ms = abs(real_speedindex - predicted_speedindex)
+        print(f"Prediction error: {error_ms:.0f}ms")
+    if analysis['background'] is not None:
+        from shap_background import describe_background
+
+        print(f"SHAP: interventional, {describe_background(analysis['background'])}")
+
+    print("\n--- Top Problems (Areas for Improvement) ---")
+    if not problems:
+        print("No significant problems found.")
+    else:
+        for f in problems[:5]:
+            print(f"  * {get_name(f['name'])} = {f['value']:,.0f}")
+            print(f"    └─ Impact: +{f['impact']:.0f} ms")
+
+    print("\n--- Top Strengths (What's Working Well) ---")
+    if not strengths:
+        print("No significant strengths found.")
+    else:
+        for f in strengths[:3]:
+            print(f"  * {get_name(f['name'])} = {f['value']:,.0f}")
+            print(f"    └─ Impact: {f['impact']:.0f} ms")
 
-# Get the model's "Before" prediction (use the one we already calculated)
-pred_before = predicted_speedindex
 
-# Generic "what-if" logic: Improve the top problem to "good" benchmark (p25)
-if top_problem_name in p25_metrics:
-    p25_value = p25_metrics[top_problem_name]
-    
-    # Only simulate if the current value is worse than p25 (higher for metrics where more = worse)
+# --- 8. "What-If" Simulation ---
+def print_what_if(model, analysis, percentile_metrics, predictor=None, cache=None, cohort_description=None):
+    """
+    Simulate fixing the page's problems and print the what-if section of the report.
+
+    percentile_metrics are the benchmarks the problems are moved to: the page's cohort
+    benchmarks (cohorts.CohortTables.lookup, described by cohort_description) or the global ones.
+
+    Every scenario (top problems at p10/p25/p50, 'good' categorical options, pairs) is
+    scored in one predict call, plus one more for the cumulative improvement plan.
+    With a predictor (exported flat trees) those calls skip the LightGBM wrapper entirely,
+    and a cached result (see explain_page) skips them altogether.
+
+    Returns:
+        dict or None: Result from whatif.plan_improvements(), None if there were no problems
+    """
+    from whatif import plan_improvements
+
+    print("\n--- What-If Simulation ---")
+
+    problems = analysis['problems']
+    if not problems:
+        print("No problems to simulate.")
+        if cache is not None and 'what_if' not in analysis['cache_entry']:
+            # Same empty result batch mode caches, so the entry is complete for every mode
+            cache.put(analysis['cache_key'], dict(analysis['cache_entry'],
+                                                  what_if={'what_if': None, 'scenarios': [], 'plan': []}))
+        return None
+
+    if cohort_description is not None:
+        print(f"  Benchmarks from similar pages: {cohort_description}")
+
+    top_problem = problems[0]
+    top_problem_name = top_problem['name']
+    top_problem_value = top_problem['value']
+    predicted_speedindex = analysis['predicted_speedindex']
+
+    X_to_analyze = analysis['X']
+    problem_indices = [X_to_analyze.columns.get_loc(f['name']) for f in problems]
+    what_if_result = analysis['cache_entry'].get('what_if')
+    if what_if_result is None:
+        with stage('what_if'):
+            what_if_result = plan_improvements(predictor or model, X_to_analyze, analysis['raw_values'],
+                                               [problem_indices], [predicted_speedindex], percentile_metrics)[0]
+        if cache is not None:
+            cache.put(analysis['cache_key'], dict(analysis['cache_entry'], what_if=what_if_result))
+    what_if = what_if_result['what_if']
+
+    # Classic what-if: the top problem moved to its best "good" benchmark (p10/p25/p50)
     # We'll assume most metrics follow "higher = worse" pattern (bytes, time, counts)
-    if top_problem_value > p25_value:
-        scenario_text = f"Improve '{get_name(top_problem_name)}' from {top_problem_value:,.0f} to 'good' benchmark {p25_value:,.0f} (25th percentile)"
-        X_modified[top_problem_name] = p25_value
-    else:
+    if what_if:
+        level_name = BENCHMARK_LEVEL_NAMES.get(what_if['level'], what_if['level'])
+        print(f"  #1 problem is {get_name(top_problem_name)}")
+        print(f"  Improve '{get_name(top_problem_name)}' from {top_problem_value:,.0f} to 'good' benchmark {what_if['to']:,.0f} ({level_name})")
+
+        savings = what_if['savings_ms']
+        if savings > 0:
+            print(f"  Estimated {analysis['target']} Improvement: {savings:.0f} ms")
+            print(f"  └─ (from {predicted_speedindex:.0f}ms to {what_if['predicted_after']:.0f}ms)")
+        else:
+            print(f"  No significant improvement predicted (Est: {savings:.0f} ms).")
+    elif top_problem_name in percentile_metrics['p25']:
         print(f"Top problem '{get_name(top_problem_name)}' is already at or better than the 'good' benchmark.")
         print("No simulation needed.")
-        scenario_text = ""
-else:
-    # For categorical or non-numeric features
-    print(f"Cannot simulate '{get_name(top_problem_name)}' (not a numeric feature).")
-    print("Skipping simulation.")
-    scenario_text = ""
-
-
-# Run the simulation if a scenario was defined
-if scenario_text:
-    print(f"  #1 problem is {get_name(top_problem_name)}")
-    print(f"  {scenario_text}")
-    
-    # Get the "After" prediction
-    pred_after = model.predict(X_modified)[0]
-    
-    savings = pred_before - pred_after
-    
-    if savings > 0:
-        print(f"  Estimated SpeedIndex Improvement: {savings:.0f} ms")
-        print(f"  └─ (from {pred_before:.0f}ms to {pred_after:.0f}ms)")
     else:
-        print(f"  No significant improvement predicted (Est: {savings:.0f} ms).")
-
+        # For categorical or non-numeric features
+        print(f"Cannot simulate '{get_name(top_problem_name)}' (not a numeric feature).")
+        print("Skipping simulation.")
+
+    # Ranked improvement plan: fixes ordered by their own savings, with the combined effect so far
+    plan = what_if_result['plan']
+    if plan:
+        print("\n--- Improvement Plan ---")
+        for step_number, step in enumerate(plan, start=1):
+            level = f"{step['level']} benchmark" if step['level'] != 'set' else "recommended setting"
+            print(f"  {step_number}. {get_name(step['feature'])}: {format_value(step['from'])} -> {format_value(step['to'])} ({level})")
+            print(f"     └─ Saves {step['step_savings_ms']:.0f} ms, {step['cumulative_savings_ms']:.0f} ms total "
+                  f"(predicted {step['predicted_after']:.0f}ms)")
+    return what_if_result
+
+
+# --- 9. Comparable Fast Pages ---
+def print_similar_pages(similar):
+    """
+    Print the most similar fast pages and the features that separate the page from them.
+
+    Args:
+        similar: One result of neighbors.NeighborIndex.query()
+    """
+    print("\n--- Comparable Fast Pages ---")
+    for number, neighbor in enumerate(similar['neighbors'], start=1):
+        print(f"  {number}. {neighbor['page']} (SpeedIndex {neighbor['speedindex']:.0f}ms)")
+    if similar['deltas']:
+        print("  What sets them apart (your page vs their median):")
+        for delta in similar['deltas']:
+            print(f"    * {get_name(delta['feature'])}: {format_value(delta['value'])} vs {format_value(delta['neighbor_value'])}")
+
+
+# --- 10. Site Rollup ---
+def print_rollup_report(summary):
+    """
+    Print the site-wide report of one site.
+
+    Args:
+        summary: One site from site_rollup.SiteRollup.summaries()
+    """
+    print("\n\n---------------------------------------")
+    print("-------   EH, IS MY SITE SLOW?   ------")
+    print("---------------------------------------")
+    print(f"Site: {summary['site']} ({summary['pages']:,} pages)")
+    print(f"Average predicted SpeedIndex: {summary['mean_predicted']:.0f}ms "
+          f"(average training page: {summary['base_value']:.0f}ms)")
+    if summary['measured_pages']:
+        print(f"Average actual SpeedIndex: {summary['mean_actual']:.0f}ms over {summary['measured_pages']:,} measured pages "
+              f"(predicted {summary['mean_predicted_measured']:.0f}ms, mean error {summary['mean_abs_error']:.0f}ms)")
+    else:
+        print("SpeedIndex: not measured")
+
+    print("\n--- Site-Wide Problems (ranked by total impact across the site) ---")
+    if not summary['problems']:
+        print("No significant problems found.")
+    for number, problem in enumerate(summary['problems'], start=1):
+        print(f"  {number}. {get_name(problem['name'])}: {problem['pages']:,} of {summary['pages']:,} pages "
+              f"({problem['share']:.0%})")
+        print(f"     └─ Impact: +{problem['impact_ms']:.0f} ms on those pages, "
+              f"+{problem['site_impact_ms']:.0f} ms per page site-wide")
+        if problem['fix_pages']:
+            print(f"     └─ Fix on {problem['fix_pages']:,} pages: saves {problem['savings_ms']:.0f} ms per page "
+                  f"({problem['improved_pages']:,} pages improve)")
+
+    print("\n--- Site-Wide Strengths (What's Working Well) ---")
+    if not summary['strengths']:
+        print("No significant strengths found.")
+    for strength in summary['strengths']:
+        print(f"  * {get_name(strength['name'])}")
+        print(f"    └─ Impact: {strength['impact_ms']:.0f} ms per page")
+
+
+def build_report_record(analysis, what_if_result, plot_file=None, similar=None, cohort=None):
+    """
+    Machine-readable report of an analyzed page (--format json).
+
+    Same fields as a batch mode record, plus the waterfall PNG path, the target explained
+    (with --target, 'actual_speedindex' and 'predicted_speedindex' hold that metric) and, with
+    interventional SHAP, the background and its approximation error.
+
+    Args:
+        analysis: dict from explain_page()
+        what_if_result: dict from print_what_if() (None if there were no problems)
+        plot_file: Saved waterfall PNG, if any
+        similar: Similar fast pages from neighbors.NeighborIndex.query(), if any
+        cohort: Key of the cohort whose benchmarks the what-if used (None = global benchmarks)
+
+    Returns:
+        dict: JSON-friendly record
+    """
+    from batch_explain import _to_json_value, TOP_PROBLEMS, TOP_STRENGTHS
+
+    def feature_records(features):
+        return [{'name': f['name'], 'value': _to_json_value(f['value']), 'impact': float(f['impact'])}
+                for f in features]
+
+    return {
+        'page': _to_json_value(analysis['page_url']),
+        'target': analysis['target'],
+        'actual_speedindex': _to_json_value(analysis['real_speedindex']),
+        'predicted_speedindex': float(analysis['predicted_speedindex']),
+        'base_value': float(analysis['base_value']),
+        'problems': feature_records(analysis['problems'][:TOP_PROBLEMS]),
+        'strengths': feature_records(analysis['strengths'][:TOP_STRENGTHS]),
+        'what_if': what_if_result['what_if'] if what_if_result else None,
+        'improvement_plan': what_if_result['plan'] if what_if_result else [],
+        'scenarios': what_if_result['scenarios'] if what_if_result else [],
+        'plot': plot_file,
+        'similar_fast_pages': similar,
+        'cohort': cohort,
+        'shap_background': _background_record(analysis['background']),
+    }
+
+
+def _background_record(background):
+    """The JSON summary of an interventional SHAP background (None for TreeSHAP)."""
+    if background is None:
+        return None
+    return {'method': background['method'], 'pages': len(background['rows']),
+            'full_pages': background['full_pages'], 'error': background['error']}
+
+
+def main(argv=None):
+    """Run aislow from the command line. Returns the process exit code."""
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.mode == 'batch' and not args.input:
+        parser.error('--mode batch requires --input')
+    if args.target != TARGET_COLUMN and args.mode in ('batch', 'rollup', 'serve'):
+        parser.error(f'--target is only supported for single pages (batch, rollup and serve explain {TARGET_COLUMN})')
+    if args.site and args.url_pattern:
+        parser.error('--site and --url-pattern are mutually exclusive')
+    if args.url_pattern:
+        try:
+            re.compile(args.url_pattern)
+        except re.error as e:
+            parser.error(f'--url-pattern is not a valid regular expression: {e}')
+    if args.shap == 'interventional' and args.mode in ('batch', 'rollup', 'serve'):
+        parser.error('--shap interventional is only supported for single pages')
+    if args.background_size < 0:
+        parser.error('--background-size must be at least 0')
+    if (args.plot_limit or args.plot_top) and args.mode != 'batch':
+        parser.error('--plot-limit and --plot-top are only supported in batch mode')
+    if args.plot_limit and args.plot_top:
+        parser.error('--plot-limit and --plot-top are mutually exclusive')
+    if min(args.plot_limit, args.plot_top) < 0 or args.plot_workers < 1:
+        parser.error('--plot-limit and --plot-top must be at least 0, --plot-workers at least 1')
+
+    # The server runs indefinitely, so it only keeps per-stage totals (see GET /metrics)
+    telemetry = reset_telemetry(keep_records=args.mode != 'serve')
+    if args.format == 'json':
+        # stdout carries only the JSON document; progress messages and errors go to stderr
+        json_out = sys.stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            result, exit_code = run(args)
+        if result is not None:
+            result['telemetry'] = telemetry.to_dict()
+            json.dump(result, json_out, indent=1)
+            json_out.write('\n')
+        return exit_code
+
+    result, exit_code = run(args)
+    if args.timings and result is not None:
+        print_stage_timings(telemetry)
+    return exit_code
+
+
+def run(args):
+    """
+    Run one aislow command (parsed arguments from build_parser()).
+
+    Returns:
+        tuple: (result dict for --format json or None on errors / serve mode, exit code)
+    """
+    analysis_mode = args.mode
+    model_file = MODEL_FILE_NAME
+    if args.target != TARGET_COLUMN:
+        # Other metrics' models are listed in the bundle saved by train_model.py --targets
+        from multi_target import load_bundle, resolve_target_model
+
+        model_file = resolve_target_model(args.target, MODEL_FILE_NAME)
+        if model_file is None:
+            print(f"ERROR: No '{args.target}' model in the bundle (trained targets: {', '.join(load_bundle(MODEL_FILE_NAME))}).")
+            print(f"Train it with: python train_model.py --targets {TARGET_COLUMN} {args.target}")
+            return None, 1
+    try:
+        model = load_model(model_file)
+    except FileNotFoundError:
+        print(f"ERROR: Could not find model file '{model_file}'.")
+        return None, 1
+
+    artifacts, df_background = load_model_artifacts(model, model_file, args.target)
+    print_background_stats(artifacts)
+    percentile_metrics = artifacts['percentile_metrics']
+
+    # Per-cohort benchmarks (cohorts.py); the global ones stay the fallback
+    cohorts = cohorts_context = None
+    if args.benchmarks == 'cohort':
+        from cohorts import ANY, load_cohort_tables, rank_band_of
+
+        with stage('cohorts_load'):
+            cohorts = load_cohort_tables(model_file)
+        if cohorts is None and model_file != MODEL_FILE_NAME:
+            print(f"Cohort benchmarks are only built for {TARGET_COLUMN}, using global benchmarks")
+        elif cohorts is None:
+            print("Cohort benchmarks not found, using global benchmarks (build them with: python cohorts.py)")
+        else:
+            rank_band = rank_band_of(args.input) if analysis_mode in ('batch', 'rollup') else ANY
+            cohorts_context = f"{cohorts.digest()}|{rank_band}"
+
+    # Interventional SHAP: the summarized background train_model.py saves (resized on request)
+    background = None
+    if args.shap == 'interventional':
+        from shap_background import load_background, resize_background
+
+        with stage('background_load'):
+            background = load_background(model_file)
+        if background is None:
+            print(f"ERROR: No SHAP background for '{model_file}'.")
+            print("Build it with: python shap_background.py (or train with: python train_model.py --shap-background)")
+            return None, 1
+        method = args.background_method or background['method']
+        size = args.background_size or len(background['rows'])
+        if method != background['method'] or size != len(background['rows']):
+            from tree_predictor import FlatTreeEnsemble
+
+            if df_background is None:
+                from data_loader import load_and_concat_csvs
+
+                with stage('csv_load'):
+                    df_background = load_and_concat_csvs(remove_duplicates=True, verbose=False)
+            with stage('background_resize'):
+                background = resize_background(model, background, df_background.dropna(subset=[args.target]),
+                                               FlatTreeEnsemble.from_model(model), size, method,
+                                               target_column=args.target)
+
+    # Explanations of byte-identical pages under this model (and these benchmarks) are reused
+    cache = None
+    if args.cache:
+        from explanation_cache import ExplanationCache, compute_context_digest
+
+        background_context = None
+        if background is not None:
+            from shap_background import background_digest
+
+            background_context = background_digest(background)
+        cache = ExplanationCache(compute_context_digest(artifacts['model_sha256'], percentile_metrics, cohorts_context,
+                                                        background_context),
+                                 max_disk_mb=args.cache_size_mb)
+
+    # --- Batch Mode: explain every page of --input ---
+    if analysis_mode == 'batch':
+        from batch_explain import run_batch
+
+        try:
+            with stage('batch'):
+                pages_explained, plots = run_batch(model, args.input, args.output, percentile_metrics,
+                                                   chunk_size=args.chunk_size, workers=args.workers,
+                                                   model_file=model_file, cache=cache, cohorts=cohorts,
+                                                   plot_limit=args.plot_limit, plot_top=args.plot_top,
+                                                   plot_workers=args.plot_workers)
+        except FileNotFoundError:
+            print(f"ERROR: Could not find file '{args.input}'.")
+            return None, 1
+        print(f"\nExplained {pages_explained} pages, results written to '{args.output}'")
+        if plots:
+            print(f"Saved {len(plots)} waterfall plots, e.g. '{plots[0]['plot']}'")
+        result = {'mode': analysis_mode, 'pages_explained': pages_explained, 'output': args.output,
+                  'plots': plots}
+        if cache is not None and args.workers <= 1:
+            stats = cache.stats()
+            print(f"Explanation cache: {stats['memory_hits'] + stats['disk_hits']} hits, "
+                  f"{stats['misses']} misses, {stats['evicted']} evicted")
+            result['cache'] = stats
+        return result, 0
+
+    # --- Rollup Mode: one site-wide explanation of every page of a site ---
+    if analysis_mode == 'rollup':
+        from site_rollup import run_rollup
+
+        input_file = args.input or ETSY_CSV_FILE
+        try:
+            with stage('rollup'):
+                rollup = run_rollup(model, input_file, percentile_metrics, site=args.site,
+                                    url_pattern=args.url_pattern, chunk_size=args.chunk_size,
+                                    workers=args.workers, model_file=model_file, cohorts=cohorts)
+        except FileNotFoundError:
+            print(f"ERROR: Could not find file '{input_file}'.")
+            return None, 1
+        except ValueError as e:
+            print(f"ERROR: {e}")
+            return None, 1
+        summaries = rollup.summaries()
+        if not summaries:
+            print(f"\nNo pages in '{input_file}' match {args.site or args.url_pattern or 'a site'}.")
+            return {'mode': analysis_mode, 'input': input_file, 'sites': []}, 1
+        if args.format != 'json':  # The JSON document lists every site instead
+            for summary in summaries[:ROLLUP_SITES_SHOWN]:
+                print_rollup_report(summary)
+            if len(summaries) > ROLLUP_SITES_SHOWN:
+                print(f"\n... and {len(summaries) - ROLLUP_SITES_SHOWN} more sites (use --site or --format json)")
+        return {'mode': analysis_mode, 'input': input_file, 'sites': summaries}, 0
+
+    # --- Serve Mode: keep everything warm and answer HTTP requests ---
+    if analysis_mode == 'serve':
+        from explain_server import run_server
+
+        run_server(model, percentile_metrics, artifacts['feature_order'], host=args.host, port=args.port,
+                   max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms, cache=cache,
+                   cohorts=cohorts)
+        return None, 0
+
+    # --- Single page: median, test or etsy ---
+    try:
+        df_to_analyze = select_page(analysis_mode, df_background, args.target)
+    except FileNotFoundError:
+        print(f"ERROR: Could not find file '{PAGE_CSV_FILES[analysis_mode]}'.")
+        return None, 1
+
+    # The page's cohort benchmarks: one dict lookup in the precomputed tables
+    page_metrics, cohort, cohort_description = percentile_metrics, None, None
+    if cohorts is not None:
+        with stage('cohort_lookup'):
+            cohort_keys, cohort_metrics = cohorts.lookup(df_to_analyze)
+        cohort, page_metrics = cohort_keys[0], cohort_metrics[0]
+        cohort_description = cohorts.describe(cohort)
+
+    # Exported flat trees (if train_model.py saved them) make the what-if predict calls much cheaper
+    from tree_predictor import load_flat_model
+
+    with stage('flat_model_load'):
+        predictor = load_flat_model(model_file)
+    explainer = None
+    if background is not None:
+        from shap_background import InterventionalExplainer
+        from tree_predictor import FlatTreeEnsemble
+
+        with stage('background_explainer'):
+            explainer = InterventionalExplainer(predictor or FlatTreeEnsemble.from_model(model),
+                                                background['rows'], background['weights'])
+    analysis = explain_page(model, df_to_analyze, artifacts['feature_order'], predictor=predictor, cache=cache,
+                            target_column=args.target, explainer=explainer)
+    analysis['background'] = background
+
+    # Most similar fast pages, from the index train_model.py saves next to the model
+    similar = None
+    if args.neighbors > 0:
+        from neighbors import load_neighbor_index
+
+        with stage('neighbor_index_load'):
+            index = load_neighbor_index(model_file)
+        if index is not None:
+            with stage('neighbors'):
+                similar = index.query(analysis['raw_values'], k=args.neighbors)[0]
+    plot_file = None
+    if args.plot:
+        with stage('plot'):
+            plot_file = save_waterfall_plot(analysis)
+    if args.format == 'json':
+        with contextlib.redirect_stdout(io.StringIO()):  # The JSON record replaces the text report
+            what_if_result = print_what_if(model, analysis, page_metrics, predictor=predictor, cache=cache)
+    else:
+        print_report(analysis)
+        what_if_result = print_what_if(model, analysis, page_metrics, predictor=predictor, cache=cache,
+                                       cohort_description=cohort_description)
+        if similar is not None:
+            print_similar_pages(similar)
+        elif args.neighbors > 0 and model_file == MODEL_FILE_NAME:
+            print("\nComparable fast pages skipped: no neighbor index for this model "
+                  "(build it with: python neighbors.py)")
+    return dict(build_report_record(analysis, what_if_result, plot_file, similar, cohort), mode=analysis_mode), 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,336 @@
+import contextlib
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from model_config import FEATURES_TO_EXCLUDE, PROBLEM_THRESHOLD_MS
+from feature_schema import get_schema
+from whatif import plan_improvements
+from telemetry import stage
+from cohorts import ANY, rank_band_of
+from data_loader import iter_file_chunks
+from report_output import RecordWriter, WaterfallRenderer, PlotSelection, DEFAULT_PLOT_WORKERS
+
+# Batch explanation engine used by `aislow.py --mode batch`
+# Explains many pages per SHAP/predict call instead of one page per process
+
+TARGET_COLUMN = 'SpeedIndex'
+DEFAULT_CHUNK_SIZE = 2000
+TOP_PROBLEMS = 5
+TOP_STRENGTHS = 3
+PERCENTILE_LEVELS = {'p10': 0.10, 'p25': 0.25, 'p50': 0.50}  # Benchmarks used by the what-if optimizer
+MODEL_FILE_NAME = 'aislow_desktop.pkl'
+
+# Per-process state for parallel batch mode (set once by _init_worker)
+_worker_model = None
+_worker_percentile_metrics = None
+_worker_cache = None
+_worker_cohorts = None
+_worker_rank_band = ANY
+_worker_waterfalls = False
+
+
+def get_columns_to_drop(df):
+    """
+    Build the list of non-feature columns to drop (same as training).
+
+    Args:
+        df: DataFrame with raw page rows
+
+    Returns:
+        list: Column names present in df that are not model features
+    """
+    columns_to_drop = [TARGET_COLUMN, 'page'] + FEATURES_TO_EXCLUDE
+    return [col for col in columns_to_drop if col in df.columns]
+
+
+def compute_percentile_metrics(X_background):
+    """
+    Calculate the benchmark percentiles (p10/p25/p50) for every numeric feature.
+
+    Must run BEFORE converting to categories so all numeric features are captured.
+
+    Args:
+        X_background: Feature DataFrame of the training data
+
+    Returns:
+        dict: Level ('p10', 'p25', 'p50') -> {feature name: percentile value}
+    """
+    numeric_columns = [col for col in X_background.columns
+                       if pd.api.types.is_numeric_dtype(X_background[col].dtype)
+                       and not pd.api.types.is_bool_dtype(X_background[col].dtype)]
+    quantiles = X_background[numeric_columns].quantile(list(PERCENTILE_LEVELS.values()))
+    return {level: quantiles.loc[q].to_dict() for level, q in PERCENTILE_LEVELS.items()}
+
+
+def prepare_features(df, schema):
+    """
+    Turn raw page rows into a model-ready feature DataFrame.
+
+    Args:
+        df: DataFrame with raw page rows (may include 'page' and the target)
+        schema: The model's feature_schema.FeatureSchema (get_schema(model))
+
+    Returns:
+        pd.DataFrame: Features in model order, categorical columns with the training levels
+    """
+    return schema.transform(df)
+
+
+def compute_contributions(model, X):
+    """
+    Exact TreeSHAP values for a LightGBM model, without importing shap.
+
+    LightGBM computes the same path-dependent TreeSHAP that shap.TreeExplainer
+    delegates to for LightGBM models; the last column is the expected value.
+
+    Args:
+        model: Trained LGBMRegressor
+        X: Model-ready feature DataFrame, or a matrix from its schema's to_matrix()
+
+    Returns:
+        tuple: (SHAP values array of shape (rows, features), expected value)
+    """
+    matrix = X if isinstance(X, np.ndarray) else get_schema(model).to_matrix(X)
+    contributions = np.asarray(model.booster_.predict(matrix, pred_contrib=True))
+    return contributions[:, :-1], float(contributions[0, -1]) if len(contributions) else float('nan')
+
+
+def _to_json_value(value):
+    """Convert numpy/pandas scalars to plain JSON-friendly Python values."""
+    if value is None:
+        return None
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return str(value)
+    return None if np.isnan(value) else value
+
+
+def explain_chunk(model, df_chunk, percentile_metrics, cache=None, cohorts=None, rank_band=ANY, waterfalls=False):
+    """
+    Explain a chunk of pages with one SHAP (pred_contrib) call and three predict calls.
+
+    With a cache (explanation_cache.ExplanationCache), only pages whose features haven't
+    been explained before under this model go through the model.
+
+    Args:
+        model: Trained LGBMRegressor
+        df_chunk: DataFrame with raw page rows
+        percentile_metrics: benchmark percentiles from compute_percentile_metrics()
+        cache: Optional ExplanationCache
+        cohorts: Optional cohorts.CohortTables; each page's what-if then uses its cohort's
+            benchmarks instead of percentile_metrics
+        rank_band: Rank band of the input file, for the cohort lookup
+        waterfalls: If True, also return what a waterfall plot of each page needs
+
+    Returns:
+        list: One record (dict) per page, in input order; with waterfalls, a tuple
+            (records, list of (SHAP values, base value, feature values) per page)
+    """
+    with stage('category_conversion', rows=len(df_chunk)):
+        X = prepare_features(df_chunk, get_schema(model))
+        raw_values = df_chunk[X.columns].to_numpy(dtype=object)
+    columns = list(X.columns)
+    n_rows = len(X)
+    cohort_keys = None
+    if cohorts is not None:
+        with stage('cohort_lookup', rows=n_rows):
+            cohort_keys, percentile_metrics = cohorts.lookup(df_chunk, rank_band)
+
+    keys = None
+    entries = [None] * n_rows
+    if cache is not None:
+        with stage('cache_lookup', rows=n_rows):
+            keys = cache.row_keys(X)
+            entries = cache.get_many(keys)
+    # Single-page mode caches an entry before its what-if runs: without one it's a miss
+    missing = np.array([i for i, entry in enumerate(entries) if entry is None or 'what_if' not in entry], dtype=int)
+    if len(missing):
+        X_missing = X.iloc[missing] if len(missing) < n_rows else X
+        if cohort_keys is not None:
+            chunk_metrics = [percentile_metrics[i] for i in missing]
+        else:
+            chunk_metrics = percentile_metrics
+        new_entries = _explain_rows(model, X_missing, raw_values[missing], chunk_metrics)
+        for i, entry in zip(missing, new_entries):
+            entries[i] = entry
+        if cache is not None:
+            cache.put_many([(keys[i], entry) for i, entry in zip(missing, new_entries)])
+
+    shap_values = np.array([entry['shap_values'] for entry in entries], dtype=float).reshape(n_rows, len(columns))
+    predictions = np.array([entry['prediction'] for entry in entries], dtype=float)
+    what_ifs = [entry['what_if'] for entry in entries]
+    order = np.argsort(-np.abs(shap_values), axis=1, kind='stable')
+    sorted_impacts = np.take_along_axis(shap_values, order, axis=1)
+    is_problem = sorted_impacts > PROBLEM_THRESHOLD_MS
+
+    # --- Build one structured record per page ---
+    pages = df_chunk['page'].to_numpy() if 'page' in df_chunk.columns else [None] * n_rows
+    actuals = df_chunk[TARGET_COLUMN].to_numpy() if TARGET_COLUMN in df_chunk.columns else [None] * n_rows
+
+    records = []
+    for i in range(n_rows):
+        row_order = order[i]
+        row_problems = row_order[is_problem[i]][:TOP_PROBLEMS]
+        row_strengths = row_order[sorted_impacts[i] < PROBLEM_THRESHOLD_MS][:TOP_STRENGTHS]
+
+        records.append({
+            'page': _to_json_value(pages[i]),
+            'actual_speedindex': _to_json_value(actuals[i]),
+            'predicted_speedindex': float(predictions[i]),
+            'base_value': entries[i]['base_value'],
+            'problems': [{'name': columns[j], 'value': _to_json_value(raw_values[i, j]),
+                          'impact': float(shap_values[i, j])} for j in row_problems],
+            'strengths': [{'name': columns[j], 'value': _to_json_value(raw_values[i, j]),
+                           'impact': float(shap_values[i, j])} for j in row_strengths],
+            'what_if': what_ifs[i]['what_if'],
+            'improvement_plan': what_ifs[i]['plan'],
+            'scenarios': what_ifs[i]['scenarios'],
+        })
+        if cohort_keys is not None:
+            records[-1]['cohort'] = cohort_keys[i]
+    if waterfalls:
+        data = X.to_numpy(dtype=object)
+        return records, [(shap_values[i], entries[i]['base_value'], data[i]) for i in range(n_rows)]
+    return records
+
+
+def _explain_rows(model, X, raw_values, percentile_metrics):
+    """
+    Run the model work for pages: SHAP values, predictions and what-if plans.
+
+    Returns:
+        list: One cache entry (dict) per row of X
+    """
+    matrix = get_schema(model).to_matrix(X)
+    with stage('shap', rows=len(X)):
+        shap_values, base_value = compute_contributions(model, matrix)
+    with stage('predict', rows=len(X)):
+        predictions = model.booster_.predict(matrix)
+
+    # Sort every row by absolute impact in one go (stable, like list.sort)
+    order = np.argsort(-np.abs(shap_values), axis=1, kind='stable')
+    is_problem = np.take_along_axis(shap_values, order, axis=1) > PROBLEM_THRESHOLD_MS
+
+    # --- What-if: all scenarios of all pages scored together (see whatif.py) ---
+    candidate_features = [order[i][is_problem[i]] for i in range(len(X))]
+    with stage('what_if', rows=len(X)):
+        what_ifs = plan_improvements(model, X, raw_values, candidate_features, predictions, percentile_metrics)
+    return [{'shap_values': shap_values[i].tolist(), 'base_value': base_value,
+             'prediction': float(predictions[i]), 'what_if': what_ifs[i]} for i in range(len(X))]
+
+
+def _init_worker(model_file, percentile_metrics, cache_settings=None, cohorts=None, rank_band=ANY,
+                 waterfalls=False):
+    """Load the model (and open the explanation cache) once per worker process."""
+    global _worker_model, _worker_percentile_metrics, _worker_cache, _worker_cohorts, _worker_rank_band
+    global _worker_waterfalls
+    import joblib
+
+    _worker_model = joblib.load(model_file)
+    _worker_percentile_metrics = percentile_metrics
+    _worker_cohorts = cohorts
+    _worker_rank_band = rank_band
+    _worker_waterfalls = waterfalls
+    if cache_settings is not None:
+        from explanation_cache import ExplanationCache
+        _worker_cache = ExplanationCache(**cache_settings)
+
+
+def _explain_chunk_in_worker(df_chunk):
+    """Explain a chunk with the worker's resident model."""
+    return explain_chunk(_worker_model, df_chunk, _worker_percentile_metrics, cache=_worker_cache,
+                         cohorts=_worker_cohorts, rank_band=_worker_rank_band, waterfalls=_worker_waterfalls)
+
+
+def _iter_parallel_records(chunks, model_file, percentile_metrics, workers, cache_settings=None, cohorts=None,
+                           rank_band=ANY, waterfalls=False):
+    """
+    Explain chunks across a process pool, yielding records in input order.
+
+    At most 2 chunks per worker are in flight, so memory stays bounded by chunk size.
+    """
+    max_pending = workers * 2
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(model_file, percentile_metrics, cache_settings, cohorts,
+                                       rank_band, waterfalls)) as executor:
+        pending = deque()
+        for df_chunk in chunks:
+            pending.append(executor.submit(_explain_chunk_in_worker, df_chunk))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def run_batch(model, input_csv, output_path, percentile_metrics, chunk_size=DEFAULT_CHUNK_SIZE,
+              workers=1, model_file=MODEL_FILE_NAME, verbose=False, cache=None, cohorts=None,
+              plot_limit=0, plot_top=0, plot_workers=DEFAULT_PLOT_WORKERS):
+    """
+    Explain every page in a CSV, streaming records to output_path.
+
+    The input is read chunk by chunk and records are written in bounded buffers, so peak
+    memory is bounded by chunk_size. With workers > 1, chunks are sharded across a process
+    pool; each worker loads model_file once and results are written in input order,
+    identical to the serial path. Waterfall plots render in their own process pool.
+
+    Args:
+        model: Trained LGBMRegressor (used by the serial path)
+        input_csv: CSV (or Parquet) file with one page per row (same columns as the training data)
+        output_path: JSON Lines file to write, one record per page (Parquet if it ends in .parquet)
+        percentile_metrics: benchmark percentiles from compute_percentile_metrics()
+        chunk_size: Number of pages explained per SHAP/predict call
+        workers: Number of worker processes (1 = explain in this process)
+        model_file: Model file each worker loads when workers > 1
+        verbose: If True, print progress per chunk
+        cache: Optional explanation_cache.ExplanationCache (workers open the same cache file)
+        cohorts: Optional cohorts.CohortTables for per-page cohort benchmarks (the input file's
+            rank band is taken from its name, see cohorts.rank_band_of)
+        plot_limit: Save waterfall PNGs of the first plot_limit pages
+        plot_top: Save waterfall PNGs of the plot_top pages with the slowest prediction instead
+        plot_workers: Processes rendering the plots
+
+    Returns:
+        tuple: (number of pages explained, list of {'page', 'plot'} per saved waterfall)
+    """
+    if not os.path.exists(input_csv):
+        raise FileNotFoundError(input_csv)
+    chunks = iter_file_chunks(input_csv, chunk_size)
+    rank_band = rank_band_of(input_csv)
+    waterfalls = bool(plot_limit or plot_top)
+    if workers > 1:
+        cache_settings = cache.settings() if cache is not None else None
+        chunk_results = _iter_parallel_records(chunks, model_file, percentile_metrics, workers, cache_settings,
+                                               cohorts, rank_band, waterfalls)
+    else:
+        chunk_results = (explain_chunk(model, df_chunk, percentile_metrics, cache=cache, cohorts=cohorts,
+                                       rank_band=rank_band, waterfalls=waterfalls) for df_chunk in chunks)
+
+    renderer = selection = None
+    with contextlib.ExitStack() as stack:
+        writer = stack.enter_context(RecordWriter(output_path))
+        if waterfalls:
+            renderer = stack.enter_context(WaterfallRenderer(get_schema(model).columns,
+                                                             os.path.dirname(output_path), plot_workers))
+            selection = PlotSelection(renderer, limit=plot_limit, top=plot_top)
+        for result in chunk_results:
+            records = result[0] if waterfalls else result
+            with stage('write', rows=len(records)):
+                writer.write(records)
+            if selection is not None and selection.wanted():
+                with stage('plot_queue', rows=len(records)):
+                    selection.add(records, result[1])
+            if verbose:
+                print(f"  Explained {writer.records} pages...")
+        total = writer.records
+        if selection is not None:
+            with stage('plot_wait'):
+                selection.finish()
+                plots = renderer.close()
+    return total, (plots if renderer is not None else [])
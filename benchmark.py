@@ -0,0 +1,347 @@
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from data_loader import CSV_FILES, CACHE_DIR_NAME
+from telemetry import reset_telemetry, peak_rss_mb
+
+# Benchmark harness for the four pipeline stages:
+#   load    - load_and_concat_csvs (CSV parsing + dedupe, binary cache off)
+#   train   - train_model.train (LightGBM fit with early stopping)
+#   explain - batch_explain.compute_contributions (TreeSHAP via pred_contrib, as aislow uses)
+#   whatif  - whatif.plan_improvements (scenario predict calls)
+# on the bundled CSVs (scale 1) and on synthetic data with 10x/100x the rows.
+#
+# Every (stage, scale) runs in a fresh process, so its peak RSS isn't inflated by earlier stages.
+# Results are appended to a JSON history file; against a saved baseline, a stage that got slower
+# (or bigger) by more than the threshold fails the run (exit code 1).
+#
+#   python benchmark.py --save-baseline       # record the baseline, e.g. before an upgrade
+#   python benchmark.py --threshold 0.2       # compare after the upgrade
+
+STAGES = ('load', 'train', 'explain', 'whatif')
+DEFAULT_SCALES = (1, 10, 100)
+HISTORY_FILE = 'benchmark_history.json'
+BASELINE_FILE = 'benchmark_baseline.json'
+DEFAULT_THRESHOLD = 0.25         # Regression = more than 25% slower (or larger peak RSS) than the baseline
+MIN_REGRESSION_SECONDS = 0.05    # Ignore slowdowns smaller than this (timer noise on tiny stages)
+MIN_REGRESSION_MB = 20           # Ignore peak RSS growth smaller than this
+EXPLAIN_ROWS_PER_SCALE = 2000    # Rows explained per unit of scale
+WHATIF_PAGES_PER_SCALE = 100     # Pages planned per unit of scale
+MODEL_FILE_NAME = 'aislow_desktop.pkl'
+TARGET_COLUMN = 'SpeedIndex'
+VERSIONED_PACKAGES = ('numpy', 'pandas', 'lightgbm', 'sklearn', 'shap', 'pyarrow')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the load, train, explain and what-if stages.')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES),
+                        help='Stages to run. Default: all')
+    parser.add_argument('--scales', nargs='+', type=int, default=list(DEFAULT_SCALES),
+                        help=f'Data sizes as multiples of the bundled CSV rows. Default: {list(DEFAULT_SCALES)}')
+    parser.add_argument('--repeats', type=int, default=1,
+                        help='Runs per measurement; the fastest is reported. Default: 1')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help=f'Allowed slowdown / memory growth vs the baseline, as a fraction. '
+                             f'Default: {DEFAULT_THRESHOLD}')
+    parser.add_argument('--history', default=HISTORY_FILE,
+                        help=f'JSON file every run is appended to. Default: {HISTORY_FILE}')
+    parser.add_argument('--baseline', default=BASELINE_FILE,
+                        help=f'Baseline results to compare against. Default: {BASELINE_FILE}')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Save this run as the new baseline instead of comparing against it')
+    return parser.parse_args(argv)
+
+
+# --- Data ---
+def get_synthetic_csv(scale, csv_files=None, verbose=True):
+    """
+    CSV with `scale` copies of every bundled row, written once to the cache folder.
+
+    Copies get a '#bench<k>' suffix on their URL so deduplication keeps them all.
+
+    Args:
+        scale: Number of copies (1 = the bundled CSVs themselves)
+        csv_files: Source CSVs (default: CSV_FILES)
+        verbose: If True, print when a file is generated
+
+    Returns:
+        list: CSV file paths for this scale
+    """
+    from data_loader import describe_source_files, load_and_concat_csvs
+
+    csv_files = csv_files or CSV_FILES
+    if scale == 1:
+        return list(csv_files)
+
+    key = json.dumps([scale, describe_source_files(csv_files)], sort_keys=True)
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+    path = os.path.join(CACHE_DIR_NAME, f"bench_{scale}x_{digest}.csv")
+    if os.path.exists(path):
+        return [path]
+
+    df = load_and_concat_csvs(csv_files, use_cache=False)
+    if verbose:
+        print(f"Writing synthetic data: {len(df) * scale} rows ({scale}x) to '{path}'...")
+    os.makedirs(CACHE_DIR_NAME, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    pages = df['page'].astype(object)
+    for k in range(scale):
+        df['page'] = pages if k == 0 else pages + f"#bench{k}"
+        df.to_csv(tmp_path, mode='w' if k == 0 else 'a', header=k == 0, index=False)
+    os.replace(tmp_path, path)
+    return [path]
+
+
+def _load_training_frame(csv_files):
+    from data_loader import load_and_concat_csvs
+
+    df = load_and_concat_csvs(csv_files, remove_duplicates=True)
+    return df.dropna(subset=[TARGET_COLUMN])
+
+
+# --- Stages: each setup returns (run function, rows processed per run) ---
+def _setup_load(csv_files, scale):
+    from data_loader import load_and_concat_csvs
+
+    def run():
+        return load_and_concat_csvs(csv_files, remove_duplicates=True, use_cache=False)
+    return run, None  # Rows are counted from the result
+
+
+def _setup_train(csv_files, scale):
+    from train_model import build_features, train
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        X, y, schema = build_features(_load_training_frame(csv_files))
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return train(X, y, schema.categorical_columns)
+    return run, len(X)
+
+
+def _setup_explain(csv_files, scale):
+    import joblib
+    from batch_explain import prepare_features, compute_contributions
+    from feature_schema import get_schema
+
+    model = joblib.load(MODEL_FILE_NAME)
+    df = _load_training_frame(csv_files)
+    X = prepare_features(df.head(EXPLAIN_ROWS_PER_SCALE * scale), get_schema(model))
+
+    def run():
+        return compute_contributions(model, X)
+    return run, len(X)
+
+
+def _setup_whatif(csv_files, scale):
+    import joblib
+    import numpy as np
+    from batch_explain import prepare_features, compute_contributions
+    from model_config import PROBLEM_THRESHOLD_MS
+    from feature_schema import get_schema
+    from model_artifacts import load_artifacts
+    from whatif import plan_improvements
+
+    model = joblib.load(MODEL_FILE_NAME)
+    percentile_metrics = load_artifacts(MODEL_FILE_NAME)['percentile_metrics']
+    df = _load_training_frame(csv_files).head(WHATIF_PAGES_PER_SCALE * scale)
+    X = prepare_features(df, get_schema(model))
+    raw_values = df[X.columns].to_numpy(dtype=object)
+    shap_values, _ = compute_contributions(model, X)
+    predictions = model.predict(X)
+    order = np.argsort(-np.abs(shap_values), axis=1, kind='stable')
+    is_problem = np.take_along_axis(shap_values, order, axis=1) > PROBLEM_THRESHOLD_MS
+    candidate_features = [order[i][is_problem[i]] for i in range(len(X))]
+
+    def run():
+        return plan_improvements(model, X, raw_values, candidate_features, predictions, percentile_metrics)
+    return run, len(X)
+
+
+STAGE_SETUPS = {'load': _setup_load, 'train': _setup_train, 'explain': _setup_explain, 'whatif': _setup_whatif}
+
+
+def run_stage(stage, scale, csv_files, repeats=1):
+    """
+    Set up and time one stage (called in a fresh worker process).
+
+    Args:
+        stage: One of STAGES
+        scale: Data scale the csv_files correspond to
+        csv_files: Input CSVs
+        repeats: Runs; the fastest is reported
+
+    Returns:
+        dict: stage, scale, rows, seconds, rows_per_sec, peak_rss_mb and setup_rss_mb
+    """
+    run, rows = STAGE_SETUPS[stage](csv_files, scale)
+    setup_rss_mb = peak_rss_mb()
+
+    # Instrumented steps inside the stage (telemetry.stage) nest under it, so its peak includes theirs
+    telemetry = reset_telemetry()
+    for _ in range(max(1, repeats)):
+        with telemetry.stage(stage):
+            result = run()
+    if rows is None:
+        rows = len(result)
+
+    runs = [record for record in telemetry.stages if record['depth'] == 0]
+    seconds = min(record['seconds'] for record in runs)
+    return {
+        'stage': stage,
+        'scale': scale,
+        'rows': int(rows),
+        'seconds': seconds,
+        'rows_per_sec': rows / seconds if seconds > 0 else None,
+        'peak_rss_mb': max(record['peak_rss_mb'] for record in runs),
+        'setup_rss_mb': setup_rss_mb,
+    }
+
+
+def get_environment():
+    """Package versions and machine details recorded with every run."""
+    from importlib import import_module
+
+    versions = {}
+    for package in VERSIONED_PACKAGES:
+        try:
+            versions[package] = import_module(package).__version__
+        except ImportError:
+            versions[package] = None
+    return {'python': platform.python_version(), 'platform': platform.platform(),
+            'cpu_count': os.cpu_count(), 'packages': versions}
+
+
+def run_benchmarks(stages=STAGES, scales=DEFAULT_SCALES, repeats=1, verbose=True):
+    """
+    Run every stage at every scale, each in its own process.
+
+    Returns:
+        dict: timestamp, environment and results (one dict per stage and scale)
+    """
+    # spawn: a clean interpreter per stage, not a fork carrying the parent's memory
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for scale in scales:
+        csv_files = get_synthetic_csv(scale, verbose=verbose)
+        for stage in stages:
+            if verbose:
+                print(f"  {stage} @ {scale}x...", end=' ', flush=True)
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                result = executor.submit(run_stage, stage, scale, csv_files, repeats).result()
+            results.append(result)
+            if verbose:
+                print(f"{result['seconds']:.3f}s, {result['peak_rss_mb']:.0f} MB peak")
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'environment': get_environment(),
+        'repeats': repeats,
+        'results': results,
+    }
+
+
+def compare_to_baseline(run, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Check every result against the baseline result of the same stage and scale.
+
+    Args:
+        run: dict from run_benchmarks()
+        baseline: Baseline run (same format), or None
+        threshold: Allowed relative slowdown / peak RSS growth
+
+    Returns:
+        list: Regression messages (empty = pass). Each result gets 'time_ratio'/'rss_ratio'.
+    """
+    if not baseline:
+        return []
+    reference = {(r['stage'], r['scale']): r for r in baseline['results']}
+    regressions = []
+    for result in run['results']:
+        base = reference.get((result['stage'], result['scale']))
+        if base is None:
+            continue
+        result['time_ratio'] = result['seconds'] / base['seconds'] if base['seconds'] else None
+        result['rss_ratio'] = result['peak_rss_mb'] / base['peak_rss_mb'] if base['peak_rss_mb'] else None
+        label = f"{result['stage']} @ {result['scale']}x"
+        if (result['seconds'] > base['seconds'] * (1 + threshold)
+                and result['seconds'] - base['seconds'] > MIN_REGRESSION_SECONDS):
+            regressions.append(f"{label}: {result['seconds']:.3f}s vs baseline {base['seconds']:.3f}s "
+                               f"({result['time_ratio']:.2f}x)")
+        if (result['peak_rss_mb'] > base['peak_rss_mb'] * (1 + threshold)
+                and result['peak_rss_mb'] - base['peak_rss_mb'] > MIN_REGRESSION_MB):
+            regressions.append(f"{label}: peak RSS {result['peak_rss_mb']:.0f} MB vs baseline "
+                               f"{base['peak_rss_mb']:.0f} MB ({result['rss_ratio']:.2f}x)")
+    return regressions
+
+
+def print_results(run):
+    print(f"\n{'Stage':<9} {'Scale':>6} {'Rows':>10} {'Time (s)':>10} {'Rows/s':>12} {'Peak RSS (MB)':>14} "
+          f"{'vs baseline':>12}")
+    print("-" * 79)
+    for r in run['results']:
+        ratio = r.get('time_ratio')
+        vs_baseline = f"{ratio:.2f}x" if ratio else '-'
+        rows_per_sec = f"{r['rows_per_sec']:,.0f}" if r['rows_per_sec'] else '-'
+        print(f"{r['stage']:<9} {str(r['scale']) + 'x':>6} {r['rows']:>10,} {r['seconds']:>10.3f} "
+              f"{rows_per_sec:>12} {r['peak_rss_mb']:>14.0f} {vs_baseline:>12}")
+
+
+def _read_json(path, default):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return default
+
+
+def _write_json(data, path):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def main(argv=None):
+    """Run the benchmarks. Returns 1 if a stage regressed past the threshold, else 0."""
+    args = parse_args(argv)
+    print(f"Benchmarking {', '.join(args.stages)} at {', '.join(f'{s}x' for s in args.scales)}...")
+    run = run_benchmarks(args.stages, args.scales, repeats=args.repeats)
+
+    baseline = None if args.save_baseline else _read_json(args.baseline, None)
+    regressions = compare_to_baseline(run, baseline, args.threshold)
+    run['threshold'] = args.threshold
+    run['regressions'] = regressions
+    print_results(run)
+
+    history = _read_json(args.history, [])
+    history.append(run)
+    _write_json(history, args.history)
+    print(f"\nAppended results to '{args.history}' ({len(history)} runs)")
+
+    if args.save_baseline:
+        _write_json(run, args.baseline)
+        print(f"Saved baseline to '{args.baseline}'")
+        return 0
+    if baseline is None:
+        print(f"No baseline in '{args.baseline}' to compare against (create one with --save-baseline)")
+        return 0
+    if regressions:
+        print(f"\nREGRESSION (threshold {args.threshold:.0%}):")
+        for message in regressions:
+            print(f"  {message}")
+        return 1
+    print(f"\nNo stage regressed by more than {args.threshold:.0%} against the baseline")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
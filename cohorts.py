@@ -0,0 +1,629 @@
+import argparse
+import os
+import re
+import sys
+import time
+import numpy as np
+import pandas as pd
+from data_loader import CSV_FILES, DEFAULT_BATCH_ROWS, UrlHashSet, iter_csv_batches, compute_row_hashes
+
+# Cohort-aware benchmarks for the what-if step
+# Pages are grouped into cohorts by CDN use, total request count, third-party script density and
+# the source file's rank band, and each cohort gets its own p10/p25/p50/p75/p90 per numeric feature.
+# A page with 2 CDN domains and 40 scripts is then benchmarked against similar pages, not the
+# global percentile of every page.
+#
+# Percentiles come from mergeable quantile sketches (log-spaced buckets with a relative accuracy
+# guarantee, as in DDSketch): adding a new crawl only adds bucket counts, so it can be folded in
+# without rescanning the CSVs already absorbed. Two files are saved next to the model:
+#   aislow_desktop.cohort_sketches.npz  bucket counts per cohort and feature (the mergeable state)
+#   aislow_desktop.cohorts.npz          percentile tables per cohort, what aislow.py loads
+# Cohorts with fewer than MIN_COHORT_PAGES pages back off to a coarser cohort (rank band first,
+# then third-party density, request count and CDN). Every possible label combination is resolved
+# when the tables are built, so looking up a page's benchmarks is a single dict lookup.
+
+MODEL_FILE_NAME = 'aislow_desktop.pkl'
+TARGET_COLUMN = 'SpeedIndex'
+COHORT_LEVELS = {'p10': 0.10, 'p25': 0.25, 'p50': 0.50, 'p75': 0.75, 'p90': 0.90}
+RELATIVE_ACCURACY = 0.01   # Sketch percentiles are within 1% of the exact value
+MIN_COHORT_PAGES = 100     # Smaller cohorts use the benchmarks of a coarser cohort
+ANY = '*'                  # Label of a dimension that isn't split on (or unknown for the page)
+
+# Cohort dimensions, in back-off order (the first one is dropped first)
+COHORT_DIMENSIONS = ('rank_band', 'third_party', 'requests', 'cdn')
+REQUEST_BUCKETS = (0, 50, 100, 200, 400)   # reqTotal bucket lower bounds
+THIRD_PARTY_COLUMNS = ['analytics', 'ads', 'marketing', 'fonts_scripts', 'tagman', 'chat']
+THIRD_PARTY_BUCKETS = (0, 2, 5, 10)        # Third-party script count bucket lower bounds
+CDN_LABELS = ('no-cdn', 'cdn')
+RANK_BAND_PATTERN = re.compile(r'rank under (\d+k)', re.IGNORECASE)
+
+# Sketch bucket codes: 0 is exactly zero, +/-(1 + index + BUCKET_OFFSET) are positive/negative values
+BUCKET_OFFSET = 2048
+CODE_RANGE = 2 * (2 * BUCKET_OFFSET + 2)   # Codes per (cohort, feature) segment of the composite key
+
+
+def get_sketches_path(model_file=MODEL_FILE_NAME):
+    """Mergeable sketches next to the model, e.g. aislow_desktop.pkl -> aislow_desktop.cohort_sketches.npz"""
+    return os.path.splitext(model_file)[0] + '.cohort_sketches.npz'
+
+
+def get_cohorts_path(model_file=MODEL_FILE_NAME):
+    """Percentile tables next to the model, e.g. aislow_desktop.pkl -> aislow_desktop.cohorts.npz"""
+    return os.path.splitext(model_file)[0] + '.cohorts.npz'
+
+
+def rank_band_of(csv_file):
+    """
+    Rank band of a crawl file from its name ('... rank under 10k ...' -> 'top10k').
+
+    Returns:
+        str: The band, or ANY if the name doesn't mention one
+    """
+    match = RANK_BAND_PATTERN.search(os.path.basename(str(csv_file)))
+    return f"top{match.group(1).lower()}" if match else ANY
+
+
+def _bucket_labels(bounds):
+    """Labels for lower bounds, e.g. (0, 50, 100) -> ['0-49', '50-99', '100+']"""
+    labels = [f"{low}-{high - 1}" for low, high in zip(bounds, bounds[1:])]
+    return labels + [f"{bounds[-1]}+"]
+
+
+REQUEST_LABELS = _bucket_labels(REQUEST_BUCKETS)
+THIRD_PARTY_LABELS = _bucket_labels(THIRD_PARTY_BUCKETS)
+
+
+def _bucketize(values, bounds, labels):
+    """Bucket label per value (ANY for missing values)."""
+    positions = np.searchsorted(np.asarray(bounds, dtype=float), values, side='right') - 1
+    return np.where(np.isnan(values), ANY, np.asarray(labels, dtype=object)[np.clip(positions, 0, len(labels) - 1)])
+
+
+def _numeric_values(df, columns):
+    """
+    Columns as a float64 matrix (NaN for missing or non-numeric values).
+
+    Selected one column at a time: a multi-column selection costs ~1 ms even on a single row.
+    """
+    values = np.empty((len(df), len(columns)))
+    for j, col in enumerate(columns):
+        try:
+            values[:, j] = df[col].to_numpy(dtype=np.float64)
+        except (TypeError, ValueError):
+            values[:, j] = pd.to_numeric(df[col], errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+    return values
+
+
+def cohort_labels(df, rank_band=ANY):
+    """
+    Cohort of every page, computed column-wise.
+
+    Args:
+        df: Raw page rows
+        rank_band: Rank band of the file the rows come from (see rank_band_of)
+
+    Returns:
+        np.ndarray: Object array (rows, len(COHORT_DIMENSIONS)) of labels; ANY where a value is missing
+    """
+    n_rows = len(df)
+    labels = np.full((n_rows, len(COHORT_DIMENSIONS)), ANY, dtype=object)
+    labels[:, COHORT_DIMENSIONS.index('rank_band')] = rank_band
+
+    if 'uses_cdn' in df.columns:
+        uses_cdn = df['uses_cdn'].to_numpy(dtype=object)
+        missing = pd.isna(uses_cdn)
+        cdn = np.where(missing, ANY, np.where(np.where(missing, False, uses_cdn).astype(bool), *CDN_LABELS[::-1]))
+        labels[:, COHORT_DIMENSIONS.index('cdn')] = cdn
+
+    # reqTotal and the third-party counts in one column selection (it dominates single-page lookups)
+    columns = [col for col in ['reqTotal'] + THIRD_PARTY_COLUMNS if col in df.columns]
+    values = _numeric_values(df, columns)
+    if 'reqTotal' in columns:
+        labels[:, COHORT_DIMENSIONS.index('requests')] = _bucketize(values[:, 0], REQUEST_BUCKETS, REQUEST_LABELS)
+        values = values[:, 1:]
+    if values.shape[1]:
+        third_party = np.where(np.isnan(values).all(axis=1), np.nan, np.nansum(values, axis=1))
+        labels[:, COHORT_DIMENSIONS.index('third_party')] = _bucketize(third_party, THIRD_PARTY_BUCKETS,
+                                                                       THIRD_PARTY_LABELS)
+    return labels
+
+
+def cohort_key(labels):
+    """String key of one cohort, e.g. 'top10k|5-9|50-99|cdn' (dimensions in COHORT_DIMENSIONS order)."""
+    return '|'.join(labels)
+
+
+def describe_cohort(key):
+    """Human-readable cohort, e.g. 'CDN, 50-99 requests, 5-9 third-party scripts'"""
+    labels = dict(zip(COHORT_DIMENSIONS, key.split('|')))
+    parts = []
+    if labels['cdn'] != ANY:
+        parts.append('CDN' if labels['cdn'] == CDN_LABELS[1] else 'no CDN')
+    if labels['requests'] != ANY:
+        parts.append(f"{labels['requests']} requests")
+    if labels['third_party'] != ANY:
+        parts.append(f"{labels['third_party']} third-party scripts")
+    if labels['rank_band'] != ANY:
+        parts.append(f"rank band {labels['rank_band']}")
+    return ', '.join(parts) if parts else 'all pages'
+
+
+class CohortSketches:
+    """
+    Log-bucket quantile sketches of every feature, one per (full) cohort.
+
+    All counts live in two flat arrays: sorted composite keys (cohort, feature, bucket code)
+    and their counts. Adding pages and merging sketches are np.unique passes over those arrays.
+
+    Args:
+        feature_names: Features sketched
+        relative_accuracy: Bucket width; percentiles are within this relative error
+        cohorts: Cohort keys (the composite keys refer to positions in this list)
+        keys, counts: Composite keys and their counts
+        pages: Pages per cohort
+        integer: Per feature, True while every value seen was a whole number (percentiles get rounded)
+        row_hashes: Sorted hashes of the rows absorbed, so re-adding a crawl counts nothing twice
+    """
+
+    STATE_NAMES = ('feature_names', 'relative_accuracy', 'cohorts', 'keys', 'counts', 'pages', 'integer',
+                   'row_hashes')
+
+    def __init__(self, feature_names, relative_accuracy=RELATIVE_ACCURACY, cohorts=None, keys=None, counts=None,
+                 pages=None, integer=None, row_hashes=None):
+        self.feature_names = list(feature_names)
+        self.relative_accuracy = float(relative_accuracy)
+        self.gamma = (1 + self.relative_accuracy) / (1 - self.relative_accuracy)
+        self.cohorts = list(cohorts) if cohorts is not None else []
+        self._cohort_ids = {key: i for i, key in enumerate(self.cohorts)}
+        self.keys = keys if keys is not None else np.empty(0, dtype=np.int64)
+        self.counts = counts if counts is not None else np.empty(0, dtype=np.int64)
+        self.pages = pages if pages is not None else np.empty(0, dtype=np.int64)
+        self.integer = integer if integer is not None else np.ones(len(self.feature_names), dtype=bool)
+        self.row_hashes = row_hashes if row_hashes is not None else np.empty(0, dtype=np.uint64)
+
+    # --- Bucket codes ---
+    def _encode(self, values):
+        """Bucket code of every value (NaN gets code 0 too; callers mask it out)."""
+        magnitude = np.abs(values)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            index = np.ceil(np.log(magnitude) / np.log(self.gamma))
+        index = np.clip(np.nan_to_num(index, nan=0.0, posinf=BUCKET_OFFSET, neginf=-BUCKET_OFFSET),
+                        -BUCKET_OFFSET, BUCKET_OFFSET).astype(np.int64)
+        codes = np.sign(np.nan_to_num(values)).astype(np.int64) * (1 + index + BUCKET_OFFSET)
+        return codes
+
+    def _decode(self, codes):
+        """Representative value of each bucket code (the bucket's midpoint in relative terms)."""
+        index = np.abs(codes) - 1 - BUCKET_OFFSET
+        return np.sign(codes) * 2 * self.gamma ** index.astype(np.float64) / (self.gamma + 1)
+
+    def _cohort_id(self, key):
+        cohort_id = self._cohort_ids.get(key)
+        if cohort_id is None:
+            cohort_id = self._cohort_ids[key] = len(self.cohorts)
+            self.cohorts.append(key)
+            self.pages = np.append(self.pages, 0)
+        return cohort_id
+
+    def _absorb(self, keys, counts):
+        """Add (composite key, count) pairs to the sketch arrays."""
+        all_keys = np.concatenate([self.keys, keys])
+        self.keys, inverse = np.unique(all_keys, return_inverse=True)
+        self.counts = np.bincount(inverse, weights=np.concatenate([self.counts, counts]),
+                                  minlength=len(self.keys)).astype(np.int64)
+
+    # --- Building ---
+    def add_frame(self, df, rank_band=ANY):
+        """
+        Add the pages of a raw DataFrame (rows already absorbed are skipped).
+
+        Args:
+            df: Raw page rows
+            rank_band: Rank band of the file the rows come from
+
+        Returns:
+            int: Pages added
+        """
+        row_hashes = compute_row_hashes(df)
+        is_new = ~np.isin(row_hashes, self.row_hashes)
+        is_new &= ~pd.Series(row_hashes).duplicated().to_numpy()
+        if not is_new.any():
+            return 0
+        df = df[is_new]
+        self.row_hashes = np.union1d(self.row_hashes, row_hashes[is_new])
+
+        labels = cohort_labels(df, rank_band)
+        page_keys = pd.Series([cohort_key(row) for row in labels])
+        unique_keys, page_cohorts = np.unique(page_keys.to_numpy(dtype=object), return_inverse=True)
+        cohort_ids = np.array([self._cohort_id(key) for key in unique_keys], dtype=np.int64)[page_cohorts]
+        np.add.at(self.pages, cohort_ids, 1)
+
+        values = _numeric_values(df.reindex(columns=self.feature_names), self.feature_names)
+        present = ~np.isnan(values)
+        self.integer &= np.all(~present | (values == np.round(values)), axis=0)
+
+        n_features = len(self.feature_names)
+        segments = cohort_ids[:, None] * n_features + np.arange(n_features)
+        composite = segments * CODE_RANGE + self._encode(values) + CODE_RANGE // 2
+        keys, counts = np.unique(composite[present], return_counts=True)
+        self._absorb(keys, counts)
+        return int(is_new.sum())
+
+    def add_csvs(self, csv_files=None, batch_rows=DEFAULT_BATCH_ROWS, verbose=False):
+        """
+        Fold crawl CSVs in batch by batch. Each file's rank band comes from its name.
+
+        URLs are deduplicated across the files (first occurrence wins, as in training), and
+        rows without a target are skipped.
+
+        Returns:
+            int: Pages added
+        """
+        seen_urls = UrlHashSet()
+        added = 0
+        for csv_file in csv_files or CSV_FILES:
+            rank_band = rank_band_of(csv_file)
+            file_added = 0
+            for batch in iter_csv_batches([csv_file], batch_rows=batch_rows):
+                if 'page' in batch.columns:
+                    batch = batch[seen_urls.add_unseen(batch['page'])]
+                if TARGET_COLUMN in batch.columns:
+                    batch = batch[batch[TARGET_COLUMN].notna()]
+                file_added += self.add_frame(batch, rank_band)
+            added += file_added
+            if verbose:
+                print(f"  '{csv_file}' (rank band {rank_band}): {file_added} new pages")
+        return added
+
+    def merge(self, other):
+        """
+        Add another sketch's counts (same features and accuracy) to this one.
+
+        Sketches only keep counts, so rows absorbed by both are counted twice; to fold a crawl
+        into saved sketches, call add_csvs on them instead (it skips rows already absorbed).
+        """
+        if other.feature_names != self.feature_names or other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('Sketches with different features or accuracy cannot be merged')
+        remap = np.array([self._cohort_id(key) for key in other.cohorts], dtype=np.int64)
+        np.add.at(self.pages, remap, other.pages)
+        segments, codes = np.divmod(other.keys, CODE_RANGE)
+        cohorts, features = np.divmod(segments, len(self.feature_names))
+        self._absorb((remap[cohorts] * len(self.feature_names) + features) * CODE_RANGE + codes, other.counts)
+        self.integer &= other.integer
+        self.row_hashes = np.union1d(self.row_hashes, other.row_hashes)
+        return self
+
+    # --- Percentiles ---
+    def _group_percentiles(self, member_cohort, member_group, n_groups, quantiles):
+        """
+        Percentiles of every feature for groups of cohorts (the groups' sketches merged).
+
+        Args:
+            member_cohort, member_group: (cohort, group) pairs, each pair once; a cohort may
+                belong to several groups
+
+        Returns:
+            np.ndarray: (n_groups, len(quantiles), features) values, NaN where a feature has no data
+        """
+        n_features = len(self.feature_names)
+        segments, codes = np.divmod(self.keys, CODE_RANGE)
+        cohorts, features = np.divmod(segments, n_features)
+        # Repeat each sketch bucket once per group its cohort belongs to
+        order = np.argsort(member_cohort, kind='stable')
+        member_groups = member_group[order]
+        groups_per_cohort = np.bincount(member_cohort, minlength=len(self.cohorts))
+        first_member = np.cumsum(groups_per_cohort) - groups_per_cohort
+        repeats = groups_per_cohort[cohorts]
+        entries = np.repeat(np.arange(len(self.keys)), repeats)
+        offsets = np.arange(len(entries)) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+        groups = member_groups[first_member[cohorts[entries]] + offsets]
+        group_keys = (groups * n_features + features[entries]) * CODE_RANGE + codes[entries]
+        keys, inverse = np.unique(group_keys, return_inverse=True)
+        counts = np.bincount(inverse, weights=self.counts[entries], minlength=len(keys))
+
+        # Keys are sorted by segment, then by bucket code, which is value order
+        segments = keys // CODE_RANGE
+        starts = np.flatnonzero(np.r_[True, segments[1:] != segments[:-1]])
+        ends = np.r_[starts[1:], len(keys)]
+        cumulative = np.cumsum(counts)
+        before = np.r_[0, cumulative[:-1]][starts]
+        totals = cumulative[ends - 1] - before
+
+        result = np.full((n_groups * n_features, len(quantiles)), np.nan)
+        values = self._decode(keys % CODE_RANGE - CODE_RANGE // 2)
+        for q, quantile in enumerate(quantiles):
+            # The bucket holding the value at rank q * (n - 1) of each segment
+            positions = np.searchsorted(cumulative, before + np.floor(quantile * (totals - 1)), side='right')
+            result[segments[starts], q] = values[positions]
+        result = result.reshape(n_groups, n_features, len(quantiles)).transpose(0, 2, 1)
+        return np.where(self.integer, np.round(result), result)
+
+    def build_tables(self, levels=COHORT_LEVELS, min_pages=MIN_COHORT_PAGES):
+        """
+        Percentile tables for every cohort and every coarser cohort it backs off to.
+
+        Args:
+            levels: dict level name -> quantile
+            min_pages: Cohorts with fewer pages resolve to a coarser cohort
+
+        Returns:
+            CohortTables
+        """
+        # Every cohort, with any subset of its dimensions replaced by ANY. A cohort that already
+        # has ANY labels (unbanded CSVs, missing CDN/request data) reaches some groups through
+        # several masks, so memberships are collected as a set: each cohort counts once per group
+        group_ids, group_keys = {}, []
+        memberships = set()
+        for cohort, key in enumerate(self.cohorts):
+            labels = key.split('|')
+            for mask in range(2 ** len(COHORT_DIMENSIONS)):
+                group = cohort_key(ANY if mask >> d & 1 else label for d, label in enumerate(labels))
+                if group not in group_ids:
+                    group_ids[group] = len(group_keys)
+                    group_keys.append(group)
+                memberships.add((cohort, group_ids[group]))
+        memberships = np.array(sorted(memberships), dtype=np.int64).reshape(-1, 2)
+        member_cohort, member_group = memberships[:, 0], memberships[:, 1]
+
+        quantiles = list(levels.values())
+        n_groups = len(group_keys)
+        values = self._group_percentiles(member_cohort, member_group, n_groups, quantiles)
+        pages = np.bincount(member_group, weights=self.pages[member_cohort],
+                            minlength=n_groups).astype(np.int64)
+
+        return CohortTables.from_groups(group_keys, pages, values, self.feature_names, list(levels), min_pages)
+
+    # --- Persistence ---
+    def save(self, path):
+        state = {name: getattr(self, name) for name in self.STATE_NAMES}
+        state['feature_names'] = np.array(self.feature_names, dtype=str)
+        state['cohorts'] = np.array(self.cohorts, dtype=str)
+        np.savez_compressed(path, **state)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        """Load saved sketches. Returns None if the file doesn't exist or can't be read."""
+        try:
+            with np.load(path) as data:
+                state = {name: data[name] for name in cls.STATE_NAMES}
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+        state['feature_names'] = state['feature_names'].tolist()
+        state['relative_accuracy'] = float(state['relative_accuracy'])
+        state['cohorts'] = state['cohorts'].tolist()
+        return cls(**state)
+
+
+class CohortTables:
+    """
+    Benchmark percentiles per cohort, with every label combination resolved ahead of time.
+
+    Args:
+        group_keys: Cohorts with enough pages (keys may contain ANY)
+        pages: Pages per cohort
+        values: (cohorts, levels, features) percentiles; gaps filled from coarser cohorts
+        feature_names, levels: Axes of values
+        resolve: dict cohort key (any label combination) -> position in group_keys
+    """
+
+    def __init__(self, group_keys, pages, values, feature_names, levels, resolve):
+        self.group_keys = list(group_keys)
+        self.pages = pages
+        self.values = values
+        self.feature_names = list(feature_names)
+        self.levels = list(levels)
+        self.resolve = resolve
+        self._metrics = [None] * len(self.group_keys)
+
+    @classmethod
+    def from_groups(cls, group_keys, pages, values, feature_names, levels, min_pages=MIN_COHORT_PAGES):
+        """Keep the cohorts with at least min_pages pages and resolve every label combination."""
+        positions = {key: i for i, key in enumerate(group_keys)}
+
+        def back_off(key):
+            labels = key.split('|')
+            for d in range(len(labels)):
+                if labels[d] != ANY:
+                    labels[d] = ANY
+                    return cohort_key(labels)
+            return None
+
+        def target(key):
+            # First cohort on the back-off chain with enough pages
+            while key is not None:
+                position = positions.get(key)
+                if position is not None and pages[position] >= min_pages:
+                    return key
+                key = back_off(key)
+            return None
+
+        kept = [key for key in group_keys if pages[positions[key]] >= min_pages]
+        global_key = cohort_key([ANY] * len(COHORT_DIMENSIONS))
+        if global_key not in kept:
+            kept.append(global_key)  # Tiny crawls: the global cohort is the only fallback
+        kept.sort(key=lambda key: (key.count(ANY), key), reverse=True)  # Coarsest first
+        kept_positions = {key: i for i, key in enumerate(kept)}
+        kept_values = values[[positions[key] for key in kept]]
+        for i, key in enumerate(kept):
+            # Features without data in a cohort take the value of the cohort it backs off to
+            parent = target(back_off(key))
+            if parent is not None:
+                gaps = np.isnan(kept_values[i])
+                kept_values[i][gaps] = kept_values[kept_positions[parent]][gaps]
+
+        labels_per_dimension = [{ANY} for _ in COHORT_DIMENSIONS]
+        for key in group_keys:
+            for d, label in enumerate(key.split('|')):
+                labels_per_dimension[d].add(label)
+        resolve = {}
+        for combination in _product(labels_per_dimension):
+            key = cohort_key(combination)
+            resolve[key] = kept_positions[target(key) or global_key]
+        return cls(kept, pages[[positions[key] for key in kept]], kept_values.astype(np.float32),
+                   feature_names, levels, resolve)
+
+    def _group_of(self, labels):
+        return self.resolve.get(cohort_key(labels), self.resolve[cohort_key([ANY] * len(COHORT_DIMENSIONS))])
+
+    def metrics(self, position):
+        """Benchmarks of one cohort as dict level -> {feature: value}, like the sidecar's percentile_metrics."""
+        metrics = self._metrics[position]
+        if metrics is None:
+            table = self.values[position]
+            metrics = self._metrics[position] = {
+                level: {col: float(value) for col, value in zip(self.feature_names, table[q]) if not np.isnan(value)}
+                for q, level in enumerate(self.levels)}
+        return metrics
+
+    def lookup(self, df, rank_band=ANY):
+        """
+        Cohort of every page and the benchmarks it should be compared with.
+
+        Args:
+            df: Raw page rows
+            rank_band: Rank band of the file the pages come from (ANY if unknown)
+
+        Returns:
+            tuple: (list of cohort keys, list of percentile_metrics dicts), one per page
+        """
+        positions = self.positions(df, rank_band)
+        return [self.group_keys[p] for p in positions], [self.metrics(p) for p in positions]
+
+    def positions(self, df, rank_band=ANY):
+        """
+        Cohort of every page as a position in group_keys (and the first axis of values),
+        for callers that read the benchmarks straight from the table.
+        """
+        return np.array([self._group_of(labels) for labels in cohort_labels(df, rank_band)], dtype=np.int64)
+
+    def describe(self, key):
+        """Cohort description with its page count, e.g. 'CDN, 100-199 requests (1,234 pages)'"""
+        return f"{describe_cohort(key)} ({self.pages[self.group_keys.index(key)]:,} pages)"
+
+    def digest(self):
+        """Short hash of the tables (part of the explanation cache key)."""
+        import hashlib
+
+        sha = hashlib.sha256()
+        sha.update('\n'.join(self.group_keys + self.feature_names + self.levels).encode('utf-8'))
+        sha.update(np.ascontiguousarray(self.values).tobytes())
+        return sha.hexdigest()[:16]
+
+    def save(self, path):
+        resolve_keys = list(self.resolve)
+        np.savez_compressed(path, group_keys=np.array(self.group_keys, dtype=str), pages=self.pages,
+                            values=self.values, feature_names=np.array(self.feature_names, dtype=str),
+                            levels=np.array(self.levels, dtype=str),
+                            resolve_keys=np.array(resolve_keys, dtype=str),
+                            resolve_positions=np.array([self.resolve[key] for key in resolve_keys], dtype=np.int32))
+        return path
+
+    @classmethod
+    def load(cls, path):
+        """Load saved tables. Returns None if the file doesn't exist or can't be read."""
+        try:
+            with np.load(path) as data:
+                resolve = dict(zip(data['resolve_keys'].tolist(), data['resolve_positions'].tolist()))
+                return cls(data['group_keys'].tolist(), data['pages'], data['values'],
+                           data['feature_names'].tolist(), data['levels'].tolist(), resolve)
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+
+def _product(label_sets):
+    """Every combination of one label per dimension."""
+    import itertools
+    return itertools.product(*[sorted(labels) for labels in label_sets])
+
+
+def update_cohort_tables(model_file=MODEL_FILE_NAME, csv_files=None, feature_names=None, rebuild=False,
+                         verbose=False):
+    """
+    Fold crawl CSVs into the saved sketches and rewrite the percentile tables.
+
+    Args:
+        model_file: Model the files are saved next to
+        csv_files: CSVs to fold in (default: CSV_FILES)
+        feature_names: Features to sketch when starting from scratch (default: the sidecar's benchmarks)
+        rebuild: If True, start from empty sketches instead of the saved ones
+        verbose: If True, print per-file progress
+
+    Returns:
+        tuple: (CohortTables, pages added)
+    """
+    sketches = None if rebuild else CohortSketches.load(get_sketches_path(model_file))
+    if sketches is None:
+        if feature_names is None:
+            from model_artifacts import load_artifacts
+
+            artifacts = load_artifacts(model_file)
+            if artifacts is None:
+                raise FileNotFoundError(f"No sketches or sidecar for '{model_file}'; run train_model.py first")
+            feature_names = list(artifacts['percentile_metrics'][next(iter(artifacts['percentile_metrics']))])
+        sketches = CohortSketches(feature_names)
+    added = sketches.add_csvs(csv_files, verbose=verbose)
+    sketches.save(get_sketches_path(model_file))
+    tables = sketches.build_tables()
+    tables.save(get_cohorts_path(model_file))
+    return tables, added
+
+
+def load_cohort_tables(model_file=MODEL_FILE_NAME):
+    """
+    Load the cohort percentile tables of a model file.
+
+    Returns:
+        CohortTables or None: None if train_model.py / cohorts.py hasn't built them yet
+    """
+    return CohortTables.load(get_cohorts_path(model_file))
+
+
+def check_tables(sketches, tables):
+    """
+    Brute-force check of the roll-up in build_tables: each kept cohort must have as many pages
+    as the sketched cohorts it matches (ANY matching any label) have between them.
+
+    Returns:
+        list: (cohort key, pages in the tables, expected pages) per mismatch
+    """
+    cohort_labels = [key.split('|') for key in sketches.cohorts]
+    mismatches = []
+    for key, pages in zip(tables.group_keys, tables.pages):
+        labels = key.split('|')
+        expected = sum(int(cohort_pages) for cohort, cohort_pages in zip(cohort_labels, sketches.pages)
+                       if all(label in (ANY, own) for label, own in zip(labels, cohort)))
+        if int(pages) != expected:
+            mismatches.append((key, int(pages), expected))
+    return mismatches
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fold crawl CSVs into the cohort benchmark tables.')
+    parser.add_argument('csv', nargs='*', help='Crawl CSVs to add (default: the CSV_FILES list in data_loader.py)')
+    parser.add_argument('--rebuild', action='store_true', help='Start from empty sketches instead of the saved ones')
+    parser.add_argument('--check', action='store_true',
+                        help='Also check every cohort\'s page count against a brute-force sum over the sketches')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    try:
+        tables, added = update_cohort_tables(MODEL_FILE_NAME, args.csv or None, rebuild=args.rebuild, verbose=True)
+    except FileNotFoundError as e:
+        print(f"ERROR: {e}")
+        return 1
+    print(f"Added {added} pages in {time.perf_counter() - start:.1f}s; "
+          f"{len(tables.group_keys)} cohorts with at least {MIN_COHORT_PAGES} pages")
+    print(f"Saved '{get_sketches_path(MODEL_FILE_NAME)}' and '{get_cohorts_path(MODEL_FILE_NAME)}'")
+    if args.check:
+        mismatches = check_tables(CohortSketches.load(get_sketches_path(MODEL_FILE_NAME)), tables)
+        for key, pages, expected in mismatches:
+            print(f"  MISMATCH '{key}': {pages} pages, expected {expected}")
+        print(f"Checked {len(tables.group_keys)} cohorts: {len(mismatches)} mismatches")
+        if mismatches:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,272 @@
+import time
+import numpy as np
+import pandas as pd
+import lightgbm as lgb
+from sklearn.model_selection import train_test_split
+from model_config import WHAT_IF_CATEGORICAL_OPTIONS
+from multi_target import to_regressor
+
+# Model compaction used by `train_model.py --compact`
+# TreeSHAP cost grows with trees x leaves x depth², so after training, cheaper stand-ins are tried:
+#   - truncation: only the first trees of the ensemble
+#   - distillation: a new ensemble with fewer leaves per tree, trained on the full model's
+#     predictions (the function it learned, which is smoother than the labels)
+#   - the same distillations with near-zero-gain features switched off (feature_contri = 0, so
+#     the model still takes every feature and the sidecars, cache and reports don't change).
+#     Features the what-if optimizer moves (benchmarked or with 'good' options) always stay on
+# Each is scored on the held-out rows (R², agreement with the full model's predictions and top
+# problems) and its TreeSHAP is timed for the report. The one with the lowest TreeSHAP cost
+# (trees x leaves x depth², deterministic unlike timings) within the R² tolerance that still
+# names the same #1 problem for most pages replaces the model.
+
+R2_TOLERANCE = 0.01           # Most test R² a compact model may lose against the full one
+MIN_TOP1_AGREEMENT = 0.9      # Least share of pages whose #1 problem must stay the same
+TRUNCATE_FRACTIONS = (0.75, 0.5)
+DISTILL_LEAVES = (15, 7)
+DISTILL_LEARNING_RATE = 0.2   # Fewer, shallower trees need bigger steps
+DISTILL_ROUNDS = 500
+EARLY_STOPPING_ROUNDS = 10
+MIN_GAIN_SHARE = 0.002        # Features with less of the total gain are switched off
+VALID_FRACTION = 0.1          # Share of the training rows held out for distillation early stopping
+TOP_PROBLEMS = 5              # Top features by |SHAP| compared with the full model (as in the report)
+SINGLE_ROW_CALLS = 50
+SEED = 42
+
+
+def tree_stats(model):
+    """
+    Size of the ensemble predict() and TreeSHAP walk (up to the best iteration).
+
+    Returns:
+        dict: trees, mean leaves per tree and mean depth
+    """
+    dump = model.booster_.dump_model(num_iteration=model.best_iteration_ or None)
+
+    def depth(node):
+        if 'split_index' not in node:
+            return 0
+        return 1 + max(depth(node['left_child']), depth(node['right_child']))
+
+    trees = dump['tree_info']
+    return {
+        'trees': len(trees),
+        'leaves': float(np.mean([tree['num_leaves'] for tree in trees])),
+        'depth': float(np.mean([depth(tree['tree_structure']) for tree in trees])),
+    }
+
+
+def shap_cost(stats):
+    """TreeSHAP work of an ensemble from its tree_stats: trees x leaves x depth²."""
+    return stats['trees'] * stats['leaves'] * stats['depth'] ** 2
+
+
+def truncate(model, n_trees):
+    """The first n_trees trees of a model (see multi_target.to_regressor)."""
+    booster = lgb.Booster(model_str=model.booster_.model_to_string(num_iteration=n_trees))
+    return to_regressor(booster, model.booster_.pandas_categorical)
+
+
+def what_if_features(X):
+    """
+    Features the what-if optimizer can move: those with 'good' options in
+    WHAT_IF_CATEGORICAL_OPTIONS and every feature with p10/p25/p50 benchmarks (numeric and not
+    boolean before category conversion, as in batch_explain.compute_percentile_metrics).
+    """
+    features = []
+    for col in X.columns:
+        dtype = X[col].cat.categories.dtype if isinstance(X[col].dtype, pd.CategoricalDtype) else X[col].dtype
+        if (col in WHAT_IF_CATEGORICAL_OPTIONS
+                or (pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype))):
+            features.append(col)
+    return features
+
+
+def low_gain_features(model, min_gain_share=MIN_GAIN_SHARE, keep=()):
+    """Features contributing less than min_gain_share of the model's total split gain, except keep."""
+    gain = model.booster_.feature_importance(importance_type='gain')
+    share = gain / gain.sum()
+    return [name for name, value in zip(model.feature_name_, share) if value < min_gain_share and name not in keep]
+
+
+def distill(X_train, teacher_train, X_valid, teacher_valid, categorical_features, num_leaves, disabled=()):
+    """
+    Train a smaller ensemble on a model's predictions.
+
+    Args:
+        X_train, X_valid: Feature DataFrames (validation rows drive early stopping)
+        teacher_train, teacher_valid: The full model's predictions for them
+        categorical_features: Categorical feature names
+        num_leaves: Leaves per tree of the new ensemble
+        disabled: Features the new ensemble may not split on
+
+    Returns:
+        LGBMRegressor
+    """
+    params = dict(random_state=SEED, n_estimators=DISTILL_ROUNDS, learning_rate=DISTILL_LEARNING_RATE,
+                  num_leaves=num_leaves, verbosity=-1)
+    if disabled:
+        params['feature_contri'] = [0.0 if name in disabled else 1.0 for name in X_train.columns]
+    model = lgb.LGBMRegressor(**params)
+    model.fit(X_train, teacher_train,
+              eval_set=[(X_valid, teacher_valid)],
+              eval_metric='l2',
+              callbacks=[lgb.early_stopping(stopping_rounds=EARLY_STOPPING_ROUNDS, verbose=False)],
+              categorical_feature=categorical_features)
+    return model
+
+
+def _r2(y_true, y_pred):
+    y_true = np.asarray(y_true, dtype=np.float64)
+    return float(1 - np.sum((y_true - y_pred) ** 2) / np.sum((y_true - y_true.mean()) ** 2))
+
+
+def _top_features(shap_values):
+    return np.argsort(-np.abs(shap_values), axis=1, kind='stable')[:, :TOP_PROBLEMS]
+
+
+def time_explanations(model, X):
+    """
+    TreeSHAP timings: one call over every row of X, and the median single-row call
+    (what one page's report pays).
+
+    Returns:
+        tuple: (SHAP values of X, ms per 1,000 rows, single-row ms)
+    """
+    start = time.perf_counter()
+    contributions = model.predict(X, pred_contrib=True)
+    batch_seconds = time.perf_counter() - start
+    single_seconds = []
+    for i in range(min(SINGLE_ROW_CALLS, len(X))):
+        row = X.iloc[[i]]
+        start = time.perf_counter()
+        model.predict(row, pred_contrib=True)
+        single_seconds.append(time.perf_counter() - start)
+    return (np.asarray(contributions)[:, :-1], batch_seconds * 1000 * 1000 / len(X),
+            float(np.median(single_seconds)) * 1000)
+
+
+def evaluate_candidate(name, model, X_test, y_test, full_predictions, full_top=None):
+    """
+    Score one candidate against the held-out labels and the full model.
+
+    Args:
+        full_top: The full model's top features per page (None when scoring the full model itself)
+
+    Returns:
+        dict: name, model, top (its top features per page), size (tree_stats), shap_cost, r2,
+              fidelity_r2 (vs the full model's predictions), top1_agreement and top5_overlap (share
+              of pages with the same #1 / top problems), shap_ms_per_1k_rows and single_row_ms
+    """
+    predictions = model.predict(X_test)
+    shap_values, batch_ms, single_ms = time_explanations(model, X_test)
+    top = _top_features(shap_values)
+    if full_top is None:
+        full_top = top
+    overlap = (top[:, :, None] == full_top[:, None, :]).any(axis=2).mean(axis=1)
+    stats = tree_stats(model)
+    return dict(
+        name=name,
+        model=model,
+        top=top,
+        **stats,
+        shap_cost=shap_cost(stats),
+        r2=_r2(y_test, predictions),
+        fidelity_r2=_r2(full_predictions, predictions),
+        top1_agreement=float(np.mean(top[:, 0] == full_top[:, 0])),
+        top5_overlap=float(overlap.mean()),
+        shap_ms_per_1k_rows=batch_ms,
+        single_row_ms=single_ms,
+    )
+
+
+def compact_model(model, X, y, categorical_features, r2_tolerance=R2_TOLERANCE, verbose=True):
+    """
+    Try every compaction and pick the cheapest model (lowest shap_cost) within the R² tolerance
+    that keeps the #1 problem of at least MIN_TOP1_AGREEMENT of the pages.
+
+    Uses the same 80/20 split as train_model.train: distilled models learn the full model's
+    predictions on the training rows, less VALID_FRACTION of them held out for early stopping,
+    and the test rows are only used for the scores.
+
+    Args:
+        model: Trained LGBMRegressor
+        X, y: Training features (categorical columns converted) and target
+        categorical_features: Categorical feature names
+        r2_tolerance: Most test R² the compact model may lose
+        verbose: If True, print each candidate as it is built
+
+    Returns:
+        tuple: (chosen LGBMRegressor, the full model if nothing qualifies;
+                report dict with the thresholds, chosen (name) and candidates (without models))
+    """
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=SEED)
+    X_fit, X_valid = train_test_split(X_train, test_size=VALID_FRACTION, random_state=SEED)
+    teacher_fit = model.predict(X_fit)
+    teacher_valid = model.predict(X_valid)
+    full_predictions = model.predict(X_test)
+    full = evaluate_candidate('full', model, X_test, y_test, full_predictions)
+
+    n_trees = model.best_iteration_ or model.booster_.num_trees()
+    disabled = low_gain_features(model, keep=what_if_features(X))
+    builders = [(f"truncate {int(n_trees * fraction)} trees", lambda n=int(n_trees * fraction): truncate(model, n))
+                 for fraction in TRUNCATE_FRACTIONS]
+    for num_leaves in DISTILL_LEAVES:
+        builders.append((f"distill {num_leaves} leaves", lambda l=num_leaves: distill(
+            X_fit, teacher_fit, X_valid, teacher_valid, categorical_features, l)))
+        if disabled:
+            builders.append((f"distill {num_leaves} leaves, -{len(disabled)} features", lambda l=num_leaves: distill(
+                X_fit, teacher_fit, X_valid, teacher_valid, categorical_features, l, disabled)))
+
+    candidates = [full]
+    for name, build in builders:
+        start = time.perf_counter()
+        candidate = evaluate_candidate(name, build(), X_test, y_test, full_predictions, full['top'])
+        if verbose:
+            print(f"  {name:<32} built and scored in {time.perf_counter() - start:.1f}s")
+        candidates.append(candidate)
+
+    for candidate in candidates:
+        candidate['speedup'] = full['shap_ms_per_1k_rows'] / candidate['shap_ms_per_1k_rows']
+        candidate['relative_cost'] = candidate['shap_cost'] / full['shap_cost']
+    eligible = [c for c in candidates
+                if c['r2'] >= full['r2'] - r2_tolerance and c['top1_agreement'] >= MIN_TOP1_AGREEMENT]
+    chosen = min(eligible, key=lambda c: c['shap_cost'])  # Ties keep the earlier candidate (the full model first)
+    report = {
+        'r2_tolerance': r2_tolerance,
+        'min_top1_agreement': MIN_TOP1_AGREEMENT,
+        'disabled_features': disabled,
+        'chosen': chosen['name'],
+        'candidates': [{key: value for key, value in c.items() if key not in ('model', 'top')} for c in candidates],
+    }
+    return chosen['model'], report
+
+
+def print_compaction_report(report):
+    """Print the accuracy/latency trade-off of every candidate and the one chosen."""
+    print(f"\n--- Model Compaction (R² tolerance {report['r2_tolerance']}, "
+          f"#1 problem kept for {report['min_top1_agreement']:.0%} of pages) ---")
+    print(f"{'Candidate':<32} {'Trees':>5} {'Leaves':>6} {'Depth':>5} {'R²':>7} {'Fidelity':>8} "
+          f"{'Top-1':>6} {'Top-5':>6} {'Cost':>5} {'SHAP ms/1k':>10} {'1 row ms':>8} {'Speedup':>7}")
+    print("-" * 119)
+    for c in report['candidates']:
+        marker = ' <-' if c['name'] == report['chosen'] else ''
+        print(f"{c['name']:<32} {c['trees']:>5} {c['leaves']:>6.1f} {c['depth']:>5.1f} {c['r2']:>7.4f} "
+              f"{c['fidelity_r2']:>8.4f} {c['top1_agreement']:>6.1%} {c['top5_overlap']:>6.1%} "
+              f"{c['relative_cost']:>5.2f} {c['shap_ms_per_1k_rows']:>10.1f} {c['single_row_ms']:>8.2f} {c['speedup']:>6.2f}x{marker}")
+    if report['disabled_features']:
+        print(f"\nFeatures switched off (< {MIN_GAIN_SHARE:.1%} of the gain, what-if features kept): "
+              f"{', '.join(report['disabled_features'])}")
+    print(f"Chosen: {report['chosen']} (lowest TreeSHAP cost, trees x leaves x depth², relative to the full model)")
+
+
+if __name__ == '__main__':
+    # Report the trade-off for the current model without saving anything
+    import contextlib
+    import io
+    import joblib
+    from train_model import MODEL_FILE_NAME, load_training_data, build_features
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        X, y, schema = build_features(load_training_data())
+    _, report = compact_model(joblib.load(MODEL_FILE_NAME), X, y, schema.categorical_columns)
+    print_compaction_report(report)
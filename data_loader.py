@@ -1,6 +1,14 @@
+import hashlib
+import os
+import numpy as np
 import pandas as pd
 import sys
 
+try:
+    import pyarrow.feather as feather
+except ImportError:  # The binary cache is optional; without pyarrow we just parse the CSVs
+    feather = None
+
 # Default CSV files to load
 CSV_FILES = [
     'fast 6k - rank under 10k si 500 to 2500.csv',
@@ -8,7 +16,183 @@ CSV_FILES = [
     'slow 13k - rank under 100K si 4500 to 20k.csv'
 ]
 
-def load_and_concat_csvs(csv_files=None, remove_duplicates=False, verbose=False):
+# Parsed CSVs are cached as uncompressed Feather files (memory-mappable) in this folder,
+# created next to each CSV. Entries are keyed by path, size and mtime, so an edited CSV
+# is re-parsed automatically; entries whose CSV was changed, moved or deleted are removed
+# whenever a new entry is written.
+CACHE_DIR_NAME = '.aislow_cache'
+CACHE_FORMAT_VERSION = 1
+MAX_CATEGORY_FRACTION = 0.05  # object columns with fewer unique values than this become 'category'
+BOOL_CATEGORIES = pd.CategoricalDtype([False, True])  # True/False columns with missing values
+DEFAULT_BATCH_ROWS = 20000    # Rows parsed per chunk by iter_csv_batches
+
+
+def compact_dtypes(df, categorize=True):
+    """
+    Shrink a freshly parsed DataFrame to compact dtypes without changing any value.
+
+    Integers are downcast to the smallest type that fits, floats become float32 only
+    when that round-trips exactly, and low-cardinality object columns become 'category'.
+
+    Args:
+        df: DataFrame as returned by pd.read_csv
+        categorize: If False, only True/False object columns become 'category' (with fixed
+            BOOL_CATEGORIES, so streamed chunks agree); other object columns are left alone
+
+    Returns:
+        pd.DataFrame: The same data with compact dtypes
+    """
+    df = df.copy()
+    for col in df.columns:
+        series = df[col]
+        if pd.api.types.is_bool_dtype(series.dtype):
+            continue
+        if pd.api.types.is_integer_dtype(series.dtype):
+            df[col] = pd.to_numeric(series, downcast='integer')
+        elif pd.api.types.is_float_dtype(series.dtype):
+            as_float32 = series.astype('float32')
+            if as_float32.astype('float64').equals(series):
+                df[col] = as_float32
+        elif categorize and series.dtype == object and series.nunique() <= max(2, MAX_CATEGORY_FRACTION * len(series)):
+            df[col] = series.astype('category')
+        elif series.dtype == object and pd.api.types.infer_dtype(series, skipna=True) == 'boolean':
+            df[col] = series.astype(BOOL_CATEGORIES)
+    return df
+
+
+def is_parquet(path):
+    """True for Parquet files (e.g. from wpt_extract.py), which are read instead of parsed as CSV."""
+    return str(path).lower().endswith('.parquet')
+
+
+def iter_file_chunks(path, chunk_rows):
+    """
+    Read a CSV or Parquet file in chunks of up to chunk_rows rows.
+
+    Raises:
+        FileNotFoundError: If the file doesn't exist
+    """
+    if is_parquet(path):
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows):
+            yield batch.to_pandas()
+        return
+    with pd.read_csv(path, chunksize=chunk_rows) as reader:
+        yield from reader
+
+
+def _get_cache_path(csv_file):
+    """Cache file for a CSV, keyed by absolute path, size and mtime."""
+    csv_path = os.path.abspath(csv_file)
+    stat = os.stat(csv_path)
+    key = f"{CACHE_FORMAT_VERSION}|{csv_path}|{stat.st_size}|{stat.st_mtime_ns}"
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+    cache_dir = os.path.join(os.path.dirname(csv_path), CACHE_DIR_NAME)
+    return os.path.join(cache_dir, f"{os.path.basename(csv_path)}.{digest}.feather")
+
+
+def _prune_cache(cache_dir):
+    """Drop the entries whose CSV no longer has the key they were written under (changed, moved or deleted)."""
+    csv_dir = os.path.dirname(os.path.abspath(cache_dir))
+    for name in os.listdir(cache_dir):
+        if not name.endswith('.feather'):
+            continue
+        try:
+            current = os.path.basename(_get_cache_path(os.path.join(csv_dir, name.rsplit('.', 2)[0])))
+        except OSError:  # The CSV is gone
+            current = None
+        if name != current:
+            os.remove(os.path.join(cache_dir, name))
+
+
+def _write_cache(df, cache_path):
+    """Atomically write the cache file and drop stale entries (see _prune_cache)."""
+    cache_dir = os.path.dirname(cache_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = cache_path + '.tmp'
+    feather.write_feather(df, tmp_path, compression='uncompressed')
+    os.replace(tmp_path, cache_path)
+    _prune_cache(cache_dir)
+
+
+def read_csv_cached(csv_file, use_cache=True, verbose=False):
+    """
+    Read one CSV with compact dtypes, going through the binary cache when possible.
+
+    Args:
+        csv_file: CSV file path (or a Parquet file, read directly)
+        use_cache: If False (or pyarrow isn't installed), always parse the CSV
+        verbose: If True, print whether the cache was used
+
+    Returns:
+        pd.DataFrame: Parsed data with compact dtypes
+    """
+    if is_parquet(csv_file):  # Already binary and typed; no cache needed
+        return compact_dtypes(pd.read_parquet(csv_file))
+    if not use_cache or feather is None:
+        return compact_dtypes(pd.read_csv(csv_file))
+
+    cache_path = _get_cache_path(csv_file)
+    if os.path.exists(cache_path):
+        if verbose:
+            print(f"    Using cached '{cache_path}'")
+        return feather.read_table(cache_path, memory_map=True).to_pandas(split_blocks=True)
+
+    df = compact_dtypes(pd.read_csv(csv_file))
+    try:
+        _write_cache(df, cache_path)
+    except OSError as e:
+        if verbose:
+            print(f"    Warning: could not write cache '{cache_path}': {e}")
+    return df
+
+
+def describe_source_files(csv_files):
+    """
+    Identify the source CSVs by size and modification time (for model lineage).
+
+    Args:
+        csv_files: List of CSV file paths
+
+    Returns:
+        dict: File name -> {'size': bytes, 'mtime': ISO timestamp}
+    """
+    from datetime import datetime, timezone
+
+    sources = {}
+    for csv_file in csv_files:
+        stat = os.stat(csv_file)
+        sources[os.path.basename(csv_file)] = {
+            'size': stat.st_size,
+            'mtime': datetime.fromtimestamp(stat.st_mtime, timezone.utc).isoformat(timespec='seconds'),
+        }
+    return sources
+
+
+def compute_row_hashes(df):
+    """
+    Stable 64-bit hash per row, independent of column order and of the compact dtypes chosen.
+
+    Used to find rows a model hasn't been trained on yet (new pages, or pages whose data changed).
+
+    Args:
+        df: DataFrame of raw rows
+
+    Returns:
+        np.ndarray: uint64 hash per row
+    """
+    canonical = pd.DataFrame(index=df.index)
+    for col in sorted(df.columns):
+        series = df[col]
+        if pd.api.types.is_numeric_dtype(series.dtype) or pd.api.types.is_bool_dtype(series.dtype):
+            canonical[col] = series.astype('float64')
+        else:
+            canonical[col] = series.astype(object).where(series.notna(), None).astype(str)
+    return pd.util.hash_pandas_object(canonical, index=False).to_numpy()
+
+
+def load_and_concat_csvs(csv_files=None, remove_duplicates=False, verbose=False, use_cache=True):
     """
     Load and concatenate multiple CSV files into a single DataFrame.
     
@@ -16,6 +200,7 @@ def load_and_concat_csvs(csv_files=None, remove_duplicates=False, verbose=False)
         csv_files: List of CSV file paths to load. If None, uses CSV_FILES constant.
         remove_duplicates: If True, remove duplicate URLs based on 'page' column
         verbose: If True, print detailed loading information
+        use_cache: If True, read through the binary cache (see read_csv_cached)
     
     Returns:
         pd.DataFrame: Combined DataFrame from all CSV files
@@ -31,7 +216,7 @@ def load_and_concat_csvs(csv_files=None, remove_duplicates=False, verbose=False)
         try:
             if verbose:
                 print(f"  Loading '{csv_file}'...")
-            temp_df = pd.read_csv(csv_file)
+            temp_df = read_csv_cached(csv_file, use_cache=use_cache, verbose=verbose)
             if verbose:
                 print(f"    Loaded {len(temp_df)} rows")
             dfs.append(temp_df)
@@ -45,6 +230,11 @@ def load_and_concat_csvs(csv_files=None, remove_duplicates=False, verbose=False)
         print(f"\nCombining all datasets...")
     
     df_combined = pd.concat(dfs, ignore_index=True)
+
+    # Categories that differ between files concat to 'object'; make them categorical again
+    for col in df_combined.columns:
+        if df_combined[col].dtype == object and any(isinstance(df[col].dtype, pd.CategoricalDtype) for df in dfs):
+            df_combined[col] = df_combined[col].astype('category')
     
     if verbose:
         print(f"Successfully combined into {len(df_combined)} total rows and {len(df_combined.columns)} columns.")
@@ -64,3 +254,82 @@ def load_and_concat_csvs(csv_files=None, remove_duplicates=False, verbose=False)
     
     return df_combined
 
+
+class UrlHashSet:
+    """
+    Compact set of the URLs seen so far, for deduplicating across streamed chunks.
+
+    URLs are kept as a sorted array of 64-bit hashes (8 bytes each, instead of a Python
+    string per URL). Two different URLs sharing a hash would be treated as duplicates;
+    at a million URLs the odds of that are about 1 in 40 million.
+    """
+
+    def __init__(self):
+        self.hashes = np.empty(0, dtype=np.uint64)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add_unseen(self, urls):
+        """
+        Remember a chunk of URLs and flag the ones not seen before.
+
+        Args:
+            urls: Series of URLs
+
+        Returns:
+            np.ndarray: bool per URL, True for the first occurrence of a new URL
+        """
+        hashes = pd.util.hash_pandas_object(urls, index=False).to_numpy()
+        is_new = ~pd.Series(hashes).duplicated().to_numpy()
+        if len(self.hashes):
+            positions = np.minimum(np.searchsorted(self.hashes, hashes), len(self.hashes) - 1)
+            is_new &= self.hashes[positions] != hashes
+        self.hashes = np.union1d(self.hashes, hashes[is_new])
+        return is_new
+
+
+def iter_csv_batches(csv_files=None, batch_rows=DEFAULT_BATCH_ROWS, remove_duplicates=False, verbose=False):
+    """
+    Stream CSV files as batches with compact dtypes, never holding a whole file in memory.
+
+    Streaming counterpart of load_and_concat_csvs: with remove_duplicates, a URL is kept
+    only the first time it appears across all files (the same rows drop_duplicates keeps).
+    Batches may differ in dtypes (e.g. int8 in one, int16 in the next); object columns are
+    not made categorical.
+
+    Args:
+        csv_files: List of CSV file paths to load. If None, uses CSV_FILES constant.
+        batch_rows: Rows parsed per chunk
+        remove_duplicates: If True, remove duplicate URLs based on 'page' column
+        verbose: If True, print per-file progress and a summary
+
+    Yields:
+        pd.DataFrame: Up to batch_rows rows
+    """
+    if csv_files is None:
+        csv_files = CSV_FILES
+
+    seen_urls = UrlHashSet() if remove_duplicates else None
+    total_rows = 0
+    duplicates_removed = 0
+    for csv_file in csv_files:
+        if verbose:
+            print(f"  Streaming '{csv_file}' in chunks of {batch_rows} rows...")
+        if not os.path.exists(csv_file):
+            print(f"ERROR: Could not find file '{csv_file}'.")
+            sys.exit(1)
+
+        for chunk in iter_file_chunks(csv_file, batch_rows):
+            total_rows += len(chunk)
+            if seen_urls is not None and 'page' in chunk.columns:
+                is_new = seen_urls.add_unseen(chunk['page'])
+                duplicates_removed += int(len(chunk) - is_new.sum())
+                chunk = chunk[is_new]
+            yield compact_dtypes(chunk, categorize=False)
+
+    if verbose:
+        print(f"Streamed {total_rows} rows from {len(csv_files)} files")
+        if seen_urls is not None:
+            print(f"  Removed {duplicates_removed} duplicate URLs "
+                  f"({len(seen_urls)} unique, {seen_urls.hashes.nbytes / 1024:.0f} KB of URL hashes)")
@@ -0,0 +1,292 @@
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from model_config import MANUAL_CATEGORICAL_FEATURES
+from batch_explain import TARGET_COLUMN, explain_chunk
+from telemetry import get_telemetry
+
+# Long-running explanation server used by `aislow.py --mode serve`
+# Keeps the model and benchmarks resident and micro-batches requests:
+# rows that arrive within --max-wait-ms of each other share one SHAP/predict call.
+#
+#   POST /explain   body: one feature row {...}, a list of rows, or {"pages": [...]}
+#   GET  /metrics   Prometheus text format (latency and batch size histograms, time per stage)
+#   GET  /health
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+DEFAULT_MAX_BATCH_SIZE = 256
+DEFAULT_MAX_WAIT_MS = 5.0
+MAX_BODY_BYTES = 64 * 1024 * 1024
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+
+class Histogram:
+    """Cumulative histogram rendered in Prometheus text format."""
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for bound, count in zip(self.buckets, self.counts):
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {count}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{self.name}_sum {self.total}")
+        lines.append(f"{self.name}_count {self.count}")
+        return '\n'.join(lines)
+
+
+def rows_to_frame(rows, feature_order):
+    """
+    Build a raw page DataFrame from JSON rows, aligned to the model's feature order.
+
+    Missing features become NaN (LightGBM treats them as missing values).
+
+    Args:
+        rows: List of dicts, one per page
+        feature_order: Model feature names in training order
+
+    Returns:
+        pd.DataFrame: Rows with 'page', the target (if given) and every feature column
+    """
+    df = pd.DataFrame.from_records(rows)
+    columns = ['page'] + ([TARGET_COLUMN] if TARGET_COLUMN in df.columns else []) + list(feature_order)
+    df = df.reindex(columns=columns)
+    for col in feature_order:
+        if col not in MANUAL_CATEGORICAL_FEATURES:
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+    return df
+
+
+class ExplanationServer:
+    """
+    Asyncio HTTP server with a warm model and a micro-batching queue.
+
+    Args:
+        model: Trained LGBMRegressor
+        percentile_metrics: benchmark percentiles (p10/p25/p50)
+        feature_order: Model feature names in training order
+        max_batch_size: Most rows explained in one SHAP/predict call
+        max_wait_ms: How long the first queued request waits for others to join its batch
+        cache: Optional explanation_cache.ExplanationCache (only used from the model thread)
+        cohorts: Optional cohorts.CohortTables (per-page cohort benchmarks for the what-if)
+    """
+
+    def __init__(self, model, percentile_metrics, feature_order,
+                 max_batch_size=DEFAULT_MAX_BATCH_SIZE, max_wait_ms=DEFAULT_MAX_WAIT_MS, cache=None, cohorts=None):
+        self.model = model
+        self.cache = cache
+        self.cohorts = cohorts
+        self.percentile_metrics = percentile_metrics
+        self.feature_order = feature_order
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        # One model thread: batches run back to back while the event loop keeps accepting requests
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+
+        self.request_latency = Histogram('aislow_request_latency_seconds',
+                                         'End-to-end /explain latency', LATENCY_BUCKETS)
+        self.batch_latency = Histogram('aislow_batch_latency_seconds',
+                                       'SHAP + predict time per micro-batch', LATENCY_BUCKETS)
+        self.batch_size = Histogram('aislow_batch_size_rows',
+                                    'Rows explained per micro-batch', BATCH_SIZE_BUCKETS)
+
+    async def explain(self, rows):
+        """Queue rows for the next micro-batch and wait for their records."""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((rows, future))
+        return await future
+
+    async def _batch_worker(self):
+        """Collect queued requests into micro-batches and explain each with one call."""
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [await self.queue.get()]
+            n_rows = len(pending[0][0])
+            deadline = loop.time() + self.max_wait
+            while n_rows < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                pending.append(item)
+                n_rows += len(item[0])
+
+            all_rows = [row for rows, _ in pending for row in rows]
+            start = time.perf_counter()
+            try:
+                records = await loop.run_in_executor(self.executor, self._explain_rows, all_rows)
+            except Exception as e:
+                if len(pending) == 1:
+                    if not pending[0][1].done():
+                        pending[0][1].set_exception(e)
+                else:
+                    # One bad request must not fail the others: explain each on its own,
+                    # so the error only reaches the request that caused it
+                    await self._explain_separately(pending)
+                continue
+            self.batch_latency.observe(time.perf_counter() - start)
+            self.batch_size.observe(len(all_rows))
+
+            offset = 0
+            for rows, future in pending:
+                if not future.done():
+                    future.set_result(records[offset:offset + len(rows)])
+                offset += len(rows)
+
+    async def _explain_separately(self, pending):
+        """Explain each request of a failed micro-batch on its own and resolve its future."""
+        loop = asyncio.get_running_loop()
+        for rows, future in pending:
+            try:
+                records = await loop.run_in_executor(self.executor, self._explain_rows, rows)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            if not future.done():
+                future.set_result(records)
+
+    def _explain_rows(self, rows):
+        df = rows_to_frame(rows, self.feature_order)
+        return explain_chunk(self.model, df, self.percentile_metrics, cache=self.cache, cohorts=self.cohorts)
+
+    def render_metrics(self):
+        sections = [h.render() for h in (self.request_latency, self.batch_latency, self.batch_size)]
+        # Time per pipeline stage (category conversion, SHAP, predict, what-if) from telemetry.stage()
+        totals = get_telemetry().totals()
+        for metric, key, help_text in (('aislow_stage_seconds_total', 'seconds', 'Time spent per pipeline stage'),
+                                       ('aislow_stage_calls_total', 'calls', 'Runs of each pipeline stage')):
+            lines = [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+            lines += [f'{metric}{{stage="{name}"}} {total[key]}' for name, total in totals.items()]
+            sections.append('\n'.join(lines))
+        return '\n'.join(sections) + '\n'
+
+    async def _handle_request(self, method, path, body):
+        """Route one HTTP request, returning (status, content type, payload bytes)."""
+        if method == 'GET' and path == '/health':
+            return 200, 'application/json', b'{"status": "ok"}'
+        if method == 'GET' and path == '/metrics':
+            return 200, 'text/plain; version=0.0.4', self.render_metrics().encode('utf-8')
+        if path != '/explain':
+            return 404, 'application/json', b'{"error": "not found"}'
+        if method != 'POST':
+            return 405, 'application/json', b'{"error": "use POST"}'
+
+        start = time.perf_counter()
+        try:
+            payload = json.loads(body or b'null')
+        except ValueError:
+            return 400, 'application/json', b'{"error": "body is not valid JSON"}'
+        single = isinstance(payload, dict) and 'pages' not in payload
+        rows = [payload] if single else (payload.get('pages') if isinstance(payload, dict) else payload)
+        if not isinstance(rows, list) or not rows or not all(isinstance(row, dict) for row in rows):
+            return 400, 'application/json', b'{"error": "expected a feature row, a list of rows or {\\"pages\\": [...]}"}'
+
+        try:
+            records = await self.explain(rows)
+        except Exception as e:
+            return 500, 'application/json', json.dumps({'error': str(e)}).encode('utf-8')
+        self.request_latency.observe(time.perf_counter() - start)
+        return 200, 'application/json', json.dumps(records[0] if single else records).encode('utf-8')
+
+    async def _handle_connection(self, reader, writer):
+        """Minimal HTTP/1.1 handling with keep-alive."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, path, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length', 0) or 0)
+                if length > MAX_BODY_BYTES:
+                    status, content_type, payload = 413, 'application/json', b'{"error": "body too large"}'
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length) if length else b''
+                    status, content_type, payload = await self._handle_request(method, path.split('?')[0], body)
+                    connection = headers.get('connection', '').lower()
+                    keep_alive = connection == 'keep-alive' or (version == 'HTTP/1.1' and connection != 'close')
+
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(payload)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + payload
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        """Run the server until cancelled."""
+        self.queue = asyncio.Queue()
+        worker = asyncio.create_task(self._batch_worker())
+        server = await asyncio.start_server(self._handle_connection, host, port)
+        print(f"Serving explanations on http://{host}:{port} "
+              f"(max batch {self.max_batch_size} rows, max wait {self.max_wait * 1000:g} ms)")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            worker.cancel()
+
+
+def run_server(model, percentile_metrics, feature_order, host=DEFAULT_HOST, port=DEFAULT_PORT,
+               max_batch_size=DEFAULT_MAX_BATCH_SIZE, max_wait_ms=DEFAULT_MAX_WAIT_MS, cache=None, cohorts=None):
+    """
+    Start the explanation server and block until interrupted.
+
+    Args:
+        model: Trained LGBMRegressor
+        percentile_metrics: benchmark percentiles (p10/p25/p50)
+        feature_order: Model feature names in training order
+        host: Interface to listen on
+        port: TCP port to listen on
+        max_batch_size: Most rows explained in one SHAP/predict call
+        max_wait_ms: How long the first queued request waits for others to join its batch
+        cache: Optional explanation_cache.ExplanationCache
+        cohorts: Optional cohorts.CohortTables
+    """
+    server = ExplanationServer(model, percentile_metrics, feature_order,
+                               max_batch_size=max_batch_size, max_wait_ms=max_wait_ms, cache=cache, cohorts=cohorts)
+    try:
+        asyncio.run(server.serve(host, port))
+    except KeyboardInterrupt:
+        print("\nServer stopped.")
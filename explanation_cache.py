@@ -0,0 +1,249 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import zlib
+from collections import OrderedDict
+import pandas as pd
+from model_config import WHAT_IF_CATEGORICAL_OPTIONS, PROBLEM_THRESHOLD_MS
+from data_loader import CACHE_DIR_NAME
+from whatif import PRIMARY_LEVEL, WHAT_IF_LEVELS, MAX_CANDIDATE_FEATURES, MAX_PLAN_STEPS, TOP_SCENARIOS
+
+# Content-addressed cache of per-page explanations
+# Key: 128-bit hash of the prepared feature row, namespaced by a digest of everything else the
+# result depends on (model SHA-256, benchmarks, what-if settings). A byte-identical page under
+# the same model skips SHAP, predict and the what-if scenarios entirely.
+#
+# Two tiers: an in-memory LRU (per process) in front of an SQLite file with size-based LRU eviction.
+# Entry: {'shap_values': [...], 'base_value', 'prediction', 'what_if': plan_improvements() result}
+
+# Bump when the entry layout or how entries are computed changes, so old entries stop matching
+CACHE_FORMAT_VERSION = 3  # 2: single-page entries always get a 'what_if', even without problems
+                          # 3: the classic what-if takes the best benchmark level and records it
+DEFAULT_CACHE_FILE = os.path.join(CACHE_DIR_NAME, 'explanations.sqlite')
+DEFAULT_MEMORY_ENTRIES = 10000
+DEFAULT_MAX_DISK_MB = 256
+EVICT_TO_FRACTION = 0.9   # Eviction frees space down to 90% of the limit, so it doesn't run on every put
+SQLITE_BATCH = 500        # Keys per "IN (...)" lookup
+ROW_HASH_KEYS = ('aislow-row-key-1', 'aislow-row-key-2')  # Two 64-bit hashes = 128-bit row key
+
+
+def compute_context_digest(model_sha256, percentile_metrics, cohorts=None, background=None):
+    """
+    Digest of everything besides the feature row that an explanation depends on.
+
+    Args:
+        model_sha256: SHA-256 of the model file
+        percentile_metrics: dict level -> {feature: benchmark value}
+        cohorts: Cohort benchmarks in use, e.g. 'tables digest|rank band' (None = global benchmarks)
+        background: Digest of the interventional SHAP background (None = path-dependent TreeSHAP)
+
+    Returns:
+        str: 16 hex characters, used as the key prefix
+    """
+    context = {
+        'version': CACHE_FORMAT_VERSION,
+        'model_sha256': model_sha256,
+        'percentile_metrics': percentile_metrics,
+        'cohorts': cohorts,
+        'problem_threshold_ms': PROBLEM_THRESHOLD_MS,
+        'what_if': [PRIMARY_LEVEL, WHAT_IF_LEVELS, MAX_CANDIDATE_FEATURES, MAX_PLAN_STEPS, TOP_SCENARIOS],
+        'categorical_options': WHAT_IF_CATEGORICAL_OPTIONS,
+    }
+    if background is not None:  # Only then, so path-dependent entries keep their keys
+        context['background'] = background
+    payload = json.dumps(context, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def _canonical_features(X):
+    """
+    Model-ready features in a dtype-independent form, so the same page hashes the same
+    whether a chunk parsed a column as int, float or category.
+    """
+    canonical = pd.DataFrame(index=X.index)
+    for col in X.columns:
+        series = X[col]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            categories = series.cat.categories
+            if pd.api.types.is_numeric_dtype(categories.dtype) or pd.api.types.is_bool_dtype(categories.dtype):
+                series = series.astype('float64')
+            else:
+                series = series.astype(object).where(series.notna(), None).astype(str)
+        elif pd.api.types.is_numeric_dtype(series.dtype) or pd.api.types.is_bool_dtype(series.dtype):
+            series = series.astype('float64')
+        else:
+            series = series.astype(object).where(series.notna(), None).astype(str)
+        canonical[col] = series
+    return canonical
+
+
+class ExplanationCache:
+    """
+    Two-tier (memory LRU + SQLite) cache of page explanations.
+
+    Args:
+        context: Key prefix from compute_context_digest()
+        path: SQLite file for the disk tier (None = memory only)
+        memory_entries: Most entries kept in the in-memory LRU
+        max_disk_mb: Disk tier size limit; least recently used entries are evicted beyond it
+    """
+
+    def __init__(self, context, path=DEFAULT_CACHE_FILE, memory_entries=DEFAULT_MEMORY_ENTRIES,
+                 max_disk_mb=DEFAULT_MAX_DISK_MB):
+        self.context = context
+        self.path = path
+        self.memory_entries = memory_entries
+        self.max_disk_bytes = int(max_disk_mb * 1024 * 1024)
+        self.memory = OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self._conn = None
+        self._disk_bytes = 0
+
+    def settings(self):
+        """Constructor arguments, so worker processes can open the same cache."""
+        return {'context': self.context, 'path': self.path, 'memory_entries': self.memory_entries,
+                'max_disk_mb': self.max_disk_bytes / (1024 * 1024)}
+
+    def row_keys(self, X):
+        """
+        Cache key of every row of a model-ready feature DataFrame.
+
+        Args:
+            X: Prepared features (batch_explain.prepare_features), columns in model order
+
+        Returns:
+            list: One key string per row
+        """
+        canonical = _canonical_features(X)
+        high, low = (pd.util.hash_pandas_object(canonical, index=False, hash_key=key).to_numpy()
+                     for key in ROW_HASH_KEYS)
+        return [f"{self.context}{h:016x}{l:016x}" for h, l in zip(high, low)]
+
+    # --- Disk tier ---
+    def _connect(self):
+        if self._conn is None and self.path:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=60)
+            self._conn.execute('PRAGMA auto_vacuum = INCREMENTAL')  # Only applies to a new file
+            self._conn.execute('PRAGMA journal_mode = WAL')           # Parallel batch workers share the file
+            self._conn.execute('CREATE TABLE IF NOT EXISTS entries ('
+                               'key TEXT PRIMARY KEY, value BLOB NOT NULL, '
+                               'size INTEGER NOT NULL, last_used REAL NOT NULL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)')
+            self._conn.commit()
+            # The limit may have been lowered since the file was written
+            self._disk_bytes = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+            if self._disk_bytes > self.max_disk_bytes:
+                self._evict()
+        return self._conn
+
+    def _disk_get_many(self, keys):
+        conn = self._connect()
+        if conn is None or not keys:
+            return {}
+        found = {}
+        for start in range(0, len(keys), SQLITE_BATCH):
+            batch = keys[start:start + SQLITE_BATCH]
+            placeholders = ','.join('?' * len(batch))
+            rows = conn.execute(f'SELECT key, value FROM entries WHERE key IN ({placeholders})', batch)
+            found.update((key, json.loads(zlib.decompress(value))) for key, value in rows)
+        if found:
+            now = time.time()
+            conn.executemany('UPDATE entries SET last_used = ? WHERE key = ?', [(now, key) for key in found])
+            conn.commit()
+        return found
+
+    def _disk_put_many(self, items):
+        conn = self._connect()
+        if conn is None or not items:
+            return
+        now = time.time()
+        rows = []
+        for key, entry in items:
+            value = zlib.compress(json.dumps(entry).encode('utf-8'))
+            rows.append((key, value, len(value), now))
+        conn.executemany('INSERT OR REPLACE INTO entries (key, value, size, last_used) VALUES (?, ?, ?, ?)', rows)
+        conn.commit()
+        self._disk_bytes += sum(row[2] for row in rows)  # Over-counts replaced keys; _evict() recounts
+        if self._disk_bytes > self.max_disk_bytes:
+            self._evict()
+
+    def _evict(self):
+        """Delete least recently used entries until the disk tier is back under its limit."""
+        conn = self._conn
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        target = self.max_disk_bytes * EVICT_TO_FRACTION
+        doomed = []
+        for key, size in conn.execute('SELECT key, size FROM entries ORDER BY last_used'):
+            if total <= target:
+                break
+            doomed.append((key,))
+            total -= size
+        conn.executemany('DELETE FROM entries WHERE key = ?', doomed)
+        conn.commit()
+        conn.execute('PRAGMA incremental_vacuum')
+        self.evicted += len(doomed)
+        self._disk_bytes = total
+
+    # --- Public API ---
+    def get_many(self, keys):
+        """
+        Look up many keys, memory first, then disk.
+
+        Returns:
+            list: Entry dict per key, or None for a miss
+        """
+        results = [None] * len(keys)
+        disk_lookup = []
+        for i, key in enumerate(keys):
+            entry = self.memory.get(key)
+            if entry is not None:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                results[i] = entry
+            else:
+                disk_lookup.append(i)
+
+        found = self._disk_get_many(list({keys[i] for i in disk_lookup}))
+        for i in disk_lookup:
+            entry = found.get(keys[i])
+            if entry is not None:
+                self.disk_hits += 1
+                self._remember(keys[i], entry)
+            else:
+                self.misses += 1
+            results[i] = entry
+        return results
+
+    def put_many(self, items):
+        """Store (key, entry) pairs in both tiers."""
+        for key, entry in items:
+            self._remember(key, entry)
+        self._disk_put_many(items)
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def put(self, key, entry):
+        self.put_many([(key, entry)])
+
+    def _remember(self, key, entry):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def stats(self):
+        """Hit/miss counters of this process."""
+        return {'memory_hits': self.memory_hits, 'disk_hits': self.disk_hits,
+                'misses': self.misses, 'evicted': self.evicted}
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
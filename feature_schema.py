@@ -0,0 +1,206 @@
+import numpy as np
+import pandas as pd
+from model_config import MANUAL_CATEGORICAL_FEATURES
+
+# Compiled feature schema shared by training and inference
+# Column order and the category levels of MANUAL_CATEGORICAL_FEATURES are fixed
+# once by train_model.py and pickled with the model (model.schema_). Every raw frame (or raw block of
+# values in feature order) is then encoded against those levels, instead of each frame inferring its
+# own categories with astype('category') (a single test page would otherwise have one level per column).
+#
+# The encoding is the one LightGBM uses internally: float64, categories as their training code
+# (NaN if missing or unseen). Columns are encoded whole, so the cost per batch is fixed by the
+# number of features, not rows.
+
+class FeatureSchema:
+    """
+    Column order, target dtypes and pinned category levels of a model's features.
+
+    Args:
+        columns: Feature names in training order
+        category_levels: dict feature -> category levels (categorical features)
+    """
+
+    def __init__(self, columns, category_levels):
+        self.columns = list(columns)
+        self.category_levels = {col: list(levels) for col, levels in category_levels.items()}
+        self.categorical_columns = [col for col in self.columns if col in self.category_levels]
+        self.category_dtypes = {col: pd.CategoricalDtype(self.category_levels[col])
+                                for col in self.categorical_columns}
+        self._level_index = {col: pd.Index(self.category_levels[col], dtype=object)
+                             for col in self.categorical_columns}
+        # Numeric levels (bool/int/float, the usual case) are looked up by value with a binary
+        # search over one float block of every categorical column: no per-column pandas work
+        self._numeric_levels = all(isinstance(level, (bool, int, float, np.number))
+                                   for col in self.categorical_columns for level in self.category_levels[col])
+        self._level_search = {}
+        if self._numeric_levels:
+            for col in self.categorical_columns:
+                levels = np.asarray(self.category_levels[col], dtype=np.float64)
+                order = np.argsort(levels, kind='stable')
+                self._level_search[col] = (levels[order], order)
+        self._categorical_positions = [self.columns.index(col) for col in self.categorical_columns]
+        self._numeric_columns = [col for col in self.columns if col not in self.category_levels]
+        self._numeric_positions = [self.columns.index(col) for col in self._numeric_columns]
+        # Model-ready dtype of every feature (transform()); to_matrix() holds them all as float64
+        self.dtypes = {col: self.category_dtypes.get(col, np.dtype(np.float64)) for col in self.columns}
+
+    def __getstate__(self):
+        return {'columns': self.columns, 'category_levels': self.category_levels}
+
+    def __setstate__(self, state):
+        self.__init__(state['columns'], state['category_levels'])
+
+    @classmethod
+    def from_frame(cls, X, category_levels=None):
+        """
+        Compile the schema of a training feature frame.
+
+        Args:
+            X: Raw training features (non-feature columns already dropped)
+            category_levels: Optional dict of feature -> levels to keep (incremental training:
+                the init model's category codes must not change, so new levels are appended)
+
+        Returns:
+            FeatureSchema
+        """
+        levels = {}
+        for col in MANUAL_CATEGORICAL_FEATURES:
+            if col not in X.columns:
+                continue
+            if category_levels and col in category_levels:
+                known = list(category_levels[col])
+                observed = pd.unique(X[col].dropna().astype(object))
+                levels[col] = known + [value for value in observed if value not in known]
+            else:
+                levels[col] = pd.Categorical(X[col]).categories.tolist()  # Same levels as astype('category')
+        return cls(X.columns, levels)
+
+    @classmethod
+    def from_model(cls, model):
+        """
+        Schema of a model saved without one: its features and LightGBM's category levels.
+        """
+        categorical_columns = [col for col in model.feature_name_ if col in MANUAL_CATEGORICAL_FEATURES]
+        pandas_categorical = model.booster_.pandas_categorical or []
+        return cls(model.feature_name_, dict(zip(categorical_columns, pandas_categorical)))
+
+    def category_codes(self, col, values):
+        """
+        Training category code of each value of one feature (-1 if missing or unseen).
+
+        Args:
+            col: Categorical feature
+            values: Raw values, or a Categorical/categorical Series (remapped by its categories)
+
+        Returns:
+            np.ndarray: int64 codes
+        """
+        level_index = self._level_index[col]
+        if isinstance(getattr(values, 'dtype', None), pd.CategoricalDtype):
+            categorical = pd.Categorical(values)
+            if categorical.dtype == self.category_dtypes[col]:
+                return categorical.codes.astype(np.int64)
+            # The column's own codes, remapped onto the training levels (-1 stays missing)
+            remap = np.append(level_index.get_indexer(categorical.categories.astype(object)), -1)
+            return remap[categorical.codes]
+        return level_index.get_indexer(pd.Index(np.asarray(values, dtype=object)))
+
+    def _search_codes(self, col, values):
+        """Training category codes of float values of one feature (-1 if missing or unseen)."""
+        sorted_levels, order = self._level_search[col]
+        if not len(sorted_levels):
+            return np.full(len(values), -1)
+        positions = np.minimum(np.searchsorted(sorted_levels, values), len(sorted_levels) - 1)
+        return np.where(sorted_levels[positions] == values, order[positions], -1)
+
+    def to_matrix(self, X):
+        """
+        Encode raw features the way LightGBM sees them: float64, categories as training codes.
+
+        Args:
+            X: DataFrame with every feature (any column order, extra columns ignored; categorical
+               columns may be raw or already converted), or a raw 2-D block in feature order
+
+        Returns:
+            np.ndarray: C-contiguous (n_rows, n_features) float64 matrix (NaN = missing or unseen)
+        """
+        is_frame = isinstance(X, pd.DataFrame)
+        if not is_frame:
+            X = np.asarray(X)
+            if X.ndim == 1:
+                X = X.reshape(1, -1)
+        matrix = np.empty((len(X), len(self.columns)), dtype=np.float64)
+
+        try:
+            numeric = (X[self._numeric_columns].to_numpy(dtype=np.float64, na_value=np.nan) if is_frame
+                       else X[:, self._numeric_positions].astype(np.float64))
+        except (TypeError, ValueError):
+            # Non-numeric values (e.g. strings from JSON rows) become NaN, as in pd.to_numeric
+            numeric = np.column_stack([
+                pd.to_numeric(pd.Series(X[col] if is_frame else X[:, j]), errors='coerce').to_numpy(
+                    dtype=np.float64, na_value=np.nan)
+                for col, j in zip(self._numeric_columns, self._numeric_positions)
+            ]) if self._numeric_columns else np.empty((len(X), 0))
+        matrix[:, self._numeric_positions] = numeric
+
+        categorical = None
+        if self._numeric_levels and self.categorical_columns:
+            try:
+                categorical = (X[self.categorical_columns].to_numpy(dtype=np.float64, na_value=np.nan) if is_frame
+                               else X[:, self._categorical_positions].astype(np.float64))
+            except (TypeError, ValueError):
+                pass  # Non-numeric values: look them up column by column below
+        for k, (col, j) in enumerate(zip(self.categorical_columns, self._categorical_positions)):
+            if categorical is not None:
+                codes = self._search_codes(col, categorical[:, k])
+            else:
+                codes = self.category_codes(col, X[col] if is_frame else X[:, j])
+            matrix[:, j] = np.where(codes >= 0, codes, np.nan)
+        return matrix
+
+    def transform(self, X):
+        """
+        Model-ready feature DataFrame: columns in training order, numeric features as float64
+        and categorical features with their pinned CategoricalDtype.
+
+        Args:
+            X: Raw page rows as a DataFrame (may include 'page' and the target), or a raw
+               2-D block in feature order
+
+        Returns:
+            pd.DataFrame
+        """
+        matrix = self.to_matrix(X)
+        index = X.index if isinstance(X, pd.DataFrame) else None
+        data = {}
+        for j, col in enumerate(self.columns):
+            if col in self.category_dtypes:
+                codes = np.where(np.isnan(matrix[:, j]), -1, matrix[:, j]).astype(np.int64)
+                data[col] = pd.Categorical.from_codes(codes, dtype=self.category_dtypes[col])
+            else:
+                data[col] = matrix[:, j]
+        return pd.DataFrame(data, index=index, copy=False)
+
+    def encode_values(self, col, values):
+        """
+        Encode raw values of one feature (e.g. what-if targets) like to_matrix() does.
+
+        Returns:
+            np.ndarray: float64 values, category codes for categorical features
+        """
+        if col in self.category_levels:
+            codes = self.category_codes(col, list(values))
+            return np.where(codes >= 0, codes, np.nan)
+        return pd.to_numeric(pd.Series(list(values), dtype=object), errors='coerce').to_numpy(dtype=np.float64)
+
+
+def get_schema(model):
+    """
+    Feature schema of a trained model. Models saved before schemas existed get one
+    derived from the booster, kept on the model object for the next call.
+    """
+    schema = getattr(model, 'schema_', None)
+    if schema is None:
+        schema = model.schema_ = FeatureSchema.from_model(model)
+    return schema
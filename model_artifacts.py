@@ -0,0 +1,157 @@
+import hashlib
+import json
+import os
+import numpy as np
+from feature_schema import get_schema
+from batch_explain import TARGET_COLUMN, get_columns_to_drop, compute_percentile_metrics, prepare_features, compute_contributions
+
+# Precomputed sidecar saved next to the model by train_model.py
+# Lets aislow.py start without reparsing the training CSVs.
+# Bump ARTIFACTS_VERSION whenever the layout below changes, so old sidecars are rejected.
+ARTIFACTS_VERSION = 3
+MODEL_FILE_NAME = 'aislow_desktop.pkl'
+
+
+def get_artifacts_path(model_file=MODEL_FILE_NAME):
+    """Sidecar path for a model file, e.g. aislow_desktop.pkl -> aislow_desktop.artifacts.json"""
+    return os.path.splitext(model_file)[0] + '.artifacts.json'
+
+
+def hash_file(path):
+    """
+    Compute the SHA-256 of a file, used to tie the sidecar to one exact model.
+
+    Args:
+        path: File to hash
+
+    Returns:
+        str: Hex digest
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def compute_background_stats(df_background, target_column=TARGET_COLUMN):
+    """Summary statistics of the training data's target shown at the top of the report."""
+    target = df_background[target_column]
+    return {
+        'pages': int(target.notna().sum()),
+        'mean': float(target.mean()),
+        'median': float(target.median()),
+    }
+
+
+def get_category_levels(model):
+    """
+    Category levels each categorical feature was trained with (the model's feature schema).
+
+    Args:
+        model: Trained LGBMRegressor
+
+    Returns:
+        dict: Feature name -> list of category levels
+    """
+    return get_schema(model).category_levels
+
+
+def build_artifacts(model, model_file, df_background, target_column=TARGET_COLUMN):
+    """
+    Precompute everything aislow.py needs from the training data.
+
+    Args:
+        model: Trained LGBMRegressor
+        model_file: Path of the saved model (hashed to tie the sidecar to it)
+        df_background: Training data DataFrame (raw rows with target; 'page' may be missing)
+        target_column: Metric the model predicts (multi_target.py trains models for others)
+
+    Returns:
+        dict: Sidecar contents
+    """
+    X_background = df_background.drop(columns=get_columns_to_drop(df_background))
+    # The expected value doesn't depend on the row explained
+    _, expected_value = compute_contributions(model, prepare_features(df_background.head(1), get_schema(model)))
+
+    return {
+        'version': ARTIFACTS_VERSION,
+        'model_file': os.path.basename(model_file),
+        'model_sha256': hash_file(model_file),
+        'target': target_column,
+        'feature_order': list(X_background.columns),
+        'background_stats': compute_background_stats(df_background, target_column),
+        'percentile_metrics': {level: {col: float(value) for col, value in values.items()}
+                               for level, values in compute_percentile_metrics(X_background).items()},
+        'category_levels': get_category_levels(model),
+        'expected_value': expected_value,
+    }
+
+
+def json_default(value):
+    """Let json.dump(s) handle numpy scalars (e.g. in category levels); shared by the JSON sidecars."""
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def save_artifacts(artifacts, model_file=MODEL_FILE_NAME):
+    """
+    Write the sidecar next to the model.
+
+    Args:
+        artifacts: dict from build_artifacts()
+        model_file: Path of the saved model
+
+    Returns:
+        str: Path of the sidecar file
+    """
+    path = get_artifacts_path(model_file)
+    with open(path, 'w') as f:
+        json.dump(artifacts, f, indent=1, default=json_default)
+    return path
+
+
+def load_artifacts(model_file=MODEL_FILE_NAME, verbose=False):
+    """
+    Load the sidecar for a model, rejecting it if it is missing, outdated or stale.
+
+    Args:
+        model_file: Path of the saved model
+        verbose: If True, print why a sidecar was rejected
+
+    Returns:
+        dict or None: Sidecar contents, or None if it can't be used
+    """
+    path = get_artifacts_path(model_file)
+    try:
+        with open(path) as f:
+            artifacts = json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        if verbose:
+            print(f"  Warning: '{path}' is not valid JSON, ignoring it")
+        return None
+
+    if artifacts.get('version') != ARTIFACTS_VERSION:
+        if verbose:
+            print(f"  Warning: '{path}' has version {artifacts.get('version')}, expected {ARTIFACTS_VERSION}, ignoring it")
+        return None
+    if artifacts.get('model_sha256') != hash_file(model_file):
+        if verbose:
+            print(f"  Warning: '{path}' was built for a different model, ignoring it")
+        return None
+    return artifacts
+
+
+if __name__ == '__main__':
+    # Rebuild the sidecar for the current model without retraining
+    import joblib
+    from data_loader import load_and_concat_csvs
+
+    model = joblib.load(MODEL_FILE_NAME)
+    df = load_and_concat_csvs(remove_duplicates=True)
+    df = df.dropna(subset=[TARGET_COLUMN])
+    path = save_artifacts(build_artifacts(model, MODEL_FILE_NAME, df), MODEL_FILE_NAME)
+    print(f"Saved artifacts to '{path}'")
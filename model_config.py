@@ -34,3 +34,16 @@ MANUAL_CATEGORICAL_FEATURES = [
     'scripts_inline'         # Inline scripts (likely similar range)
 ]
 
+
+# A feature whose SHAP value adds more than this is a "problem" (reported and simulated by the
+# what-if); below it, a "strength". Shared by every report mode and part of the cache key.
+PROBLEM_THRESHOLD_MS = 50
+
+# "Good" values the what-if optimizer tries for categorical features that show up as problems
+# (numeric features are moved to the p10/p25/p50 benchmarks instead)
+WHAT_IF_CATEGORICAL_OPTIONS = {
+    'is_lcp_preloaded': [True],  # Preload the LCP resource
+    'renderBlockingJS': [0],     # Defer/async all render-blocking scripts
+    'renderBlockingCSS': [0],    # Inline critical CSS, load the rest async
+    'uses_cdn': [True],          # Serve from a CDN
+}
@@ -0,0 +1,248 @@
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import lightgbm as lgb
+from sklearn.model_selection import train_test_split
+from tuning import DATASET_PARAMS, EARLY_STOPPING_ROUNDS, SEED
+
+# Multi-target training used by `train_model.py --targets`
+# The feature matrix and the binned lgb.Dataset are built once (the same binary file --tune uses);
+# every target trains on a subset of those rows with its own labels, so binning never repeats.
+# A target's own column can't be a feature of its model (TotalBlockingTime is a SpeedIndex feature):
+# its split gain is zeroed (feature_contri) instead of dropping it, which would need another Dataset.
+#
+# The models are listed in a bundle manifest next to the primary model, which aislow.py --target reads.
+
+MODEL_FILE_NAME = 'aislow_desktop.pkl'
+PRIMARY_TARGET = 'SpeedIndex'   # Trained into MODEL_FILE_NAME itself, with every sidecar
+DEFAULT_TARGETS = ('SpeedIndex', 'LargestContentfulPaint', 'TotalBlockingTime')
+MIN_TARGET_ROWS = 1000          # Targets with fewer measured pages are skipped
+N_ESTIMATORS = 500
+LEARNING_RATE = 0.05
+TEST_SIZE = 0.2
+
+# Per-worker state, set by _init_worker
+_worker_dataset = None
+
+
+def get_bundle_path(model_file=MODEL_FILE_NAME):
+    """Bundle manifest next to the model, e.g. aislow_desktop.pkl -> aislow_desktop.bundle.json"""
+    return os.path.splitext(model_file)[0] + '.bundle.json'
+
+
+def get_target_model_path(target, model_file=MODEL_FILE_NAME):
+    """
+    Model file of one target: the primary target is the model file itself,
+    others get their own, e.g. aislow_desktop.TotalBlockingTime.pkl
+    """
+    if target == PRIMARY_TARGET:
+        return model_file
+    root, extension = os.path.splitext(model_file)
+    return f"{root}.{target}{extension}"
+
+
+def split_rows(labels, test_size=TEST_SIZE):
+    """
+    Train/validation split over the rows that have a value for the target.
+
+    Args:
+        labels: float64 target values for every row of the shared Dataset (NaN = not measured)
+        test_size: Share of the measured rows held out for early stopping and evaluation
+
+    Returns:
+        tuple: (sorted train row indices, sorted validation row indices)
+    """
+    measured = np.flatnonzero(~np.isnan(labels))
+    train_rows, valid_rows = train_test_split(measured, test_size=test_size, random_state=SEED)
+    return np.sort(train_rows), np.sort(valid_rows)
+
+
+def model_params(params=None):
+    """LGBMRegressor arguments of every target model (train_model.train's defaults, plus tuned ones)."""
+    return dict(dict(random_state=SEED, n_estimators=N_ESTIMATORS, learning_rate=LEARNING_RATE, verbosity=-1),
+                **(params or {}))
+
+
+def train_target(dataset, target, labels, params=None, num_threads=0):
+    """
+    Train one target's booster on subsets of the shared Dataset.
+
+    Args:
+        dataset: Constructed lgb.Dataset over every row (its own label is ignored)
+        target: Target column name (zeroed out as a feature if the Dataset has it)
+        labels: float64 target values for every row (NaN = not measured)
+        params: Extra LightGBM params (e.g. the best config from --tune)
+        num_threads: LightGBM threads (0 = OpenMP default)
+
+    Returns:
+        dict: target, booster, train_rows, valid_rows and seconds
+    """
+    start = time.perf_counter()
+    train_rows, valid_rows = split_rows(labels)
+    train_set = dataset.subset(train_rows).construct()
+    train_set.set_label(labels[train_rows])
+    valid_set = dataset.subset(valid_rows).construct()
+    valid_set.set_label(labels[valid_rows])
+
+    feature_names = dataset.get_feature_name()
+    train_params = dict(dict(objective='regression', metric='l2', seed=SEED, learning_rate=LEARNING_RATE,
+                             verbosity=-1, num_threads=num_threads), **(params or {}))
+    if target in feature_names:
+        train_params['feature_contri'] = [0.0 if name == target else 1.0 for name in feature_names]
+
+    booster = lgb.train(train_params, train_set, num_boost_round=N_ESTIMATORS, valid_sets=[valid_set],
+                        callbacks=[lgb.early_stopping(stopping_rounds=EARLY_STOPPING_ROUNDS, verbose=False)])
+    booster.free_dataset()
+    return {'target': target, 'booster': booster, 'train_rows': train_rows, 'valid_rows': valid_rows,
+            'seconds': time.perf_counter() - start}
+
+
+def _init_worker(dataset_path):
+    """Pool initializer: load the binary Dataset once per worker process."""
+    global _worker_dataset
+    _worker_dataset = lgb.Dataset(dataset_path, params=DATASET_PARAMS).construct()
+
+
+def _train_target_in_worker(target, labels, params, num_threads):
+    return train_target(_worker_dataset, target, labels, params, num_threads)
+
+
+def train_targets(dataset, dataset_path, labels, params=None, workers=1, verbose=True):
+    """
+    Train one booster per target, serially or one target per worker process.
+
+    Args:
+        dataset: Constructed lgb.Dataset (used by in-process training)
+        dataset_path: Its binary file (loaded by pool workers)
+        labels: dict of target -> float64 values for every row
+        params: Extra LightGBM params shared by every target
+        workers: Targets trained in parallel (1 = in this process)
+        verbose: If True, print every target as it finishes
+
+    Returns:
+        dict: target -> result of train_target(), in the order of labels
+    """
+    targets = list(labels)
+    workers = max(1, min(workers, len(targets)))
+    num_threads = max(1, (os.cpu_count() or 1) // workers)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(dataset_path,)) as executor:
+            futures = [executor.submit(_train_target_in_worker, target, labels[target], params, num_threads)
+                       for target in targets]
+            results = [future.result() for future in futures]
+    else:
+        results = [train_target(dataset, target, labels[target], params, num_threads) for target in targets]
+
+    if verbose:
+        for result in results:
+            print(f"  {result['target']:<24} {len(result['train_rows']):>6} train rows, "
+                  f"{result['booster'].best_iteration:>3} iters, {result['seconds']:6.2f}s")
+    return {result['target']: result for result in results}
+
+
+class BoosterRegressor:
+    """
+    A booster trained with lgb.train, with the part of the LGBMRegressor interface that
+    aislow.py, the sidecars and tree_predictor use (booster_, predict, score, feature_name_,
+    best_iteration_, feature_importances_). Only public Booster methods are used, so it
+    doesn't depend on LGBMRegressor internals. schema_ and lineage_ are set when it's saved.
+    """
+
+    def __init__(self, booster, params=None):
+        self.booster_ = booster
+        self.params = model_params(params)
+
+    @property
+    def best_iteration_(self):
+        return self.booster_.best_iteration
+
+    @property
+    def feature_name_(self):
+        return self.booster_.feature_name()
+
+    @property
+    def n_features_in_(self):
+        return self.booster_.num_feature()
+
+    @property
+    def feature_importances_(self):
+        return self.booster_.feature_importance(importance_type='split')
+
+    def predict(self, X, **kwargs):
+        """Predictions up to the best iteration, like LGBMRegressor.predict (pred_contrib etc. pass through)."""
+        return self.booster_.predict(X, **kwargs)
+
+    def score(self, X, y):
+        """R-squared of the predictions, like LGBMRegressor.score."""
+        from sklearn.metrics import r2_score
+
+        return r2_score(y, self.predict(X))
+
+
+def to_regressor(booster, pandas_categorical, params=None):
+    """
+    Wrap a booster trained with lgb.train as a model aislow.py and the sidecars can use.
+
+    Args:
+        booster: Trained lgb.Booster
+        pandas_categorical: Category levels of the shared Dataset (lost by its binary file,
+            so boosters trained in workers need them restored)
+        params: Extra params the booster was trained with
+
+    Returns:
+        BoosterRegressor
+    """
+    booster.pandas_categorical = pandas_categorical
+    return BoosterRegressor(booster, params)
+
+
+def load_bundle(model_file=MODEL_FILE_NAME):
+    """
+    Targets of a model's bundle.
+
+    Returns:
+        dict: target -> {'model_file', 'rows', 'r2', 'trained_at'}; only the primary
+              target if no multi-target training has run
+    """
+    try:
+        with open(get_bundle_path(model_file)) as f:
+            targets = json.load(f)['targets']
+    except (FileNotFoundError, ValueError, KeyError):
+        targets = {}
+    targets.setdefault(PRIMARY_TARGET, {'model_file': os.path.basename(model_file)})
+    return targets
+
+
+def save_bundle(entries, model_file=MODEL_FILE_NAME):
+    """
+    Add (or replace) targets in the bundle manifest; targets trained earlier are kept.
+
+    Args:
+        entries: dict of target -> {'model_file', 'rows', 'r2', 'trained_at'}
+        model_file: Primary model file
+
+    Returns:
+        str: Path of the manifest
+    """
+    targets = load_bundle(model_file)
+    targets.update(entries)
+    path = get_bundle_path(model_file)
+    with open(path, 'w') as f:
+        json.dump({'primary': PRIMARY_TARGET, 'targets': targets}, f, indent=1)
+    return path
+
+
+def resolve_target_model(target, model_file=MODEL_FILE_NAME):
+    """
+    Model file that explains a target.
+
+    Returns:
+        str or None: Path of the target's model, None if the bundle doesn't have it
+    """
+    entry = load_bundle(model_file).get(target)
+    if entry is None:
+        return None
+    return os.path.join(os.path.dirname(model_file), entry['model_file'])
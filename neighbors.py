@@ -0,0 +1,261 @@
+import json
+import os
+import time
+import warnings
+import numpy as np
+import pandas as pd
+from data_loader import CSV_FILES
+
+# Nearest-fast-neighbor index: the pages of the fast CSVs most similar to a given page
+# Features are imputed with the training median, signed-log scaled (sizes, timings and counts are
+# heavy-tailed) and standardized. A KD-tree over the top principal components returns candidates,
+# which are re-ranked by the distance over every standardized feature. Queries stay well under a
+# millisecond at 100k+ pages, where a brute-force scan over every page would not.
+#
+# Built by train_model.py next to the model (aislow_desktop.neighbors.npz, tied by SHA-256). Plain arrays
+# only (no pickle): the KD-tree is rebuilt from its projected points on load.
+
+MODEL_FILE_NAME = 'aislow_desktop.pkl'
+TARGET_COLUMN = 'SpeedIndex'
+FAST_CSV_FILES = [csv_file for csv_file in CSV_FILES if csv_file.startswith('fast')]
+FAST_MAX_SPEEDINDEX = 2500  # The fast CSVs were selected at SpeedIndex 500-2500; re-crawls drift above it
+DEFAULT_NEIGHBORS = 3
+INDEX_COMPONENTS = 16   # Principal components the KD-tree is built on (KD-trees degrade in high dimensions)
+CANDIDATE_FACTOR = 10   # KD-tree candidates per neighbor returned, re-ranked on all features
+LEAF_SIZE = 30
+TOP_DELTAS = 5          # Separating features reported per neighbor and for the whole group
+
+
+def get_neighbors_path(model_file=MODEL_FILE_NAME):
+    """Index next to the model, e.g. aislow_desktop.pkl -> aislow_desktop.neighbors.npz"""
+    return os.path.splitext(model_file)[0] + '.neighbors.npz'
+
+
+def _to_values(X, feature_names):
+    """
+    Raw features as a float64 matrix (booleans as 0/1, anything non-numeric as NaN).
+
+    X is a DataFrame, or a 2-D array already in feature order (e.g. aislow's raw_values,
+    which skips the DataFrame column lookup that dominates a single-page query).
+    """
+    if not isinstance(X, pd.DataFrame):
+        X = np.asarray(X)
+        try:
+            return X.astype(np.float64)
+        except (TypeError, ValueError):
+            X = pd.DataFrame(X, columns=feature_names)
+    try:
+        return X[feature_names].to_numpy(dtype=np.float64, na_value=np.nan)
+    except (TypeError, ValueError):
+        return np.column_stack([pd.to_numeric(X[col], errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+                                for col in feature_names])
+
+
+class NeighborIndex:
+    """
+    KD-tree over standardized features of reference pages, with exact re-ranking.
+
+    Args:
+        feature_names: Features used for similarity (the model's features)
+        fill_values: Per-feature value used for missing data (training median)
+        mean, scale: Standardization of the signed-log features
+        components, components_mean: PCA projection the KD-tree is built on
+        tree: sklearn KDTree over the projected reference pages
+        standardized: Standardized features of the reference pages (float32)
+        values: Raw features of the reference pages (float32)
+        pages: Reference page URLs
+        speedindex: Reference SpeedIndex values
+    """
+
+    ARRAY_NAMES = ('fill_values', 'mean', 'scale', 'components', 'components_mean', 'standardized', 'values',
+                   'pages', 'speedindex')
+
+    def __init__(self, feature_names, fill_values, mean, scale, components, components_mean, tree,
+                 standardized, values, pages, speedindex):
+        self.feature_names = list(feature_names)
+        self.fill_values = fill_values
+        self.mean = mean
+        self.scale = scale
+        self.components = components
+        self.components_mean = components_mean
+        self.tree = tree
+        self.standardized = standardized
+        self.values = values
+        self.pages = pages
+        self.speedindex = speedindex
+
+    @classmethod
+    def from_frame(cls, df, feature_names, n_components=INDEX_COMPONENTS):
+        """
+        Build the index over the pages of a raw DataFrame.
+
+        Args:
+            df: Raw page rows (with 'page' and the target)
+            feature_names: Features used for similarity
+            n_components: Principal components the KD-tree is built on
+
+        Returns:
+            NeighborIndex
+        """
+        from sklearn.decomposition import PCA
+        from sklearn.neighbors import KDTree
+
+        values = _to_values(df, feature_names)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)  # All-missing columns get a median of NaN -> 0
+            fill_values = np.nan_to_num(np.nanmedian(values, axis=0))
+        logged = cls._signed_log(np.where(np.isnan(values), fill_values, values))
+        mean = logged.mean(axis=0)
+        scale = logged.std(axis=0)
+        scale[scale == 0] = 1.0  # Constant columns don't separate pages
+        standardized = (logged - mean) / scale
+
+        pca = PCA(n_components=min(n_components, *standardized.shape), random_state=42).fit(standardized)
+        projected = pca.transform(standardized)
+        return cls(feature_names, fill_values, mean, scale, pca.components_, pca.mean_,
+                   KDTree(projected, leaf_size=LEAF_SIZE), standardized.astype(np.float32),
+                   values.astype(np.float32), df['page'].astype(str).to_numpy(dtype=str),
+                   df[TARGET_COLUMN].to_numpy(dtype=np.float64))
+
+    @staticmethod
+    def _signed_log(values):
+        return np.sign(values) * np.log1p(np.abs(values))
+
+    def standardize(self, values):
+        """Raw feature matrix -> standardized features (missing values filled first)."""
+        values = np.where(np.isnan(values), self.fill_values, values)
+        return (self._signed_log(values) - self.mean) / self.scale
+
+    def query(self, X, k=DEFAULT_NEIGHBORS, top_deltas=TOP_DELTAS):
+        """
+        Find the k reference pages most similar to each page.
+
+        Args:
+            X: Raw page rows as a DataFrame (any columns; the index's features are used),
+               or a 2-D array of raw values in feature order
+            k: Neighbors per page
+            top_deltas: Separating features reported per neighbor and per page
+
+        Returns:
+            list: Per page, a dict with 'neighbors' (nearest first: page, speedindex, distance and
+                  'deltas') and 'deltas' (features separating the page from the neighbors' median)
+        """
+        values = _to_values(X, self.feature_names)
+        standardized = self.standardize(values)
+        projected = (standardized - self.components_mean) @ self.components.T
+        n_candidates = min(len(self.pages), k * CANDIDATE_FACTOR)
+        _, candidates = self.tree.query(projected, k=n_candidates)
+
+        results = []
+        for i in range(len(values)):
+            # Exact distance over every standardized feature, on the few candidates only
+            differences = self.standardized[candidates[i]] - standardized[i]
+            distances = np.sqrt(np.einsum('ij,ij->i', differences, differences))
+            nearest = np.argsort(distances, kind='stable')[:k]
+            neighbor_rows = candidates[i][nearest]
+
+            neighbors = [{
+                'page': str(self.pages[r]),
+                'speedindex': float(self.speedindex[r]),
+                'distance': float(distances[n]),
+                'deltas': self._deltas(values[i], self.values[r], differences[n], top_deltas),
+            } for n, r in zip(nearest, neighbor_rows)]
+
+            group_differences = np.median(self.standardized[neighbor_rows], axis=0) - standardized[i]
+            group_values = np.median(self.values[neighbor_rows], axis=0)
+            results.append({'neighbors': neighbors,
+                            'deltas': self._deltas(values[i], group_values, group_differences, top_deltas)})
+        return results
+
+    def _deltas(self, page_values, neighbor_values, differences, top_deltas):
+        """Features with the largest standardized difference, biggest first."""
+        order = np.argsort(-np.abs(differences), kind='stable')[:top_deltas]
+        return [{
+            'feature': self.feature_names[j],
+            'value': None if np.isnan(page_values[j]) else float(page_values[j]),
+            'neighbor_value': None if np.isnan(neighbor_values[j]) else float(neighbor_values[j]),
+            'standardized_difference': float(differences[j]),
+        } for j in order if differences[j] != 0]
+
+    def save(self, path, model_sha256=None):
+        """Write the index to a compressed .npz file (the KD-tree as its points), tagged with the model's hash."""
+        meta = {'feature_names': self.feature_names, 'model_sha256': model_sha256}
+        np.savez_compressed(path, meta=np.array(json.dumps(meta)), projected=self.tree.get_arrays()[0],
+                            **{name: getattr(self, name) for name in self.ARRAY_NAMES})
+        return path
+
+    @classmethod
+    def load(cls, path, model_sha256=None):
+        """
+        Load a saved index, rejecting it if it was built for a different model.
+
+        Returns:
+            NeighborIndex or None
+        """
+        from sklearn.neighbors import KDTree
+
+        try:
+            with np.load(path) as data:
+                meta = json.loads(str(data['meta']))
+                arrays = {name: data[name] for name in cls.ARRAY_NAMES}
+                projected = data['projected']
+        except (FileNotFoundError, KeyError, ValueError):
+            return None
+        if model_sha256 is not None and meta.get('model_sha256') != model_sha256:
+            return None
+        # Same points and leaf size as at build time, so the same tree
+        return cls(meta['feature_names'], tree=KDTree(projected, leaf_size=LEAF_SIZE), **arrays)
+
+
+def build_neighbor_index(model, model_file=MODEL_FILE_NAME, csv_files=None):
+    """
+    Build the index over the fast CSVs' pages (SpeedIndex up to FAST_MAX_SPEEDINDEX)
+    and save it next to the model file.
+
+    Args:
+        model: Trained LGBMRegressor (its features are used for similarity)
+        model_file: Path of the saved model (hashed to tie the index to it)
+        csv_files: Reference CSVs (default: FAST_CSV_FILES)
+
+    Returns:
+        str: Path of the saved index
+    """
+    from data_loader import load_and_concat_csvs
+    from model_artifacts import hash_file
+
+    df = load_and_concat_csvs(csv_files or FAST_CSV_FILES, remove_duplicates=True)
+    df = df[df[TARGET_COLUMN] <= FAST_MAX_SPEEDINDEX]
+    index = NeighborIndex.from_frame(df, model.feature_name_)
+    return index.save(get_neighbors_path(model_file), hash_file(model_file))
+
+
+def load_neighbor_index(model_file=MODEL_FILE_NAME):
+    """
+    Load the neighbor index of a model file.
+
+    Returns:
+        NeighborIndex or None: None if there is no index or it belongs to another model
+    """
+    from model_artifacts import hash_file
+    return NeighborIndex.load(get_neighbors_path(model_file), hash_file(model_file))
+
+
+if __name__ == '__main__':
+    # Build the index for the current model and time single-page queries
+    import joblib
+    from data_loader import load_and_concat_csvs
+
+    model = joblib.load(MODEL_FILE_NAME)
+    path = build_neighbor_index(model, MODEL_FILE_NAME)
+    index = load_neighbor_index(MODEL_FILE_NAME)
+    print(f"Saved an index over {len(index.pages)} fast pages to '{path}'")
+
+    df = load_and_concat_csvs(remove_duplicates=True).sample(200, random_state=42)
+    raw_values = df[index.feature_names].to_numpy(dtype=object)
+    timings = []
+    for i in range(len(df)):
+        start = time.perf_counter()
+        index.query(raw_values[i:i + 1])
+        timings.append(time.perf_counter() - start)
+    print(f"Single-page query: median {np.median(timings) * 1000:.3f} ms, "
+          f"p99 {np.percentile(timings, 99) * 1000:.3f} ms over {len(df)} pages")
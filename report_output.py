@@ -0,0 +1,223 @@
+import heapq
+import json
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+# Output stage for `aislow.py --mode batch`
+# Records are streamed to JSON Lines or Parquet (by extension) in bounded buffers, and
+# SHAP waterfall PNGs are rendered by a separate process pool fed through a bounded
+# queue, so explaining pages never waits on json/pyarrow writes or matplotlib.
+# Only selected pages are plotted: the first --plot-limit pages, or the --plot-top
+# pages with the slowest predicted SpeedIndex (kept in a heap while streaming).
+
+DEFAULT_BUFFER_RECORDS = 1000  # Records held before they are written (one Parquet row group)
+DEFAULT_PLOT_WORKERS = 1
+MAX_PENDING_PLOTS_PER_WORKER = 4  # Queue depth before the explanation loop waits for a plot
+MAX_DISPLAY = 15  # Features shown in a waterfall
+FLOAT_FIELDS = ('actual_speedindex', 'predicted_speedindex', 'base_value')
+
+
+def get_plot_filename(page_url, directory=''):
+    """Waterfall PNG path for a page, e.g. shap_waterfall_example.com_shop.png"""
+    page_slug = str(page_url).replace('https://', '').replace('http://', '').replace('/', '_').replace('?', '_').replace('&', '_')[:100]
+    return os.path.join(directory, f"shap_waterfall_{page_slug}.png")
+
+
+def render_waterfall(values, base_value, data, feature_names, output_filename):
+    """
+    Save the SHAP waterfall plot of one page.
+
+    Args:
+        values: SHAP value per feature
+        base_value: Expected model output E[f(x)]
+        data: Feature values shown next to the names
+        feature_names: Model feature names
+        output_filename: PNG path
+
+    Returns:
+        str: output_filename
+    """
+    import matplotlib
+    matplotlib.use('Agg')  # Headless, file-only rendering
+    import matplotlib.pyplot as plt
+    import shap
+
+    explanation = shap.Explanation(values=values, base_values=base_value, data=data, feature_names=feature_names)
+    plt.figure(figsize=(10, 8))
+    shap.plots.waterfall(explanation, max_display=MAX_DISPLAY, show=False)
+    plt.tight_layout()
+    plt.savefig(output_filename, dpi=150, bbox_inches='tight')
+    plt.close()
+    return output_filename
+
+
+class RecordWriter:
+    """
+    Streams explanation records to a JSON Lines or Parquet file (by extension).
+
+    At most buffer_records records are held in memory. Parquet keeps the number fields
+    as float64 columns and stores every other field as a string: nested fields (problems,
+    what-if, plan, scenarios) as JSON, so all row groups share one schema.
+    """
+
+    def __init__(self, path, buffer_records=DEFAULT_BUFFER_RECORDS):
+        self.path = path
+        self.parquet = path.lower().endswith('.parquet')
+        self.buffer_records = buffer_records
+        self.records = 0  # Records written or buffered
+        self._buffer = []
+        self._file = None if self.parquet else open(path, 'w')
+        self._writer = None
+        self._schema = None
+
+    def write(self, records):
+        """Add records, writing them out whenever the buffer is full."""
+        for record in records:
+            self._buffer.append(record)
+            self.records += 1
+            if len(self._buffer) >= self.buffer_records:
+                self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        if self.parquet:
+            self._write_parquet(self._buffer)
+        else:
+            self._file.write(''.join(json.dumps(record) + '\n' for record in self._buffer))
+        self._buffer = []
+
+    def _write_parquet(self, records):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self._schema is None:
+            self._schema = pa.schema([(name, pa.float64() if name in FLOAT_FIELDS else pa.string())
+                                      for name in records[0]])
+            self._writer = pq.ParquetWriter(self.path, self._schema)
+        columns = {}
+        for field in self._schema:
+            values = [record.get(field.name) for record in records]
+            if field.name not in FLOAT_FIELDS:
+                values = [value if value is None or isinstance(value, str) else json.dumps(value)
+                          for value in values]
+            columns[field.name] = values
+        self._writer.write_table(pa.Table.from_pydict(columns, schema=self._schema))
+
+    def close(self):
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+        elif self._writer is not None:
+            self._writer.close()
+        else:  # No records: still write a valid, empty file
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            pq.write_table(pa.table({}), self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _init_plot_worker():
+    """Import matplotlib and shap once per plot worker."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot  # noqa: F401
+    import shap  # noqa: F401
+
+
+class WaterfallRenderer:
+    """
+    Renders waterfall PNGs in a process pool, fed through a bounded queue.
+
+    submit() only waits when MAX_PENDING_PLOTS_PER_WORKER plots per worker are queued,
+    so the caller keeps explaining pages while plots render.
+    """
+
+    def __init__(self, feature_names, directory='', workers=DEFAULT_PLOT_WORKERS):
+        self.feature_names = list(feature_names)
+        self.directory = directory
+        self.max_pending = max(1, workers) * MAX_PENDING_PLOTS_PER_WORKER
+        self._executor = ProcessPoolExecutor(max_workers=max(1, workers), initializer=_init_plot_worker)
+        self._pending = deque()
+        self.plots = []
+
+    def submit(self, page_url, values, base_value, data):
+        """Queue the waterfall of one page (see render_waterfall)."""
+        if len(self._pending) >= self.max_pending:
+            self._collect(self._pending.popleft())
+        output_filename = get_plot_filename(page_url, self.directory)
+        future = self._executor.submit(render_waterfall, values, base_value, data, self.feature_names,
+                                       output_filename)
+        self._pending.append((page_url, future))
+
+    def _collect(self, item):
+        page_url, future = item
+        self.plots.append({'page': page_url, 'plot': future.result()})
+
+    def close(self):
+        """
+        Wait for every queued plot.
+
+        Returns:
+            list: {'page', 'plot'} per rendered waterfall, in submission order
+        """
+        while self._pending:
+            self._collect(self._pending.popleft())
+        self._executor.shutdown()
+        return self.plots
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if exc_info[0] is not None:
+            self._executor.shutdown(cancel_futures=True)
+        else:
+            self.close()
+
+
+class PlotSelection:
+    """
+    Picks the pages of a streamed batch that get a waterfall.
+
+    With limit, the first `limit` pages are plotted as they arrive. With top, the `top`
+    pages with the slowest predicted SpeedIndex are kept in a min-heap and plotted at the end.
+    """
+
+    def __init__(self, renderer, limit=0, top=0):
+        self.renderer = renderer
+        self.limit = limit
+        self.top = top
+        self.seen = 0
+        self._heap = []
+
+    def add(self, records, waterfalls):
+        """Consider a chunk of pages: records from explain_chunk() and their (values, base_value, data)."""
+        for record, (values, base_value, data) in zip(records, waterfalls):
+            page_url = record['page'] if record['page'] is not None else f"row{self.seen}"
+            if self.top:
+                item = (record['predicted_speedindex'], -self.seen, page_url, values, base_value, data)
+                if len(self._heap) < self.top:
+                    heapq.heappush(self._heap, item)
+                elif item[:2] > self._heap[0][:2]:
+                    heapq.heapreplace(self._heap, item)
+            elif self.seen < self.limit:
+                self.renderer.submit(page_url, values, base_value, data)
+            self.seen += 1
+
+    def wanted(self):
+        """True while new pages can still be plotted."""
+        return bool(self.top) or self.seen < self.limit
+
+    def finish(self):
+        """Queue the slowest pages (top mode), slowest first."""
+        for _, _, page_url, values, base_value, data in sorted(self._heap, key=lambda item: item[:2], reverse=True):
+            self.renderer.submit(page_url, values, base_value, data)
+        self._heap = []
@@ -0,0 +1,461 @@
+import argparse
+import json
+import math
+import os
+import sys
+import time
+import warnings
+import numpy as np
+from feature_schema import get_schema
+
+# Summarized background set for interventional SHAP
+# Path-dependent TreeSHAP (LightGBM's pred_contrib, the default everywhere) explains a page against
+# the training distribution as the trees recorded it. Interventional SHAP explains it against real
+# background pages instead: a feature outside the coalition takes the background page's value, so
+# the cost and memory grow with the background. This module summarizes the ~23k training pages
+# into a small weighted set and computes interventional SHAP against it:
+#   kmeans      k-means clusters of the pages, each represented by the page closest to its centroid
+#               (a real page, so categorical codes stay valid) and weighted by the cluster's share
+#               of the pages. Pages are clustered on their signed-log, standardized features scaled
+#               by the features' share of the model's split gain (unused features don't split
+#               clusters), plus their standardized prediction, so each representative predicts
+#               close to its cluster's mean and the expected value isn't biased
+#   stratified  pages sampled equally from every source CSV, weighted by rows / sampled rows
+#
+# shap.TreeExplainer's interventional mode treats LightGBM's categorical splits as numeric
+# thresholds (its additivity check fails on this model), so the values are computed here on the
+# exported flat trees (tree_predictor). For a page x and a background page z, a leaf is reachable
+# by the hybrid of both iff every split on its path goes x's or z's way; features where only x's
+# (only z's) way leads there form the set A (B), and the leaf value v is shared as
+# v * (|A|-1)! |B|! / (|A|+|B|)! per feature of A and -v * |A|! (|B|-1)! / (|A|+|B|)! per feature of
+# B. Every (background page, tree) pair is walked at once, branching only where x and z disagree.
+# SHAP values add up to f(x) - sum_k w_k f(z_k) exactly.
+#
+# Saved by train_model.py next to the model (aislow_desktop.background.npz, tied by SHA-256),
+# together with a few reference pages explained against the full background, so the error of any
+# background size can be reported without touching the full background again.
+
+MODEL_FILE_NAME = 'aislow_desktop.pkl'
+TARGET_COLUMN = 'SpeedIndex'
+BACKGROUND_VERSION = 1
+BACKGROUND_METHODS = ('kmeans', 'stratified')
+DEFAULT_METHOD = 'kmeans'
+DEFAULT_SIZE = 100          # Background pages kept
+CHECK_PAGES = 6             # Reference pages explained against the full background (a few seconds each)
+BLOCK_ROWS = 2048           # Background pages walked per step (bounds memory with a large background)
+TRADE_OFF_SIZES = (25, 50, 100, 200, 400)  # Sizes compared by `python shap_background.py`
+PREDICTION_WEIGHT = 0.5     # Weight of the standardized prediction in the k-means space
+SEED = 42
+
+
+def get_background_path(model_file=MODEL_FILE_NAME):
+    """Background next to the model, e.g. aislow_desktop.pkl -> aislow_desktop.background.npz"""
+    return os.path.splitext(model_file)[0] + '.background.npz'
+
+
+class InterventionalExplainer:
+    """
+    Interventional TreeSHAP of a flat tree ensemble against a weighted background.
+
+    Args:
+        flat_model: tree_predictor.FlatTreeEnsemble of the model
+        rows: Encoded background pages (FeatureSchema.to_matrix)
+        weights: Weight per background page (normalized to sum to 1)
+        block_rows: Background pages walked together
+    """
+
+    def __init__(self, flat_model, rows, weights=None, block_rows=BLOCK_ROWS):
+        self.flat = flat_model
+        self.rows = np.ascontiguousarray(rows, dtype=np.float64)
+        weights = np.ones(len(self.rows)) if weights is None else np.asarray(weights, dtype=np.float64)
+        self.weights = weights / weights.sum()
+        self.block_rows = block_rows
+        self.n_features = len(flat_model.feature_names)
+        self.n_words = (self.n_features + 63) // 64
+        self._nodes = np.arange(len(flat_model.split_feature))
+        self._word = (flat_model.split_feature >> 6).astype(np.int64)
+        self._bit = np.left_shift(np.uint64(1), (flat_model.split_feature & 63).astype(np.uint64))
+        # Shapley weights by (|A|, |B|); |A| + |B| is at most the number of splits on a path
+        depth = self._max_depth()
+        self._coef_a = np.zeros((depth + 1, depth + 1))
+        self._coef_b = np.zeros((depth + 1, depth + 1))
+        for a in range(depth + 1):
+            for b in range(depth + 1):
+                if a:
+                    self._coef_a[a, b] = math.factorial(a - 1) * math.factorial(b) / math.factorial(a + b)
+                if b:
+                    self._coef_b[a, b] = math.factorial(a) * math.factorial(b - 1) / math.factorial(a + b)
+        self.expected_value = float(self.weights @ flat_model.predict(self.rows))
+
+    def _max_depth(self):
+        """Longest root-to-leaf path of any tree."""
+        depth, pointers = 0, self.flat.roots[self.flat.roots >= 0]
+        while len(pointers):
+            depth += 1
+            pointers = self.flat.children[np.concatenate([2 * pointers, 2 * pointers + 1])]
+            pointers = pointers[pointers >= 0]
+        return depth
+
+    def _go_left(self, matrix):
+        """Split decision of every node for every row: (rows, nodes) booleans."""
+        n_nodes = len(self._nodes)
+        values = matrix[:, self.flat.split_feature].ravel()
+        return self.flat._go_left(np.tile(self._nodes, len(matrix)), values).reshape(len(matrix), n_nodes)
+
+    def _walk(self, x_left, z_left, weights):
+        """
+        SHAP values of one page against a block of background pages.
+
+        Args:
+            x_left: The page's split decisions (nodes,)
+            z_left: The background pages' split decisions (pages, nodes)
+            weights: The background pages' weights
+
+        Returns:
+            np.ndarray: (features,) weighted SHAP values
+        """
+        flat = self.flat
+        n_trees = len(flat.roots)
+        pair = np.repeat(np.arange(len(z_left)), n_trees)
+        pointer = np.tile(flat.roots, len(z_left))
+        mask_a = np.zeros((len(pointer), self.n_words), dtype=np.uint64)
+        mask_b = np.zeros_like(mask_a)
+        done_a, done_b, done_values = [], [], []
+        while len(pointer):
+            at_leaf = pointer < 0
+            if at_leaf.any():
+                # Leaves reached without a disagreement contribute to no feature
+                counted = at_leaf & (mask_a.any(axis=1) | mask_b.any(axis=1))
+                done_a.append(mask_a[counted])
+                done_b.append(mask_b[counted])
+                done_values.append(weights[pair[counted]] * flat.leaf_value[~pointer[counted]])
+                walking = ~at_leaf
+                pointer, pair, mask_a, mask_b = pointer[walking], pair[walking], mask_a[walking], mask_b[walking]
+                if not len(pointer):
+                    break
+            states = np.arange(len(pointer))
+            word, bit = self._word[pointer], self._bit[pointer]
+            x_goes_left = x_left[pointer]
+            z_goes_left = z_left[pair, pointer]
+            in_a = (mask_a[states, word] & bit) != 0
+            in_b = (mask_b[states, word] & bit) != 0
+            agree = x_goes_left == z_goes_left
+            # A feature already taken from z (from x) keeps following z (x) further down the path
+            follow = np.where(in_b, z_goes_left, x_goes_left)
+            branch = np.flatnonzero(~agree & ~in_a & ~in_b)
+            next_pointer = flat.children[2 * pointer + ~follow]
+            if len(branch):
+                # The state follows x with the feature added to A; a copy follows z with it in B
+                branch_word, branch_bit = word[branch], bit[branch]
+                z_pointer = flat.children[2 * pointer[branch] + ~z_goes_left[branch]]
+                z_mask_a = mask_a[branch]
+                z_mask_b = mask_b[branch]
+                z_mask_b[np.arange(len(branch)), branch_word] |= branch_bit
+                mask_a[branch, branch_word] |= branch_bit
+                pointer = np.concatenate([next_pointer, z_pointer])
+                pair = np.concatenate([pair, pair[branch]])
+                mask_a = np.concatenate([mask_a, z_mask_a])
+                mask_b = np.concatenate([mask_b, z_mask_b])
+            else:
+                pointer = next_pointer
+
+        shap_values = np.zeros(self.n_features)
+        mask_a, mask_b = np.concatenate(done_a), np.concatenate(done_b)
+        if not len(mask_a):
+            return shap_values
+        values = np.concatenate(done_values)
+        size_a = np.bitwise_count(mask_a).sum(axis=1)
+        size_b = np.bitwise_count(mask_b).sum(axis=1)
+        for masks, share in ((mask_a, values * self._coef_a[size_a, size_b]),
+                             (mask_b, -values * self._coef_b[size_a, size_b])):
+            for word in range(self.n_words):
+                self._add_by_bit(shap_values, masks[:, word], share, 64 * word)
+        return shap_values
+
+    def _add_by_bit(self, shap_values, masks, share, first_feature):
+        """Add each state's share to every feature whose bit is set, lowest bit first."""
+        present = masks != 0
+        masks, share = masks[present], share[present]
+        while len(masks):
+            lowest = masks & (~masks + np.uint64(1))
+            features = first_feature + np.log2(lowest.astype(np.float64)).astype(np.int64)
+            shap_values += np.bincount(features, weights=share, minlength=self.n_features)
+            masks ^= lowest
+            present = masks != 0
+            masks, share = masks[present], share[present]
+
+    def shap_values(self, X):
+        """
+        Interventional SHAP values of pages.
+
+        Args:
+            X: Model-ready DataFrame, or an encoded matrix (FeatureSchema.to_matrix)
+
+        Returns:
+            tuple: (SHAP values of shape (rows, features), expected value over the background)
+        """
+        matrix = self.flat.to_matrix(X)
+        x_left = self._go_left(matrix)
+        shap_values = np.zeros((len(matrix), self.n_features))
+        for start in range(0, len(self.rows), self.block_rows):
+            block = slice(start, start + self.block_rows)
+            z_left = self._go_left(self.rows[block])
+            for i in range(len(matrix)):
+                shap_values[i] += self._walk(x_left[i], z_left, self.weights[block])
+        return shap_values, self.expected_value
+
+
+def _clustering_space(model, df, matrix):
+    """
+    Pages as points for k-means: signed-log, standardized raw features (missing values at the
+    median) scaled by their share of the split gain, plus the standardized prediction.
+    """
+    from shap_summary import numeric_values
+
+    columns = get_schema(model).columns
+    values = numeric_values(df.reindex(columns=columns), columns)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # All-missing columns get a median of NaN -> 0
+        medians = np.nan_to_num(np.nanmedian(values, axis=0))
+    values = np.where(np.isnan(values), medians, values)
+    logged = np.sign(values) * np.log1p(np.abs(values))
+    scale = logged.std(axis=0)
+    scale[scale == 0] = 1.0
+    gain = model.booster_.feature_importance(importance_type='gain')
+    prediction = model.booster_.predict(matrix)
+    return np.column_stack([(logged - logged.mean(axis=0)) / scale * (gain / gain.sum()),
+                            PREDICTION_WEIGHT * (prediction - prediction.mean()) / max(prediction.std(), 1e-12)])
+
+
+def summarize_background(model, df, method=DEFAULT_METHOD, size=DEFAULT_SIZE, csv_files=None,
+                         target_column=TARGET_COLUMN):
+    """
+    Summarize the training pages into a small weighted background.
+
+    Args:
+        model: Trained LGBMRegressor
+        df: All training data (raw rows), the population the background stands for
+        method: 'kmeans' (cluster representatives) or 'stratified' (equal samples per source CSV)
+        size: Background pages to keep
+        csv_files: Source CSVs for 'stratified' (default: CSV_FILES)
+        target_column: Metric the model predicts
+
+    Returns:
+        tuple: (encoded background pages, weights summing to 1)
+    """
+    schema = get_schema(model)
+    if method == 'stratified':
+        from shap_summary import stratified_sample
+
+        sample, weights, _ = stratified_sample(csv_files, target_column, size)
+        return schema.to_matrix(sample), weights / weights.sum()
+    if method != 'kmeans':
+        raise ValueError(f"Unknown background method '{method}' (use one of: {', '.join(BACKGROUND_METHODS)})")
+
+    from sklearn.cluster import KMeans
+
+    matrix = schema.to_matrix(df)
+    points = _clustering_space(model, df, matrix)
+    size = min(size, len(df))
+    kmeans = KMeans(n_clusters=size, n_init=1, random_state=SEED).fit(points)
+    labels = kmeans.labels_
+    representatives = np.empty(size, dtype=np.int64)
+    for k in range(size):
+        members = np.flatnonzero(labels == k)
+        distances = ((points[members] - kmeans.cluster_centers_[k]) ** 2).sum(axis=1)
+        representatives[k] = members[np.argmin(distances)]
+    weights = np.bincount(labels, minlength=size).astype(np.float64)
+    return matrix[representatives], weights / weights.sum()
+
+
+def approximation_error(explainer, check_rows, check_shap, full_expected_value):
+    """
+    How far a background's SHAP values are from the full background's, on the reference pages.
+
+    Returns:
+        dict: mean/max absolute error per SHAP value (ms), error relative to sum |SHAP|, and the
+              difference of the expected values (ms)
+    """
+    shap_values, expected_value = explainer.shap_values(check_rows)
+    errors = np.abs(shap_values - check_shap)
+    return {
+        'mean_abs_error_ms': float(errors.mean()),
+        'max_abs_error_ms': float(errors.max()),
+        'relative_error': float(errors.sum() / max(np.abs(check_shap).sum(), 1e-12)),
+        'expected_value_error_ms': float(expected_value - full_expected_value),
+    }
+
+
+def build_background(model, model_file, df, flat_model=None, method=DEFAULT_METHOD, size=DEFAULT_SIZE,
+                     csv_files=None, target_column=TARGET_COLUMN, check_pages=CHECK_PAGES):
+    """
+    Summarize the background and measure its error against the full background.
+
+    The reference pages are sampled equally from the source CSVs and explained against every
+    training page once; their SHAP values are saved, so later sizes are checked against them.
+
+    Args:
+        model: Trained LGBMRegressor
+        model_file: Path of the saved model (hashed to tie the background to it)
+        df: All training data (raw rows)
+        flat_model: Optional FlatTreeEnsemble of the model (flattened here if not given)
+        method, size: See summarize_background()
+        csv_files: Source CSVs (default: CSV_FILES)
+        target_column: Metric the model predicts
+        check_pages: Reference pages for the approximation error
+
+    Returns:
+        dict: Background contents (see save_background)
+    """
+    from model_artifacts import hash_file
+    from shap_summary import stratified_sample
+    from tree_predictor import FlatTreeEnsemble
+
+    flat_model = flat_model or FlatTreeEnsemble.from_model(model)
+    schema = get_schema(model)
+    started = time.perf_counter()
+    check_rows = schema.to_matrix(stratified_sample(csv_files, target_column, check_pages)[0])
+    full = InterventionalExplainer(flat_model, schema.to_matrix(df))
+    check_shap, full_expected_value = full.shap_values(check_rows)
+    reference_seconds = time.perf_counter() - started
+
+    rows, weights = summarize_background(model, df, method, size, csv_files, target_column)
+    explainer = InterventionalExplainer(flat_model, rows, weights)
+    return {
+        'version': BACKGROUND_VERSION,
+        'model_sha256': hash_file(model_file),
+        'method': method,
+        'rows': rows,
+        'weights': weights,
+        'full_pages': len(df),
+        'full_expected_value': full_expected_value,
+        'check_rows': check_rows,
+        'check_shap': check_shap,
+        'reference_seconds': reference_seconds,
+        'error': approximation_error(explainer, check_rows, check_shap, full_expected_value),
+    }
+
+
+ARRAY_NAMES = ('rows', 'weights', 'check_rows', 'check_shap')
+
+
+def save_background(background, model_file=MODEL_FILE_NAME):
+    """Write the background next to the model. Returns its path."""
+    path = get_background_path(model_file)
+    meta = {name: value for name, value in background.items() if name not in ARRAY_NAMES}
+    np.savez(path, meta=np.array(json.dumps(meta)), **{name: background[name] for name in ARRAY_NAMES})
+    return path
+
+
+def load_background(model_file=MODEL_FILE_NAME):
+    """
+    Load the background of a model file.
+
+    Returns:
+        dict or None: None if there is no background, or it is outdated or belongs to another model
+    """
+    from model_artifacts import hash_file
+
+    try:
+        with np.load(get_background_path(model_file)) as data:
+            background = json.loads(str(data['meta']))
+            background.update({name: data[name] for name in ARRAY_NAMES})
+    except (FileNotFoundError, KeyError, ValueError):
+        return None
+    if background.get('version') != BACKGROUND_VERSION or background.get('model_sha256') != hash_file(model_file):
+        return None
+    return background
+
+
+def resize_background(model, background, df, flat_model, size, method=None, csv_files=None,
+                      target_column=TARGET_COLUMN):
+    """
+    A background of another size (or method), checked against the saved reference pages.
+
+    Returns:
+        dict: Same contents as build_background(), with the new rows, weights and error
+    """
+    method = method or background['method']
+    rows, weights = summarize_background(model, df, method, size, csv_files, target_column)
+    explainer = InterventionalExplainer(flat_model, rows, weights)
+    error = approximation_error(explainer, background['check_rows'], background['check_shap'],
+                                background['full_expected_value'])
+    return dict(background, method=method, rows=rows, weights=weights, error=error)
+
+
+def background_digest(background):
+    """Short hash of the background pages and weights (part of the explanation cache key)."""
+    import hashlib
+
+    sha = hashlib.sha256()
+    sha.update(np.ascontiguousarray(background['rows']).tobytes())
+    sha.update(np.ascontiguousarray(background['weights']).tobytes())
+    return sha.hexdigest()[:16]
+
+
+def describe_background(background):
+    """One line for the report, e.g. '100-page kmeans background: error 2.1% of |SHAP| ...'"""
+    error = background['error']
+    return (f"{len(background['rows'])}-page {background['method']} background (of {background['full_pages']:,}): "
+            f"error vs. the full background {error['relative_error']:.1%} of |SHAP|, "
+            f"mean {error['mean_abs_error_ms']:.1f} ms, max {error['max_abs_error_ms']:.0f} ms per feature")
+
+
+def print_trade_off(model, background, df, flat_model, sizes=TRADE_OFF_SIZES, methods=BACKGROUND_METHODS,
+                    csv_files=None):
+    """Print the error and explain time of every background size and method."""
+    print(f"\nInterventional SHAP vs. the full background ({background['full_pages']:,} pages, "
+          f"{len(background['check_rows'])} reference pages, "
+          f"{background['reference_seconds'] / len(background['check_rows']):.1f} s per page):")
+    print(f"{'Method':<12} {'Size':>6} {'Rel. error':>11} {'Mean (ms)':>10} {'Max (ms)':>9} {'E[f] diff':>10} "
+          f"{'ms/page':>8}")
+    print("-" * 72)
+    for method in methods:
+        for size in sizes:
+            resized = resize_background(model, background, df, flat_model, size, method, csv_files)
+            explainer = InterventionalExplainer(flat_model, resized['rows'], resized['weights'])
+            started = time.perf_counter()
+            explainer.shap_values(background['check_rows'])
+            ms_per_page = (time.perf_counter() - started) * 1000 / len(background['check_rows'])
+            error = resized['error']
+            print(f"{method:<12} {len(resized['rows']):>6} {error['relative_error']:>10.1%} "
+                  f"{error['mean_abs_error_ms']:>10.1f} {error['max_abs_error_ms']:>9.0f} "
+                  f"{error['expected_value_error_ms']:>10.1f} {ms_per_page:>8.1f}")
+
+
+def main(argv=None):
+    """Rebuild the background of the current model and compare background sizes."""
+    import joblib
+    from data_loader import load_and_concat_csvs
+    from tree_predictor import load_flat_model, FlatTreeEnsemble
+
+    parser = argparse.ArgumentParser(description='Build the summarized SHAP background saved next to the model.')
+    parser.add_argument('--method', choices=BACKGROUND_METHODS, default=DEFAULT_METHOD,
+                        help=f'How the training pages are summarized. Default: {DEFAULT_METHOD}')
+    parser.add_argument('--size', type=int, default=DEFAULT_SIZE,
+                        help=f'Background pages to keep. Default: {DEFAULT_SIZE}')
+    parser.add_argument('--check-pages', type=int, default=CHECK_PAGES,
+                        help=f'Reference pages explained against the full background. Default: {CHECK_PAGES}')
+    parser.add_argument('--trade-off', action='store_true',
+                        help=f"Also print the error of sizes {', '.join(map(str, TRADE_OFF_SIZES))} for both methods")
+    args = parser.parse_args(argv)
+
+    model = joblib.load(MODEL_FILE_NAME)
+    flat_model = load_flat_model(MODEL_FILE_NAME) or FlatTreeEnsemble.from_model(model)
+    df = load_and_concat_csvs(remove_duplicates=True).dropna(subset=[TARGET_COLUMN])
+    background = load_background(MODEL_FILE_NAME)
+    if background is not None and len(background['check_rows']) == args.check_pages:
+        # The reference pages don't depend on the size or method: only re-summarize
+        background = resize_background(model, background, df, flat_model, args.size, args.method)
+    else:
+        background = build_background(model, MODEL_FILE_NAME, df, flat_model, args.method, args.size,
+                                      check_pages=args.check_pages)
+    path = save_background(background, MODEL_FILE_NAME)
+    print(f"\nSaved the {describe_background(background)} to '{path}'")
+    if args.trade_off:
+        print_trade_off(model, background, df, flat_model)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,350 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from data_loader import CSV_FILES, read_csv_cached
+from feature_schema import get_schema
+from batch_explain import compute_contributions
+from model_artifacts import json_default
+
+# Global SHAP summary saved next to the model by train_model.py (aislow_desktop.shap_summary.json)
+# TreeSHAP runs once at training time, over a sample drawn equally from every source CSV (the fast
+# and the slow crawls), in chunks spread over worker processes. Each sampled page is weighted by
+# its file's rows / sampled rows, so the summary describes the whole training population:
+#   - mean |SHAP| and mean SHAP per feature (global importance and average push)
+#   - dependence curves: weighted mean SHAP per value bin (quantile bins, one bin per distinct
+#     value for low-cardinality features, one per level for non-numeric categories, plus missing values)
+#   - correlation of every feature with the target (all training rows) and with its own SHAP
+#     values (direction of the model's effect), computed for all features in one pass
+# Dashboards load this file instead of running SHAP over the training data. Tied to the model by SHA-256.
+
+MODEL_FILE_NAME = 'aislow_desktop.pkl'
+TARGET_COLUMN = 'SpeedIndex'
+SUMMARY_VERSION = 1
+SAMPLE_ROWS = 6000      # Pages explained, split equally between the source CSVs
+CHUNK_ROWS = 1000       # Pages per SHAP call (and per worker task)
+DEPENDENCE_BINS = 10    # Quantile bins per numeric feature
+TOP_FEATURES = 13       # Rows printed by print_shap_summary (same as the importance table)
+SEED = 42
+
+# Per-process state for parallel chunks (set once by _init_worker)
+_worker_model = None
+
+
+def get_summary_path(model_file=MODEL_FILE_NAME):
+    """Summary next to the model, e.g. aislow_desktop.pkl -> aislow_desktop.shap_summary.json"""
+    return os.path.splitext(model_file)[0] + '.shap_summary.json'
+
+
+def numeric_values(df, columns):
+    """
+    Raw columns as a float64 matrix (booleans and numeric levels as numbers, anything else as NaN).
+
+    Args:
+        df: DataFrame of raw rows
+        columns: Columns to convert, in order
+
+    Returns:
+        np.ndarray: (rows, columns) float64 matrix
+    """
+    try:
+        return df[columns].to_numpy(dtype=np.float64, na_value=np.nan)
+    except (TypeError, ValueError):
+        pass
+    # Numeric and boolean columns still convert as one block; only the others go column by column
+    values = np.empty((len(df), len(columns)), dtype=np.float64)
+    is_numeric = [pd.api.types.is_numeric_dtype(df[col].dtype) or pd.api.types.is_bool_dtype(df[col].dtype)
+                  for col in columns]
+    block = [j for j, numeric in enumerate(is_numeric) if numeric]
+    values[:, block] = df[[columns[j] for j in block]].to_numpy(dtype=np.float64, na_value=np.nan)
+    for j in (j for j, numeric in enumerate(is_numeric) if not numeric):
+        values[:, j] = pd.to_numeric(df[columns[j]].astype(object), errors='coerce').to_numpy(
+            dtype=np.float64, na_value=np.nan)
+    return values
+
+
+def column_correlations(values, other):
+    """
+    Pearson correlation of every column of a matrix, over the rows where both sides are present
+    (what pandas' Series.corr computes, for all columns at once).
+
+    Args:
+        values: (rows, columns) float64 matrix, NaN = missing
+        other: (rows,) vector correlated with every column, or a (rows, columns) matrix
+            correlated column by column
+
+    Returns:
+        np.ndarray: Correlation per column (0.0 where it is undefined, e.g. a constant column)
+    """
+    other = np.asarray(other, dtype=np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if other.ndim == 1:
+            # One vector for every column: rows without it are dropped, and its sums over each
+            # column's rows are matrix products (values are shifted by their column mean first)
+            rows = ~np.isnan(other)
+            if not rows.all():
+                values, other = values[rows], other[rows]
+            y = other - other.mean()
+            missing = np.isnan(values)
+            weights = (~missing).astype(np.float64)
+            counts = weights.sum(axis=0)
+            x = np.where(missing, 0.0, values)
+            x -= x.sum(axis=0) / counts
+            x *= weights  # Centered over each column's rows, 0 where it is missing
+            y_sums = y @ weights
+            covariance = y @ x
+            y_variance = (y * y) @ weights - y_sums ** 2 / counts
+        else:
+            present = ~np.isnan(values) & ~np.isnan(other)
+            counts = present.sum(axis=0)
+            x = np.where(present, values, 0.0)
+            y = np.where(present, other, 0.0)
+            x = np.where(present, x - x.sum(axis=0) / counts, 0.0)
+            y = np.where(present, y - y.sum(axis=0) / counts, 0.0)
+            covariance = np.einsum('ij,ij->j', x, y)
+            y_variance = np.einsum('ij,ij->j', y, y)
+        correlations = covariance / np.sqrt(np.einsum('ij,ij->j', x, x) * y_variance)
+    return np.nan_to_num(correlations, nan=0.0)
+
+
+def stratified_sample(csv_files=None, target_column=TARGET_COLUMN, sample_rows=SAMPLE_ROWS):
+    """
+    Sample the training pages equally from every source CSV.
+
+    Rows are filtered like load_training_data (a page is kept in the first file that has it,
+    and pages without a target are dropped), then each file contributes up to
+    sample_rows / len(csv_files) pages.
+
+    Returns:
+        tuple: (sampled rows, weight per sampled row, dict of file name -> {'rows', 'sampled', 'weight'})
+    """
+    csv_files = csv_files or CSV_FILES
+    per_file = max(1, sample_rows // len(csv_files))
+    seen_pages = set()
+    parts, weights, sources = [], [], {}
+    for csv_file in csv_files:
+        df = read_csv_cached(csv_file)
+        if 'page' in df.columns:
+            df = df.drop_duplicates(subset=['page'])
+            df = df[~df['page'].isin(seen_pages)]
+            seen_pages.update(df['page'])
+        df = df.dropna(subset=[target_column])
+        if not len(df):
+            continue
+        sample = df.sample(min(len(df), per_file), random_state=SEED)
+        weight = len(df) / len(sample)
+        parts.append(sample)
+        weights.append(np.full(len(sample), weight))
+        sources[os.path.basename(csv_file)] = {'rows': len(df), 'sampled': len(sample), 'weight': weight}
+    return pd.concat(parts, ignore_index=True), np.concatenate(weights), sources
+
+
+def _init_worker(model_file):
+    """Load the model once per worker process."""
+    global _worker_model
+    import joblib
+    _worker_model = joblib.load(model_file)
+
+
+def _contributions_in_worker(matrix):
+    return compute_contributions(_worker_model, matrix)
+
+
+def explain_in_chunks(model, model_file, matrix, workers=None, chunk_rows=CHUNK_ROWS):
+    """
+    TreeSHAP values of an encoded feature matrix, one chunk per call, across worker processes.
+
+    Args:
+        model: Trained LGBMRegressor (used in-process)
+        model_file: Its saved file (loaded by pool workers)
+        matrix: Encoded features (FeatureSchema.to_matrix)
+        workers: Processes (default: one per CPU, at most one per chunk; 1 = in this process)
+        chunk_rows: Rows per chunk
+
+    Returns:
+        tuple: (SHAP values of shape (rows, features), expected value)
+    """
+    chunks = [matrix[start:start + chunk_rows] for start in range(0, len(matrix), chunk_rows)]
+    workers = max(1, min(workers or os.cpu_count() or 1, len(chunks)))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(model_file,)) as executor:
+            results = list(executor.map(_contributions_in_worker, chunks))
+    else:
+        results = [compute_contributions(model, chunk) for chunk in chunks]
+    return np.vstack([shap_values for shap_values, _ in results]), results[0][1]
+
+
+def _weighted_means(bins, n_bins, weights, values):
+    totals = np.bincount(bins, weights=weights, minlength=n_bins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.bincount(bins, weights=weights * values, minlength=n_bins) / totals
+
+
+def dependence_curve(values, shap_values, weights, levels=None, n_bins=DEPENDENCE_BINS):
+    """
+    Weighted mean SHAP value per value range of one feature.
+
+    Args:
+        values: Feature values of the sampled pages (category codes for categorical features)
+        shap_values: Their SHAP values for this feature
+        weights: Page weights
+        levels: Category levels (non-numeric categorical features), else None
+        n_bins: Quantile bins for numeric features with more distinct values than that
+
+    Returns:
+        dict: 'level' (categorical) or 'low'/'high'/'mean_value' (numeric) per bin, with
+              'pages' and 'mean_shap'; 'missing' holds the pages without a value
+    """
+    missing = np.isnan(values)
+    present_values, present_shap, present_weights = values[~missing], shap_values[~missing], weights[~missing]
+    curve = {}
+    if levels is not None:
+        bins = present_values.astype(np.int64)
+        n = len(levels)
+        curve['level'] = list(levels)
+    else:
+        distinct = np.unique(present_values)
+        if len(distinct) <= n_bins:
+            # Few distinct values (counts, flags): one bin each
+            bins = np.searchsorted(distinct, present_values)
+            low = high = distinct
+        else:
+            edges = np.unique(np.quantile(present_values, np.linspace(0, 1, n_bins + 1)))
+            bins = np.clip(np.searchsorted(edges, present_values, side='right') - 1, 0, len(edges) - 2)
+            low, high = edges[:-1], edges[1:]
+        n = len(low)
+        curve['low'], curve['high'] = low.tolist(), high.tolist()
+        curve['mean_value'] = _weighted_means(bins, n, present_weights, present_values).tolist()
+    pages = np.bincount(bins, minlength=n)
+    curve['pages'] = pages.tolist()
+    curve['mean_shap'] = _weighted_means(bins, n, present_weights, present_shap).tolist()
+
+    # Levels/bins no sampled page falls in carry no information
+    keep = pages > 0
+    curve = {key: [item for item, k in zip(items, keep) if k] for key, items in curve.items()}
+    if missing.any():
+        curve['missing'] = {'pages': int(missing.sum()),
+                            'mean_shap': float(np.average(shap_values[missing], weights=weights[missing]))}
+    return curve
+
+
+def build_shap_summary(model, model_file, df, csv_files=None, target_column=TARGET_COLUMN,
+                       sample_rows=SAMPLE_ROWS, workers=None):
+    """
+    Explain a stratified sample of the training pages and summarize the SHAP values.
+
+    Args:
+        model: Trained LGBMRegressor
+        model_file: Path of the saved model (hashed to tie the summary to it; loaded by workers)
+        df: All training data (for the target correlations)
+        csv_files: Source CSVs the sample is stratified over (default: CSV_FILES)
+        target_column: Metric the model predicts
+        sample_rows: Pages explained
+        workers: SHAP worker processes (default: one per CPU)
+
+    Returns:
+        dict: Summary contents
+    """
+    from model_artifacts import hash_file
+
+    schema = get_schema(model)
+    sample, weights, sources = stratified_sample(csv_files, target_column, sample_rows)
+    matrix = schema.to_matrix(sample)
+    shap_values, expected_value = explain_in_chunks(model, model_file, matrix, workers)
+
+    # Raw values for correlations (categorical levels are numbers), codes for the level curves
+    sample_values = numeric_values(sample, schema.columns)
+    target_correlation = column_correlations(numeric_values(df, schema.columns),
+                                             pd.to_numeric(df[target_column], errors='coerce').to_numpy(dtype=np.float64))
+    shap_correlation = column_correlations(sample_values, shap_values)
+    mean_abs_shap = np.average(np.abs(shap_values), axis=0, weights=weights)
+    mean_shap = np.average(shap_values, axis=0, weights=weights)
+
+    features = []
+    for j in np.argsort(-mean_abs_shap, kind='stable'):
+        col = schema.columns[j]
+        # Numeric levels (counts, flags) are binned like numeric features; others get a bin per level
+        levels = schema.category_levels.get(col)
+        if levels is not None and all(isinstance(level, (bool, int, float, np.number)) for level in levels):
+            levels = None
+        features.append({
+            'name': col,
+            'categorical': col in schema.category_levels,
+            'mean_abs_shap': float(mean_abs_shap[j]),
+            'mean_shap': float(mean_shap[j]),
+            'target_correlation': float(target_correlation[j]),
+            'shap_correlation': float(shap_correlation[j]),
+            'dependence': dependence_curve(matrix[:, j] if levels is not None else sample_values[:, j],
+                                           shap_values[:, j], weights, levels),
+        })
+    return {
+        'version': SUMMARY_VERSION,
+        'model_file': os.path.basename(model_file),
+        'model_sha256': hash_file(model_file),
+        'target': target_column,
+        'expected_value': expected_value,
+        'sample': {'pages': len(sample), 'sources': sources},
+        'features': features,
+    }
+
+
+def save_shap_summary(summary, model_file=MODEL_FILE_NAME):
+    """Write the summary next to the model. Returns its path."""
+    path = get_summary_path(model_file)
+    with open(path, 'w') as f:
+        json.dump(summary, f, default=json_default)
+    return path
+
+
+def load_shap_summary(model_file=MODEL_FILE_NAME):
+    """
+    Load the SHAP summary of a model file.
+
+    Returns:
+        dict or None: None if there is no summary, or it is outdated or belongs to another model
+    """
+    from model_artifacts import hash_file
+
+    try:
+        with open(get_summary_path(model_file)) as f:
+            summary = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if summary.get('version') != SUMMARY_VERSION or summary.get('model_sha256') != hash_file(model_file):
+        return None
+    return summary
+
+
+def print_shap_summary(summary, top=TOP_FEATURES):
+    """Print the most important features by mean |SHAP| and the direction of their effect."""
+    from feature_names import FEATURE_NAME_MAP
+
+    sources = ', '.join(f"{name} ({source['sampled']} of {source['rows']})"
+                        for name, source in summary['sample']['sources'].items())
+    print(f"\nTop {top} Features by Mean |SHAP| ({summary['sample']['pages']} pages: {sources}):")
+    print(f"{'Feature':<40} {'Mean |SHAP|':>11} {'Mean SHAP':>10} {'SHAP corr':>10}  {'Effect':<15}")
+    print("-" * 92)
+    for feature in summary['features'][:top]:
+        corr = feature['shap_correlation']
+        if abs(corr) < 0.1:
+            effect = "depends on value"
+        else:
+            effect = "higher → slower" if corr > 0 else "higher → faster"
+        friendly_name = FEATURE_NAME_MAP.get(feature['name'], feature['name'])
+        print(f"{friendly_name:<40} {feature['mean_abs_shap']:>9.0f}ms {feature['mean_shap']:>8.0f}ms "
+              f"{corr:>10.3f}  {effect:<15}")
+
+
+if __name__ == '__main__':
+    # Rebuild the summary for the current model without retraining
+    import joblib
+    from data_loader import load_and_concat_csvs
+
+    model = joblib.load(MODEL_FILE_NAME)
+    df = load_and_concat_csvs(remove_duplicates=True).dropna(subset=[TARGET_COLUMN])
+    summary = build_shap_summary(model, MODEL_FILE_NAME, df)
+    path = save_shap_summary(summary, MODEL_FILE_NAME)
+    print_shap_summary(summary)
+    print(f"\nSaved the SHAP summary to '{path}'")
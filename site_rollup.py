@@ -0,0 +1,410 @@
+import os
+import warnings
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from model_config import WHAT_IF_CATEGORICAL_OPTIONS, PROBLEM_THRESHOLD_MS
+from feature_schema import get_schema
+from batch_explain import compute_contributions
+from shap_summary import numeric_values
+from whatif import PRIMARY_LEVEL
+from telemetry import stage
+from cohorts import ANY, rank_band_of
+from data_loader import iter_file_chunks
+
+# Site-level rollup used by `aislow.py --mode rollup`
+# Explains every page of a site (a domain and its subdomains, or a URL regex) and keeps only
+# per-site sums: SHAP contributions, predicted vs. actual SpeedIndex and what-if savings. Each
+# chunk is reduced with grouped numpy sums (np.add.at over site codes), so memory is bounded by
+# (sites x features), not by the number of pages, and no per-page records are ever built.
+# Without a site or pattern every domain in the input is rolled up on its own.
+#
+# The what-if is the classic one: a page's problem (SHAP > PROBLEM_THRESHOLD_MS) is moved to the
+# 'good' benchmark (p25, the page's cohort benchmark when cohort tables are given), or to its
+# recommended setting for the features in WHAT_IF_CATEGORICAL_OPTIONS. Every (page, problem)
+# scenario of a chunk is scored in one predict call.
+
+TARGET_COLUMN = 'SpeedIndex'
+MODEL_FILE_NAME = 'aislow_desktop.pkl'
+DEFAULT_CHUNK_SIZE = 2000
+TOP_PROBLEMS = 10
+TOP_STRENGTHS = 3
+HOST_PATTERN = r'^(?:[a-zA-Z][a-zA-Z0-9+.-]*://)?(?:[^@/?#]*@)?(?:www\d*\.)?([^/:?#]+)'
+
+# Per-site sums, name -> True if the sum is per feature (sites x features) rather than per site
+SUMS = {
+    'pages': False,
+    'measured_pages': False,        # Pages with an actual SpeedIndex
+    'predicted': False,
+    'actual': False,
+    'predicted_measured': False,    # Predictions of the measured pages only, to compare like for like
+    'abs_error': False,
+    'shap': True,
+    'problem_pages': True,          # Pages where the feature adds more than PROBLEM_THRESHOLD_MS
+    'problem_shap': True,           # SHAP summed over those pages
+    'fix_pages': True,              # Problem pages with a better benchmark/setting to move to
+    'improved_pages': True,         # ... where the move lowers the prediction
+    'savings': True,                # Predicted ms saved by the move, summed over fix_pages
+}
+
+# Per-process state for parallel rollups (set once by _init_worker)
+_worker_model = None
+_worker_settings = None
+
+
+def page_hosts(pages):
+    """
+    Host of every URL, lower case and without a leading 'www.' (NaN if there is none).
+
+    Args:
+        pages: Series of page URLs
+
+    Returns:
+        pd.Series: Hosts, e.g. 'https://www.etsy.com/c/jewelry' -> 'etsy.com'
+    """
+    return pages.astype('string').str.extract(HOST_PATTERN, expand=False).str.lower()
+
+
+def site_keys(df, site=None, url_pattern=None):
+    """
+    Which pages belong to the rollup, and the site each one is counted under.
+
+    Args:
+        df: Raw page rows with a 'page' column
+        site: Domain to roll up; its subdomains are included (e.g. 'etsy.com' also matches
+            'help.etsy.com')
+        url_pattern: Regular expression matched against the URL (re.search semantics)
+
+    Returns:
+        tuple: (boolean mask of the pages to keep, object array of site names for those pages)
+
+    Raises:
+        ValueError: If df has no 'page' column
+    """
+    if 'page' not in df.columns:
+        raise ValueError("Rolling up pages by site needs a 'page' column with the URLs")
+    pages = df['page']
+    if url_pattern is not None:
+        with warnings.catch_warnings():  # Groups in the pattern are fine, only the match matters
+            warnings.simplefilter('ignore', UserWarning)
+            mask = pages.astype('string').str.contains(url_pattern, regex=True, na=False).to_numpy(dtype=bool)
+        return mask, np.full(int(mask.sum()), url_pattern, dtype=object)
+    hosts = page_hosts(pages)
+    if site is not None:
+        site = site.lower().removeprefix('www.')
+        mask = ((hosts == site) | hosts.str.endswith('.' + site)).fillna(False).to_numpy(dtype=bool)
+        return mask, np.full(int(mask.sum()), site, dtype=object)
+    mask = hosts.notna().to_numpy(dtype=bool)
+    return mask, hosts[mask].to_numpy(dtype=object)
+
+
+def fix_targets(raw, columns, percentile_metrics, cohorts=None, cohort_positions=None):
+    """
+    Raw value every feature of every page would be moved to, NaN where there is no better value.
+
+    Args:
+        raw: (pages, features) float64 raw values (shap_summary.numeric_values)
+        columns: Feature names of raw's columns
+        percentile_metrics: Global benchmarks (level -> {feature: value})
+        cohorts: Optional cohorts.CohortTables; its PRIMARY_LEVEL benchmark of each page's cohort
+            takes precedence over the global one
+        cohort_positions: Cohort of every page (CohortTables.positions), with cohorts
+
+    Returns:
+        np.ndarray: (pages, features) float64 targets
+    """
+    good = percentile_metrics.get(PRIMARY_LEVEL, {})
+    targets = np.tile(np.array([good.get(col, np.nan) for col in columns], dtype=np.float64), (len(raw), 1))
+    if cohorts is not None and PRIMARY_LEVEL in cohorts.levels:
+        table = cohorts.values[cohort_positions, cohorts.levels.index(PRIMARY_LEVEL)]
+        for j, col in enumerate(columns):
+            if col in cohorts.feature_names:
+                cohort_good = table[:, cohorts.feature_names.index(col)]
+                targets[:, j] = np.where(np.isnan(cohort_good), targets[:, j], cohort_good)
+    # "Higher = worse", as in the single-page what-if: only values above the benchmark move
+    with np.errstate(invalid='ignore'):
+        targets[~(raw > targets)] = np.nan
+    for j, col in enumerate(columns):
+        options = WHAT_IF_CATEGORICAL_OPTIONS.get(col)
+        if options:
+            option = float(options[0])
+            targets[:, j] = np.where(raw[:, j] == option, np.nan, option)
+    return targets
+
+
+def fix_savings(model, matrix, targets, problems, predictions):
+    """
+    Predicted savings of moving each problem of each page to its target, one scenario per pair.
+
+    All scenarios go through a single predict call.
+
+    Args:
+        model: Trained LGBMRegressor
+        matrix: (pages, features) encoded features (FeatureSchema.to_matrix)
+        targets: Raw target values from fix_targets()
+        problems: (pages, features) boolean mask of the problems to simulate
+        predictions: Current prediction of every page
+
+    Returns:
+        tuple: ((pages, features) savings in ms, 0 where nothing was simulated;
+                (pages, features) boolean mask of the simulated pairs)
+    """
+    simulated = problems & ~np.isnan(targets)
+    savings = np.zeros(matrix.shape, dtype=np.float64)
+    rows, cols = np.nonzero(simulated)
+    if not len(rows):
+        return savings, simulated
+    schema = get_schema(model)
+    new_values = targets[rows, cols]
+    for j in np.unique(cols):
+        col = schema.columns[j]
+        if col in schema.category_levels:
+            in_col = cols == j
+            new_values[in_col] = schema.encode_values(col, new_values[in_col])
+    scenarios = matrix[rows]
+    scenarios[np.arange(len(rows)), cols] = new_values
+    savings[rows, cols] = predictions[rows] - model.booster_.predict(scenarios)
+    return savings, simulated
+
+
+class SiteRollup:
+    """
+    Running per-site sums of page explanations (see SUMS). Rollups of different chunks merge.
+
+    Args:
+        feature_names: Model features, the columns of the per-feature sums
+    """
+
+    def __init__(self, feature_names):
+        self.feature_names = list(feature_names)
+        self.sites = []
+        self.base_value = float('nan')
+        self.sums = {name: np.zeros((0, len(self.feature_names)) if per_feature else 0)
+                     for name, per_feature in SUMS.items()}
+        self._positions = {}
+
+    def _site_ids(self, names):
+        """Position of every site name, adding rows for sites not seen before."""
+        ids = np.empty(len(names), dtype=np.int64)
+        for i, name in enumerate(names):
+            position = self._positions.get(name)
+            if position is None:
+                position = self._positions[name] = len(self.sites)
+                self.sites.append(name)
+            ids[i] = position
+        grow = len(self.sites) - len(self.sums['pages'])
+        if grow:
+            for name, values in self.sums.items():
+                self.sums[name] = np.concatenate([values, np.zeros((grow,) + values.shape[1:])])
+        return ids
+
+    def add(self, sites, base_value, **page_values):
+        """
+        Add pages: one array per name in SUMS (first axis = pages), grouped by site.
+
+        Args:
+            sites: Site name of every page
+            base_value: The model's expected value (same for every page)
+        """
+        names, codes = np.unique(np.asarray(sites, dtype=object), return_inverse=True)
+        ids = self._site_ids(names)[codes]
+        for name, values in page_values.items():
+            np.add.at(self.sums[name], ids, values)
+        if len(ids):
+            self.base_value = float(base_value)
+
+    def merge(self, other):
+        """Fold in another rollup of the same model. Returns self."""
+        ids = self._site_ids(other.sites)
+        for name, values in other.sums.items():
+            np.add.at(self.sums[name], ids, values)
+        if not np.isnan(other.base_value):
+            self.base_value = other.base_value
+        return self
+
+    def summary(self, site, top_problems=TOP_PROBLEMS, top_strengths=TOP_STRENGTHS):
+        """
+        Site-wide explanation of one site, for the report and the JSON output.
+
+        Problems are ranked by the SHAP they add summed over the site's pages (so a problem that
+        affects many pages outranks a bigger one on a few), strengths by their mean contribution.
+
+        Returns:
+            dict: Page counts, mean predicted/actual SpeedIndex, ranked problems and strengths
+        """
+        s = {name: values[self._positions[site]] for name, values in self.sums.items()}
+        pages = int(s['pages'])
+        measured = int(s['measured_pages'])
+
+        def per(total, count):
+            return float(total / count) if count else None
+
+        problems = []
+        for j in np.argsort(-s['problem_shap'], kind='stable')[:top_problems]:
+            affected = int(s['problem_pages'][j])
+            if not affected:
+                break
+            fixed = int(s['fix_pages'][j])
+            problems.append({
+                'name': self.feature_names[j],
+                'pages': affected,
+                'share': affected / pages,
+                'impact_ms': per(s['problem_shap'][j], affected),       # On the pages it affects
+                'site_impact_ms': per(s['problem_shap'][j], pages),     # Spread over every page of the site
+                'fix_pages': fixed,
+                'improved_pages': int(s['improved_pages'][j]),
+                'savings_ms': per(s['savings'][j], fixed),
+                'total_savings_ms': float(s['savings'][j]),
+            })
+        strengths = [{'name': self.feature_names[j], 'impact_ms': per(s['shap'][j], pages)}
+                     for j in np.argsort(s['shap'], kind='stable')[:top_strengths] if s['shap'][j] < 0]
+        return {
+            'site': site,
+            'pages': pages,
+            'measured_pages': measured,
+            'base_value': self.base_value,
+            'mean_predicted': per(s['predicted'], pages),
+            'mean_actual': per(s['actual'], measured),
+            'mean_predicted_measured': per(s['predicted_measured'], measured),
+            'mean_abs_error': per(s['abs_error'], measured),
+            'problems': problems,
+            'strengths': strengths,
+        }
+
+    def summaries(self, top_sites=None):
+        """Summaries of the sites with the most pages first (all of them, or the top_sites)."""
+        order = np.argsort(-self.sums['pages'], kind='stable')[:top_sites]
+        return [self.summary(self.sites[i]) for i in order]
+
+
+def rollup_chunk(model, df_chunk, percentile_metrics, site=None, url_pattern=None, cohorts=None,
+                 rank_band=ANY):
+    """
+    Explain the pages of a chunk that belong to the rollup and reduce them to per-site sums.
+
+    One SHAP (pred_contrib) call, one predict call and one predict call for all what-if scenarios.
+
+    Args:
+        model: Trained LGBMRegressor
+        df_chunk: Raw page rows
+        percentile_metrics: Global benchmarks from batch_explain.compute_percentile_metrics()
+        site, url_pattern: Pages to keep (see site_keys); every domain on its own if both are None
+        cohorts: Optional cohorts.CohortTables for per-page what-if benchmarks
+        rank_band: Rank band of the input file, for the cohort lookup
+
+    Returns:
+        SiteRollup: Sums of this chunk's pages
+    """
+    schema = get_schema(model)
+    rollup = SiteRollup(schema.columns)
+    mask, sites = site_keys(df_chunk, site, url_pattern)
+    if not mask.any():
+        return rollup
+    df_site = df_chunk[mask] if not mask.all() else df_chunk
+    n_rows = len(df_site)
+    with stage('category_conversion', rows=n_rows):
+        matrix = schema.to_matrix(df_site)
+        raw = numeric_values(df_site.reindex(columns=schema.columns), schema.columns)
+    with stage('shap', rows=n_rows):
+        shap_values, base_value = compute_contributions(model, matrix)
+    with stage('predict', rows=n_rows):
+        predictions = model.booster_.predict(matrix)
+
+    with stage('what_if', rows=n_rows):
+        cohort_positions = cohorts.positions(df_site, rank_band) if cohorts is not None else None
+        targets = fix_targets(raw, schema.columns, percentile_metrics, cohorts, cohort_positions)
+        problems = shap_values > PROBLEM_THRESHOLD_MS
+        savings, simulated = fix_savings(model, matrix, targets, problems, predictions)
+
+    if TARGET_COLUMN in df_site.columns:
+        actual = pd.to_numeric(df_site[TARGET_COLUMN], errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+    else:
+        actual = np.full(n_rows, np.nan)
+    measured = ~np.isnan(actual)
+    with stage('rollup', rows=n_rows):
+        rollup.add(sites, base_value,
+                   pages=np.ones(n_rows),
+                   measured_pages=measured.astype(np.float64),
+                   predicted=predictions,
+                   actual=np.where(measured, actual, 0.0),
+                   predicted_measured=np.where(measured, predictions, 0.0),
+                   abs_error=np.where(measured, np.abs(actual - predictions), 0.0),
+                   shap=shap_values,
+                   problem_pages=problems.astype(np.float64),
+                   problem_shap=np.where(problems, shap_values, 0.0),
+                   fix_pages=simulated.astype(np.float64),
+                   improved_pages=(savings > 0).astype(np.float64),
+                   savings=savings)
+    return rollup
+
+
+def _init_worker(model_file, settings):
+    """Load the model once per worker process."""
+    global _worker_model, _worker_settings
+    import joblib
+
+    _worker_model = joblib.load(model_file)
+    _worker_settings = settings
+
+
+def _rollup_chunk_in_worker(df_chunk):
+    """Roll up a chunk with the worker's resident model."""
+    return rollup_chunk(_worker_model, df_chunk, **_worker_settings)
+
+
+def _iter_parallel_rollups(chunks, model_file, settings, workers):
+    """
+    Roll up chunks across a process pool, yielding the partial rollups in input order
+    (so the floating point sums are the same for any number of workers).
+
+    At most 2 chunks per worker are in flight, so memory stays bounded by chunk size.
+    """
+    max_pending = workers * 2
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(model_file, settings)) as executor:
+        pending = deque()
+        for df_chunk in chunks:
+            pending.append(executor.submit(_rollup_chunk_in_worker, df_chunk))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def run_rollup(model, input_csv, percentile_metrics, site=None, url_pattern=None, chunk_size=DEFAULT_CHUNK_SIZE,
+               workers=1, model_file=MODEL_FILE_NAME, cohorts=None, verbose=False):
+    """
+    Roll up every page of a CSV that belongs to a site (or every site), streaming it chunk by chunk.
+
+    Args:
+        model: Trained LGBMRegressor (used by the serial path)
+        input_csv: CSV (or Parquet) file with one page per row (same columns as the training data)
+        percentile_metrics: Global benchmark percentiles from compute_percentile_metrics()
+        site: Domain to roll up, subdomains included
+        url_pattern: Regular expression the URLs must match (instead of site)
+        chunk_size: Number of pages explained per SHAP/predict call
+        workers: Number of worker processes (1 = explain in this process)
+        model_file: Model file each worker loads when workers > 1
+        cohorts: Optional cohorts.CohortTables (the input file's rank band is taken from its name)
+        verbose: If True, print progress per chunk
+
+    Returns:
+        SiteRollup: Per-site sums of every matching page
+    """
+    if not os.path.exists(input_csv):
+        raise FileNotFoundError(input_csv)
+    chunks = iter_file_chunks(input_csv, chunk_size)
+    settings = {'percentile_metrics': percentile_metrics, 'site': site, 'url_pattern': url_pattern,
+                'cohorts': cohorts, 'rank_band': rank_band_of(input_csv)}
+    if workers > 1:
+        partial_rollups = _iter_parallel_rollups(chunks, model_file, settings, workers)
+    else:
+        partial_rollups = (rollup_chunk(model, df_chunk, **settings) for df_chunk in chunks)
+
+    rollup = SiteRollup(get_schema(model).columns)
+    for partial in partial_rollups:
+        rollup.merge(partial)
+        if verbose:
+            print(f"  Rolled up {int(rollup.sums['pages'].sum())} pages...")
+    return rollup
@@ -0,0 +1,148 @@
+import sys
+import time
+from contextlib import contextmanager
+
+# Per-stage timing and memory telemetry
+#   with stage('shap', rows=len(X)):
+#       ...
+# records the wall time and peak RSS of a pipeline step on the active Telemetry. Stages nest
+# (a parent's peak includes its children's), and hooks see every stage as it finishes.
+#
+# Peak RSS per stage uses Linux's resettable high-water mark (/proc/self/clear_refs). Elsewhere
+# it falls back to the process-lifetime peak from getrusage.
+
+
+def reset_peak_rss():
+    """Reset the kernel's peak RSS counter (Linux). Returns False where unsupported."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _read_status_mb(field):
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB (since the last reset_peak_rss on Linux)."""
+    peak = _read_status_mb('VmHWM:')
+    if peak is not None:
+        return peak
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024  # bytes on macOS, KB on Linux
+
+
+def current_rss_mb():
+    """Current resident memory in MB (peak_rss_mb where /proc isn't available)."""
+    rss = _read_status_mb('VmRSS:')
+    return rss if rss is not None else peak_rss_mb()
+
+
+class Telemetry:
+    """
+    Collects one record per finished stage, and running totals per stage name.
+
+    Records: name, depth (nesting level), start and seconds (relative wall time),
+    rss_before_mb, peak_rss_mb, plus any extra keyword info given to stage().
+
+    Args:
+        keep_records: If False, only the totals are kept (long-running processes like the server)
+    """
+
+    def __init__(self, keep_records=True):
+        self.keep_records = keep_records
+        self.stages = []
+        self._totals = {}
+        self.hooks = []
+        self.started = time.perf_counter()
+        self._open = []  # Records of the stages currently running, outermost first
+
+    def add_hook(self, hook):
+        """Call hook(record) every time a stage finishes."""
+        self.hooks.append(hook)
+
+    @contextmanager
+    def stage(self, name, **info):
+        """Context manager timing one stage. Yields the record, so callers can add info."""
+        parent = self._open[-1] if self._open else None
+        if parent is not None:
+            parent['peak_rss_mb'] = max(parent['peak_rss_mb'], peak_rss_mb())
+        record = dict(name=name, depth=len(self._open), rss_before_mb=current_rss_mb(), **info)
+        reset_peak_rss()
+        record['peak_rss_mb'] = 0.0
+        self._open.append(record)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['start'] = start - self.started
+            record['seconds'] = time.perf_counter() - start
+            record['peak_rss_mb'] = max(record['peak_rss_mb'], peak_rss_mb())
+            self._open.pop()
+            if parent is not None:
+                parent['peak_rss_mb'] = max(parent['peak_rss_mb'], record['peak_rss_mb'])
+            total = self._totals.setdefault(name, {'calls': 0, 'seconds': 0.0, 'peak_rss_mb': 0.0})
+            total['calls'] += 1
+            total['seconds'] += record['seconds']
+            total['peak_rss_mb'] = max(total['peak_rss_mb'], record['peak_rss_mb'])
+            if self.keep_records:
+                self.stages.append(record)
+            for hook in self.hooks:
+                hook(record)
+
+    def totals(self):
+        """Per stage name: calls, total seconds and the highest peak RSS (repeated stages summed)."""
+        return {name: dict(total) for name, total in self._totals.items()}
+
+    def to_dict(self):
+        """JSON-friendly summary: stages in start order, per-name totals and overall wall time."""
+        return {
+            'total_seconds': time.perf_counter() - self.started,
+            'stages': sorted(self.stages, key=lambda record: record['start']),
+            'totals': self.totals(),
+        }
+
+
+# The active Telemetry used by stage(). Commands call reset_telemetry() to keep per-stage records;
+# library use only accumulates the totals.
+_telemetry = Telemetry(keep_records=False)
+
+
+def get_telemetry():
+    return _telemetry
+
+
+def reset_telemetry(keep_records=True):
+    """Start collecting into a new Telemetry (e.g. once per command) and return it."""
+    global _telemetry
+    _telemetry = Telemetry(keep_records=keep_records)
+    return _telemetry
+
+
+def stage(name, **info):
+    """Time a stage on the active Telemetry (see Telemetry.stage)."""
+    return _telemetry.stage(name, **info)
+
+
+def print_stage_timings(telemetry):
+    """Print the stage table: nested stages indented, repeated stages listed once per call."""
+    summary = telemetry.to_dict()
+    print(f"\n--- Stage Timings ---")
+    print(f"{'Stage':<30} {'Time (ms)':>12} {'Peak RSS (MB)':>15}")
+    print("-" * 59)
+    for record in summary['stages']:
+        label = '  ' * record['depth'] + record['name']
+        print(f"{label:<30} {record['seconds'] * 1000:>12.1f} {record['peak_rss_mb']:>15.0f}")
+    print(f"{'total':<30} {summary['total_seconds'] * 1000:>12.1f}")
@@ -1,12 +1,36 @@
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+import warnings
+from datetime import datetime, timezone
+import numpy as np
 import pandas as pd
 import lightgbm as lgb
+from sklearn.metrics import r2_score
 from sklearn.model_selection import train_test_split
 import joblib
-import time
-import warnings
 from model_config import FEATURES_TO_EXCLUDE, MANUAL_CATEGORICAL_FEATURES
-from data_loader import load_and_concat_csvs
+from data_loader import (load_and_concat_csvs, iter_csv_batches, compute_row_hashes, describe_source_files,
+                         CSV_FILES, DEFAULT_BATCH_ROWS, CACHE_DIR_NAME)
 from feature_names import FEATURE_NAME_MAP
+from model_artifacts import build_artifacts, save_artifacts
+from feature_schema import FeatureSchema, get_schema
+from tree_predictor import export_trees
+from neighbors import build_neighbor_index, FAST_CSV_FILES
+from cohorts import update_cohort_tables
+from telemetry import stage, reset_telemetry, print_stage_timings
+from tuning import (SEARCH_STRATEGIES, DEFAULT_FOLDS, DEFAULT_RANDOM_TRIALS, get_tuning_path, get_dataset_path,
+                    build_dataset, search, print_search_report, save_search_results, load_best_params)
+from shap_summary import (build_shap_summary, save_shap_summary, get_summary_path, column_correlations,
+                          numeric_values)
+from shap_background import build_background, save_background, describe_background, get_background_path
+from compaction import R2_TOLERANCE, compact_model, print_compaction_report
+from multi_target import (PRIMARY_TARGET, DEFAULT_TARGETS, MIN_TARGET_ROWS, get_target_model_path, train_targets,
+                          to_regressor, save_bundle, load_bundle)
 
 # Suppress numpy warnings from correlation calculations with zero-variance features
 warnings.filterwarnings('ignore', category=RuntimeWarning, module='numpy')
@@ -14,155 +38,847 @@ warnings.filterwarnings('ignore', category=RuntimeWarning, module='numpy')
 # --- Configuration ---
 TARGET_COLUMN = 'SpeedIndex'
 MODEL_FILE_NAME = 'aislow_desktop.pkl'
+N_ESTIMATORS = 500           # Maximum number of boosting rounds
+LEARNING_RATE = 0.05         # Lower learning rate for better generalization
+INCREMENTAL_ROUNDS = 100     # Maximum extra boosting rounds added by --incremental
+MIN_INCREMENTAL_ROWS = 100   # Fewer new rows than this aren't worth boosting on
+STREAM_SAMPLE_ROWS = 200_000  # Stream mode: rows kept in memory for the sidecars and correlations
+
+
+def get_row_hashes_path(model_file=MODEL_FILE_NAME):
+    """Row hashes of the training data already used by a model, e.g. aislow_desktop.rowhashes.npy"""
+    return os.path.splitext(model_file)[0] + '.rowhashes.npy'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Train the SpeedIndex model.')
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='Continue boosting the existing model using only rows it has not seen yet (default: full retrain)'
+    )
+    parser.add_argument(
+        '--rounds',
+        type=int,
+        default=INCREMENTAL_ROUNDS,
+        help=f'Incremental mode: maximum boosting rounds to add. Default: {INCREMENTAL_ROUNDS}'
+    )
+    parser.add_argument(
+        '--tune',
+        choices=SEARCH_STRATEGIES,
+        help='Run a K-fold cross-validated hyperparameter search instead of training, '
+             'and save the results next to the model'
+    )
+    parser.add_argument(
+        '--trials',
+        type=int,
+        default=DEFAULT_RANDOM_TRIALS,
+        help=f'Tune mode: configs sampled by random/halving search. Default: {DEFAULT_RANDOM_TRIALS}'
+    )
+    parser.add_argument(
+        '--folds',
+        type=int,
+        default=DEFAULT_FOLDS,
+        help=f'Tune mode: cross-validation folds. Default: {DEFAULT_FOLDS}'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        help='Tune mode: trials run in parallel worker processes (default: 1). '
+             'Multi-target mode: targets trained in parallel (default: one per CPU, up to one per target)'
+    )
+    parser.add_argument(
+        '--tuned',
+        action='store_true',
+        help='Full training with the best config from the last --tune run instead of the defaults'
+    )
+    parser.add_argument(
+        '--compact',
+        action='store_true',
+        help='Full training: replace the model with the cheapest truncated or distilled version within '
+             '--r2-tolerance, for faster SHAP and predictions (see compaction.py)'
+    )
+    parser.add_argument(
+        '--r2-tolerance',
+        type=float,
+        default=R2_TOLERANCE,
+        help=f'Compact mode: most test R² the compact model may lose. Default: {R2_TOLERANCE}'
+    )
+    parser.add_argument(
+        '--targets',
+        nargs='*',
+        help='Train one model per target from a single feature matrix and binned Dataset, and save them '
+             f'as a bundle for aislow.py --target (no names: {" ".join(DEFAULT_TARGETS)}). '
+             f'{PRIMARY_TARGET} replaces the main model'
+    )
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        help='Full training: read the CSVs in batches and train from an on-disk feature matrix instead of '
+             'loading them whole (bounded memory for large crawl exports; trains the same model)'
+    )
+    parser.add_argument(
+        '--batch-rows',
+        type=int,
+        default=DEFAULT_BATCH_ROWS,
+        help=f'Stream mode: rows parsed per batch. Default: {DEFAULT_BATCH_ROWS}'
+    )
+    parser.add_argument(
+        '--shap-summary',
+        action=argparse.BooleanOptionalAction,
+        help='Save the global SHAP summary (~7 s per model; see shap_summary.py). '
+             'Default: on for full and multi-target training, off for --incremental'
+    )
+    parser.add_argument(
+        '--shap-background',
+        action='store_true',
+        help='Also save the summarized background for aislow.py --shap interventional (adds ~45 s; '
+             'see shap_background.py)'
+    )
+    parser.add_argument(
+        '--csv',
+        nargs='+',
+        help='CSV files to train on (default: the CSV_FILES list in data_loader.py)'
+    )
+    parser.add_argument(
+        '--format',
+        choices=['text', 'json'],
+        default='text',
+        help='"json" prints per-step timings and memory as JSON on stdout (progress goes to stderr). Default: text'
+    )
+    args = parser.parse_args(argv)
+    if args.incremental:
+        ignored = [flag for flag, used in (('--tuned', args.tuned), ('--stream', args.stream),
+                                           ('--compact', args.compact)) if used]
+        if ignored:
+            parser.error(f"--incremental continues the saved model and cannot be combined with {', '.join(ignored)}")
+    if args.stream and args.compact:
+        parser.error('--compact needs the whole feature matrix in memory; it cannot be combined with --stream')
+    return args
 
-print(f"Starting model training process...")
 
 # 1. Load and Combine Data
-df = load_and_concat_csvs(remove_duplicates=True, verbose=True)
-
-# Check for missing target values
-print(f"Checking for missing values in '{TARGET_COLUMN}'...")
-missing_target = df[TARGET_COLUMN].isna().sum()
-if missing_target > 0:
-    print(f"  Warning: Found {missing_target} missing values in target. Removing these rows...")
-    df = df.dropna(subset=[TARGET_COLUMN])
-else:
-    print(f"  No missing values in target column")
-
-# 2. Separate Features (X) and Target (y)
-print(f"Separating features (X) and target '{TARGET_COLUMN}' (y)...")
-y = df[TARGET_COLUMN]
-
-# Build list of columns to drop
-columns_to_drop = [TARGET_COLUMN, 'page'] + FEATURES_TO_EXCLUDE
-
-# Filter out any excluded features that don't exist in the dataframe
-columns_to_drop = [col for col in columns_to_drop if col in df.columns]
-
-# Report what's being dropped
-excluded_found = [col for col in FEATURES_TO_EXCLUDE if col in df.columns]
-excluded_not_found = [col for col in FEATURES_TO_EXCLUDE if col not in df.columns]
-
-print(f"Dropping 'page' (URL) and target '{TARGET_COLUMN}' from features...")
-if excluded_found:
-    print(f"Excluding {len(excluded_found)} additional feature(s): {', '.join(excluded_found)}")
-if excluded_not_found:
-    print(f"  Note: {len(excluded_not_found)} excluded feature(s) not found in data: {', '.join(excluded_not_found)}")
-
-X = df.drop(columns=columns_to_drop)
-
-# 3. Preprocessing
-print("Converting specified columns to 'category' type...")
-
-# Loop through your manual list and convert columns
-features_converted = []
-features_not_found = []
-for col in MANUAL_CATEGORICAL_FEATURES:
-    if col in X.columns:
-        X[col] = X[col].astype('category')
-        features_converted.append(col)
+def load_training_data(csv_files=None):
+    df = load_and_concat_csvs(csv_files, remove_duplicates=True, verbose=True)
+
+    # Check for missing target values
+    print(f"Checking for missing values in '{TARGET_COLUMN}'...")
+    missing_target = df[TARGET_COLUMN].isna().sum()
+    if missing_target > 0:
+        print(f"  Warning: Found {missing_target} missing values in target. Removing these rows...")
+        df = df.dropna(subset=[TARGET_COLUMN])
     else:
-        features_not_found.append(col)
-
-if features_converted:
-    print(f"  Converted: {features_converted}")
-if features_not_found:
-    print(f"  Warning: Did not find: {features_not_found}")
-
-print(f"\nFeatures (X) shape: {X.shape}")
-print(f"Target (y) shape: {y.shape}")
-
-# 4. Create Training and Test Sets
-print("Splitting data into training and test sets (80% train / 20% test)...")
-X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
-
-# 5. Initialize and Train the Model
-print("Initializing LGBMRegressor model...")
-model = lgb.LGBMRegressor(
-    random_state=42,
-    n_estimators=500,      # Maximum number of boosting rounds
-    learning_rate=0.05,    # Lower learning rate for better generalization
-    verbosity=-1           # Suppress warnings
-)
-
-print("Starting model training... (This should be fast!)")
-start_time = time.time()
-
-# Pass the list of categorical feature names directly to the model
-model.fit(X_train, y_train,
-          eval_set=[(X_test, y_test)],
-          eval_metric='l2', # Mean Squared Error
-          callbacks=[lgb.early_stopping(stopping_rounds=10, verbose=False)],
-          categorical_feature=features_converted  # Tell LightGBM the category names
-         )
-
-end_time = time.time()
-
-print(f"\n--- Training Complete ---")
-print(f"Training took {end_time - start_time:.2f} seconds.")
-print(f"Best iteration: {model.best_iteration_}")
-
-# 6. Evaluate Model Score
-score = model.score(X_test, y_test)
-print(f"Model R-squared score on test data: {score:.4f}")
+        print(f"  No missing values in target column")
+    return df
+
+
+class StreamedRows(lgb.Sequence):
+    """Rows of the on-disk feature matrix (in the given order), read by LightGBM batch by batch."""
+
+    def __init__(self, matrix, rows, batch_size=DEFAULT_BATCH_ROWS):
+        self.matrix = matrix
+        self.rows = np.asarray(rows)
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, idx):
+        return self.matrix[self.rows[idx]]
+
+
+def _bottom_rows(sample_parts, key_parts, sample_rows):
+    """Keep the sample_rows rows with the smallest keys, in their original order."""
+    sample = pd.concat(sample_parts, ignore_index=True)
+    keys = np.concatenate(key_parts)
+    keep = np.sort(np.argpartition(keys, sample_rows - 1)[:sample_rows])
+    return [sample.iloc[keep]], [keys[keep]], keys[keep].max()
+
+
+def stream_training_data(matrix_file, csv_files=None, batch_rows=DEFAULT_BATCH_ROWS,
+                         sample_rows=STREAM_SAMPLE_ROWS):
+    """
+    Streaming counterpart of load_training_data and build_features.
+
+    Each batch is deduplicated, stripped of rows without a target and hashed, and its features
+    are appended to matrix_file as raw float64 values before the next one is read. Only the
+    targets, row hashes, distinct category values and a bounded sample of rows stay in memory.
+    Once the category levels are known the matrix is encoded in place (FeatureSchema.to_matrix).
+    The sample keeps the rows with the smallest row hashes (a fixed pseudo-random pick), in file
+    order: every row while there are at most sample_rows of them.
+
+    Args:
+        matrix_file: Scratch file for the feature matrix (removed by the caller)
+        csv_files: CSV files to stream (default: CSV_FILES)
+        batch_rows: Rows parsed per batch
+        sample_rows: Rows kept in the sample
+
+    Returns:
+        tuple: (np.memmap feature matrix in schema order, float64 targets, uint64 row hashes,
+                feature_schema.FeatureSchema, sample DataFrame without the 'page' column)
+    """
+    print(f"Streaming {len(csv_files or CSV_FILES)} CSV files in batches of {batch_rows} rows...")
+    columns, distinct = None, {}
+    targets, row_hashes = [], []
+    sample_parts, key_parts, kept, threshold = [], [], 0, None
+    missing_target = 0
+    with open(matrix_file, 'wb') as out:
+        for batch in iter_csv_batches(csv_files, batch_rows=batch_rows, remove_duplicates=True, verbose=True):
+            has_target = batch[TARGET_COLUMN].notna()
+            missing_target += int((~has_target).sum())
+            batch = batch[has_target].drop(columns=['page'], errors='ignore')
+            if columns is None:
+                columns = [col for col in batch.columns if col != TARGET_COLUMN and col not in FEATURES_TO_EXCLUDE]
+            keys = compute_row_hashes(batch)
+            row_hashes.append(keys)
+            targets.append(batch[TARGET_COLUMN].to_numpy(dtype=np.float64))
+            features = batch.reindex(columns=columns)
+            features.to_numpy(dtype=np.float64, na_value=np.nan).tofile(out)
+
+            # Distinct values keep the batch dtype (and NaN), so the levels come out as in one frame
+            for col in MANUAL_CATEGORICAL_FEATURES:
+                if col in features.columns:
+                    values = features[col].drop_duplicates()
+                    distinct[col] = values if col not in distinct else \
+                        pd.concat([distinct[col], values], ignore_index=True).drop_duplicates()
+
+            if threshold is not None:
+                take = keys < threshold
+                batch, keys = batch[take], keys[take]
+            sample_parts.append(batch)
+            key_parts.append(keys)
+            kept += len(keys)
+            if kept > 2 * sample_rows:
+                sample_parts, key_parts, threshold = _bottom_rows(sample_parts, key_parts, sample_rows)
+                kept = sample_rows
+
+    if missing_target > 0:
+        print(f"  Warning: Removed {missing_target} rows with missing values in target '{TARGET_COLUMN}'")
+    if kept > sample_rows:
+        sample_parts, key_parts, _ = _bottom_rows(sample_parts, key_parts, sample_rows)
+    df_sample = pd.concat(sample_parts, ignore_index=True)
+    y = np.concatenate(targets)
+    row_hashes = np.concatenate(row_hashes)
+    print(f"Kept {len(y)} rows and {len(columns)} features (without URLs), {len(df_sample)} rows in memory")
+
+    schema = FeatureSchema(columns, {col: pd.Categorical(values).categories.tolist()
+                                     for col, values in distinct.items()})
+    if schema.categorical_columns:
+        print(f"Encoding categorical features: {schema.categorical_columns}")
+    matrix = np.memmap(matrix_file, dtype=np.float64, mode='r+', shape=(len(y), len(columns)))
+    for start in range(0, len(y), batch_rows):
+        matrix[start:start + batch_rows] = schema.to_matrix(matrix[start:start + batch_rows])
+    matrix.flush()
+    return matrix, y, row_hashes, schema, df_sample
+
+
+# 2. Separate Features (X) and Target (y), 3. Preprocessing
+def build_features(df, category_levels=None):
+    """
+    Split a training frame into features and target and convert categorical columns.
+
+    Args:
+        df: Training data
+        category_levels: Optional dict of feature -> levels to keep (incremental training:
+            the init model's category codes must not change, so new levels are appended)
+
+    Returns:
+        tuple: (X, y, feature_schema.FeatureSchema with the column order and category levels)
+    """
+    print(f"Separating features (X) and target '{TARGET_COLUMN}' (y)...")
+    y = df[TARGET_COLUMN]
+
+    # Build list of columns to drop
+    columns_to_drop = [TARGET_COLUMN, 'page'] + FEATURES_TO_EXCLUDE
+
+    # Filter out any excluded features that don't exist in the dataframe
+    columns_to_drop = [col for col in columns_to_drop if col in df.columns]
+
+    # Report what's being dropped
+    excluded_found = [col for col in FEATURES_TO_EXCLUDE if col in df.columns]
+    excluded_not_found = [col for col in FEATURES_TO_EXCLUDE if col not in df.columns]
+
+    print(f"Dropping 'page' (URL) and target '{TARGET_COLUMN}' from features...")
+    if excluded_found:
+        print(f"Excluding {len(excluded_found)} additional feature(s): {', '.join(excluded_found)}")
+    if excluded_not_found:
+        print(f"  Note: {len(excluded_not_found)} excluded feature(s) not found in data: {', '.join(excluded_not_found)}")
+
+    X = df.drop(columns=columns_to_drop)
+
+    print("Converting specified columns to 'category' type...")
+
+    # Pin the category levels once; inference encodes every page against the same schema
+    schema = FeatureSchema.from_frame(X, category_levels)
+    X = X.astype(schema.category_dtypes)  # Numeric columns keep their compact dtypes
+    features_not_found = [col for col in MANUAL_CATEGORICAL_FEATURES if col not in X.columns]
+
+    if schema.categorical_columns:
+        print(f"  Converted: {schema.categorical_columns}")
+    if features_not_found:
+        print(f"  Warning: Did not find: {features_not_found}")
+
+    print(f"\nFeatures (X) shape: {X.shape}")
+    print(f"Target (y) shape: {y.shape}")
+    return X, y, schema
+
+
+# 4 & 5. Split, Initialize and Train the Model
+def train(X, y, categorical_features, n_estimators=N_ESTIMATORS, init_model=None, params=None):
+    """
+    Train (or, with init_model, continue training) the LGBMRegressor with early stopping.
+
+    params optionally overrides the defaults (e.g. the best config from a --tune run).
+
+    Returns:
+        tuple: (model, X_test, y_test)
+    """
+    print("Splitting data into training and test sets (80% train / 20% test)...")
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+
+    print("Initializing LGBMRegressor model...")
+    model_params = dict(
+        random_state=42,
+        n_estimators=n_estimators,    # Maximum number of boosting rounds
+        learning_rate=LEARNING_RATE,  # Lower learning rate for better generalization
+        verbosity=-1                  # Suppress warnings
+    )
+    if params:
+        print(f"  Using tuned parameters: {params}")
+        model_params.update(params)
+    model = lgb.LGBMRegressor(**model_params)
+
+    print("Starting model training... (This should be fast!)")
+    start_time = time.time()
+
+    # Pass the list of categorical feature names directly to the model
+    model.fit(X_train, y_train,
+              eval_set=[(X_test, y_test)],
+              eval_metric='l2', # Mean Squared Error
+              callbacks=[lgb.early_stopping(stopping_rounds=10, verbose=False)],
+              categorical_feature=categorical_features,  # Tell LightGBM the category names
+              init_model=init_model  # Existing booster to continue from (incremental mode)
+             )
+
+    end_time = time.time()
+
+    print(f"\n--- Training Complete ---")
+    print(f"Training took {end_time - start_time:.2f} seconds.")
+    print(f"Best iteration: {model.best_iteration_}")
+    return model, X_test, y_test
+
+
+def train_streamed(matrix, y, schema, params=None):
+    """
+    Stream-mode counterpart of train(): the same split and boosting setup, with the Dataset
+    built from the on-disk matrix through StreamedRows instead of an in-memory frame.
+
+    Returns:
+        tuple: (model, test row positions)
+    """
+    print("Splitting data into training and test sets (80% train / 20% test)...")
+    train_rows, test_rows = train_test_split(np.arange(len(y)), test_size=0.2, random_state=42)
+
+    train_params = dict(objective='regression', metric='l2', seed=42, learning_rate=LEARNING_RATE, verbosity=-1)
+    if params:
+        print(f"  Using tuned parameters: {params}")
+        train_params.update(params)
+    train_set = lgb.Dataset([StreamedRows(matrix, train_rows)], label=y[train_rows], feature_name=schema.columns,
+                            categorical_feature=schema.categorical_columns, params=train_params)
+    valid_set = lgb.Dataset([StreamedRows(matrix, test_rows)], label=y[test_rows], reference=train_set)
+
+    print("Starting model training from the streamed Dataset...")
+    start_time = time.time()
+    booster = lgb.train(train_params, train_set, num_boost_round=N_ESTIMATORS, valid_sets=[valid_set],
+                        callbacks=[lgb.early_stopping(stopping_rounds=10, verbose=False)])
+    model = to_regressor(booster, [schema.category_levels[col] for col in schema.categorical_columns], params)
+
+    print(f"\n--- Training Complete ---")
+    print(f"Training took {time.time() - start_time:.2f} seconds.")
+    print(f"Best iteration: {model.best_iteration_}")
+    return model, test_rows
+
+
+def score_streamed(model, matrix, y, rows, batch_rows=DEFAULT_BATCH_ROWS):
+    """R² of the model on the given rows of the on-disk matrix, predicted batch by batch."""
+    rows = np.sort(rows)  # Sequential reads
+    predictions = np.concatenate([model.predict(matrix[rows[start:start + batch_rows]])
+                                  for start in range(0, len(rows), batch_rows)])
+    return r2_score(y[rows], predictions)
+
 
 # 7. Feature Importance with Correlation Analysis
-print(f"\nTop 13 Most Important Features:")
-feature_importance = pd.DataFrame({
-    'feature': X.columns,
-    'split_count': model.feature_importances_,  # How many times used to split
-    'gain': model.booster_.feature_importance(importance_type='gain')  # Total improvement in loss
-})
-
-# Add normalized percentages
-feature_importance['split_pct'] = 100 * feature_importance['split_count'] / feature_importance['split_count'].sum()
-feature_importance['gain_pct'] = 100 * feature_importance['gain'] / feature_importance['gain'].sum()
-
-# Add correlation with target (shows direction of relationship)
-correlations = []
-for feature in feature_importance['feature']:
+def report_feature_importance(model, feature_names, df):
+    print(f"\nTop 13 Most Important Features:")
+    feature_importance = pd.DataFrame({
+        'feature': feature_names,
+        'split_count': model.feature_importances_,  # How many times used to split
+        'gain': model.booster_.feature_importance(importance_type='gain')  # Total improvement in loss
+    })
+
+    # Add normalized percentages
+    feature_importance['split_pct'] = 100 * feature_importance['split_count'] / feature_importance['split_count'].sum()
+    feature_importance['gain_pct'] = 100 * feature_importance['gain'] / feature_importance['gain'].sum()
+
+    # Add correlation with target (shows direction of relationship), every feature in one pass
+    # (0.0 where it is undefined: zero variance, all NaN or non-numeric)
+    feature_importance['correlation'] = column_correlations(
+        numeric_values(df, list(feature_names)), df[TARGET_COLUMN].to_numpy(dtype=np.float64, na_value=np.nan))
+
+    # Sort by gain (usually more meaningful for understanding impact)
+    feature_importance = feature_importance.sort_values('gain', ascending=False)
+
+    print(f"{'Feature':<40} {'Splits':<8} {'Gain %':<9} {'Correlation':<12} {'Impact':<15}")
+    print("-" * 95)
+    for idx, row in feature_importance.head(13).iterrows():
+        corr = row['correlation']
+        # Interpret correlation direction
+        if corr > 0.3:
+            impact = "↑↑ SLOWS page"
+        elif corr > 0.1:
+            impact = "↑ slows page"
+        elif corr > -0.1:
+            impact = "~ neutral"
+        elif corr > -0.3:
+            impact = "↓ speeds up"
+        else:
+            impact = "↓↓ SPEEDS UP"
+
+        # Get friendly name, fallback to original if not found
+        friendly_name = FEATURE_NAME_MAP.get(row['feature'], row['feature'])
+
+        print(f"{friendly_name:<40} {row['split_count']:<8.0f} {row['gain_pct']:<9.2f} {corr:<12.3f} {impact:<15}")
+
+    print("\nNote: Correlation shows LINEAR relationship with SpeedIndex.")
+    print("      Positive = higher values → higher SpeedIndex (slower)")
+    print("      Negative = higher values → lower SpeedIndex (faster)")
+    print("      The model may capture more complex non-linear patterns.")
+
+
+# 8. Save the Trained Model
+def save_model(model, df, row_hashes, lineage, schema, csv_files=None, rebuild_cohorts=True, shap_summary=True,
+               shap_background=False):
+    """
+    Save the model with its lineage and feature schema, the row hashes it was trained on and the aislow.py sidecar.
+
+    Args:
+        model: Trained LGBMRegressor
+        df: All training data (used for the sidecar's benchmarks)
+        row_hashes: uint64 hashes of every row the model has been trained on
+        lineage: dict recorded on the model as `lineage_`
+        schema: FeatureSchema from build_features(), recorded on the model as `schema_`
+        csv_files: Training CSVs, folded into the cohort benchmarks (default: CSV_FILES)
+        rebuild_cohorts: If False, only rows the saved cohort sketches haven't absorbed are added
+        shap_summary: If False, skip the global SHAP summary (TreeSHAP over a sample of pages)
+        shap_background: If True, also save the interventional SHAP background (slow: it explains
+            reference pages against every training row)
+    """
+    model.lineage_ = lineage
+    model.schema_ = schema
+
+    print(f"\nSaving trained model to '{MODEL_FILE_NAME}'...")
+    with stage('save_model'):
+        joblib.dump(model, MODEL_FILE_NAME)
+        np.save(get_row_hashes_path(MODEL_FILE_NAME), np.unique(row_hashes))
+
+    # 9. Save the precomputed sidecar (p25 benchmarks, background stats, etc.) tied to this model
+    print("Saving precomputed artifacts for aislow.py...")
+    with stage('save_artifacts'):
+        artifacts = build_artifacts(model, MODEL_FILE_NAME, df)
+        artifacts_file = save_artifacts(artifacts, MODEL_FILE_NAME)
+    print(f"  Saved '{artifacts_file}'")
+
+    # 10. Export the trees as flat arrays for fast small-batch predictions (what-if scenarios)
+    with stage('export_trees'):
+        trees_file = export_trees(model, MODEL_FILE_NAME)
+    print(f"  Saved '{trees_file}'")
+
+    # 11. Index the fast pages for the report's "Comparable Fast Pages"
+    if all(os.path.exists(csv_file) for csv_file in FAST_CSV_FILES):
+        with stage('neighbor_index'):
+            neighbors_file = build_neighbor_index(model, MODEL_FILE_NAME)
+        print(f"  Saved '{neighbors_file}'")
+    else:
+        print(f"  Skipped the neighbor index (fast CSVs not found: {', '.join(FAST_CSV_FILES)})")
+
+    # 12. Per-cohort percentile tables for the what-if benchmarks (sketches fold in new rows only)
+    with stage('cohort_tables') as record:
+        tables, added = update_cohort_tables(MODEL_FILE_NAME, csv_files,
+                                             feature_names=list(artifacts['percentile_metrics']['p25']),
+                                             rebuild=rebuild_cohorts)
+        record['rows'] = added
+    print(f"  Saved cohort benchmarks: {len(tables.group_keys)} cohorts ({added} pages added to the sketches)")
+
+    # 13. Global SHAP summary (importance, dependence curves, correlations) for dashboards
+    if shap_summary:
+        with stage('shap_summary') as record:
+            summary = build_shap_summary(model, MODEL_FILE_NAME, df, csv_files)
+            summary_file = save_shap_summary(summary, MODEL_FILE_NAME)
+            record['rows'] = summary['sample']['pages']
+        print(f"  Saved '{summary_file}' (SHAP over {summary['sample']['pages']} sampled pages)")
+    elif os.path.exists(get_summary_path(MODEL_FILE_NAME)):
+        print(f"  '{get_summary_path(MODEL_FILE_NAME)}' is now outdated "
+              "(rebuild it with --shap-summary or python shap_summary.py)")
+
+    # 14. Summarized background for interventional SHAP (aislow.py --shap interventional), on request
+    if shap_background:
+        with stage('shap_background') as record:
+            background = build_background(model, MODEL_FILE_NAME, df, csv_files=csv_files)
+            background_file = save_background(background, MODEL_FILE_NAME)
+            record['rows'] = len(df)
+        print(f"  Saved '{background_file}' ({describe_background(background)})")
+    elif os.path.exists(get_background_path(MODEL_FILE_NAME)):
+        print(f"  '{get_background_path(MODEL_FILE_NAME)}' is now outdated "
+              "(rebuild it with --shap-background or python shap_background.py)")
+
+
+def save_target_model(model, target, df, lineage, schema, csv_files=None, shap_summary=True):
+    """
+    Save the model of a secondary target (see multi_target.py) with the sidecars aislow.py
+    needs to explain it. The neighbor index and cohort tables are only built for SpeedIndex.
+
+    Args:
+        model: Trained LGBMRegressor
+        target: Metric the model predicts
+        df: All training data (used for the sidecar's benchmarks)
+        lineage: dict recorded on the model as `lineage_`
+        schema: FeatureSchema from build_features(), recorded on the model as `schema_`
+        csv_files: Training CSVs, sampled for the SHAP summary (default: CSV_FILES)
+        shap_summary: If False, skip the global SHAP summary
+
+    Returns:
+        str: Path of the saved model
+    """
+    model.lineage_ = lineage
+    model.schema_ = schema
+    model_file = get_target_model_path(target, MODEL_FILE_NAME)
+
+    print(f"\nSaving the {target} model to '{model_file}'...")
+    with stage('save_model'):
+        joblib.dump(model, model_file)
+    with stage('save_artifacts'):
+        artifacts_file = save_artifacts(build_artifacts(model, model_file, df, target_column=target), model_file)
+    print(f"  Saved '{artifacts_file}'")
+    with stage('export_trees'):
+        trees_file = export_trees(model, model_file)
+    print(f"  Saved '{trees_file}'")
+    if shap_summary:
+        with stage('shap_summary'):
+            summary_file = save_shap_summary(build_shap_summary(model, model_file, df, csv_files,
+                                                                target_column=target), model_file)
+        print(f"  Saved '{summary_file}'")
+    return model_file
+
+
+def _lineage_entry(mode, csv_files, total_rows, new_rows, model):
+    """One training run for the model's lineage history."""
+    return {
+        'mode': mode,
+        'trained_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'sources': describe_source_files(csv_files or CSV_FILES),
+        'total_rows': int(total_rows),
+        'new_rows': int(new_rows),
+        'num_trees': int(model.booster_.num_trees()),
+        'best_iteration': int(model.best_iteration_),
+    }
+
+
+def load_tuned_params():
+    """Best config from the last --tune run, or None (with an error printed) if there is none."""
+    params = load_best_params(get_tuning_path(MODEL_FILE_NAME))
+    if params is None:
+        print(f"ERROR: No tuning results in '{get_tuning_path(MODEL_FILE_NAME)}'.")
+        print("Run a search first: python train_model.py --tune random")
+    return params
+
+
+def train_from_stream(csv_files=None, batch_rows=DEFAULT_BATCH_ROWS, params=None):
+    """
+    Full training on CSVs read in batches (see stream_training_data and train_streamed):
+    the feature matrix lives in a scratch file under the cache directory while training.
+
+    Returns:
+        tuple: (model, sample DataFrame for the sidecars, row hashes, FeatureSchema)
+    """
+    os.makedirs(CACHE_DIR_NAME, exist_ok=True)
+    fd, matrix_file = tempfile.mkstemp(suffix='.features.f64', dir=CACHE_DIR_NAME)
+    os.close(fd)
     try:
-        corr = df[feature].corr(df[TARGET_COLUMN])
-        # Handle NaN (occurs when feature has zero variance or is all NaN)
-        if pd.isna(corr):
-            corr = 0.0
-    except Exception:
-        corr = 0.0
-    correlations.append(corr)
-feature_importance['correlation'] = correlations
-
-# Sort by gain (usually more meaningful for understanding impact)
-feature_importance = feature_importance.sort_values('gain', ascending=False)
-
-print(f"{'Feature':<40} {'Splits':<8} {'Gain %':<9} {'Correlation':<12} {'Impact':<15}")
-print("-" * 95)
-for idx, row in feature_importance.head(13).iterrows():
-    corr = row['correlation']
-    # Interpret correlation direction
-    if corr > 0.3:
-        impact = "↑↑ SLOWS page"
-    elif corr > 0.1:
-        impact = "↑ slows page"
-    elif corr > -0.1:
-        impact = "~ neutral"
-    elif corr > -0.3:
-        impact = "↓ speeds up"
+        with stage('load_data') as record:
+            matrix, y, row_hashes, schema, df = stream_training_data(matrix_file, csv_files, batch_rows=batch_rows)
+            record['rows'] = len(y)
+        with stage('train', rows=len(y)) as record:
+            model, test_rows = train_streamed(matrix, y, schema, params=params)
+            record['best_iteration'] = int(model.best_iteration_)
+
+        # 6. Evaluate Model Score
+        with stage('evaluate', rows=len(test_rows)) as record:
+            score = score_streamed(model, matrix, y, test_rows, batch_rows=batch_rows)
+            record['r2'] = float(score)
+        print(f"Model R-squared score on test data: {score:.4f}")
+        del matrix
+    finally:
+        os.remove(matrix_file)
+    return model, df, row_hashes, schema
+
+
+def run_full(csv_files=None, use_tuned=False, stream=False, batch_rows=DEFAULT_BATCH_ROWS, compact=False,
+             r2_tolerance=R2_TOLERANCE, shap_summary=True, shap_background=False):
+    """
+    Train from scratch on every row. With stream, the CSVs are read in batches and the
+    model is trained from an on-disk matrix (see train_from_stream). With compact, the saved model is the cheapest compaction
+    within r2_tolerance (see compaction.py). shap_summary and shap_background select the
+    optional SHAP sidecars (see save_model). Returns True once the model is saved.
+    """
+    params = None
+    if use_tuned:
+        params = load_tuned_params()
+        if params is None:
+            return False
+
+    if stream:
+        model, df, row_hashes, schema = train_from_stream(csv_files, batch_rows=batch_rows, params=params)
+        total_rows = len(row_hashes)
     else:
-        impact = "↓↓ SPEEDS UP"
-    
-    # Get friendly name, fallback to original if not found
-    friendly_name = FEATURE_NAME_MAP.get(row['feature'], row['feature'])
-    
-    print(f"{friendly_name:<40} {row['split_count']:<8.0f} {row['gain_pct']:<9.2f} {corr:<12.3f} {impact:<15}")
-
-print("\nNote: Correlation shows LINEAR relationship with SpeedIndex.")
-print("      Positive = higher values → higher SpeedIndex (slower)")
-print("      Negative = higher values → lower SpeedIndex (faster)")
-print("      The model may capture more complex non-linear patterns.")
+        with stage('load_data') as record:
+            df = load_training_data(csv_files)
+            row_hashes = compute_row_hashes(df)
+            record['rows'] = len(df)
+        with stage('build_features'):
+            X, y, schema = build_features(df)
+        with stage('train', rows=len(X)) as record:
+            model, X_test, y_test = train(X, y, schema.categorical_columns, params=params)
+            record['best_iteration'] = int(model.best_iteration_)
+
+        # 6. Evaluate Model Score
+        with stage('evaluate', rows=len(X_test)) as record:
+            score = model.score(X_test, y_test)
+            record['r2'] = float(score)
+        print(f"Model R-squared score on test data: {score:.4f}")
+        total_rows = len(df)
+
+    with stage('feature_importance'):
+        report_feature_importance(model, schema.columns, df)
+
+    compaction = None
+    if compact:
+        print("\nCompacting the model...")
+        with stage('compaction') as record:
+            model, compaction = compact_model(model, X, y, schema.categorical_columns, r2_tolerance)
+            record['chosen'] = compaction['chosen']
+        print_compaction_report(compaction)
+
+    entry = _lineage_entry('full', csv_files, total_rows, total_rows, model)
+    if compaction is not None:
+        entry['compaction'] = compaction
+    save_model(model, df, row_hashes, {'history': [entry]}, schema, csv_files, shap_summary=shap_summary,
+               shap_background=shap_background)
+    return True
+
+
+def run_incremental(csv_files=None, rounds=INCREMENTAL_ROUNDS, shap_summary=False, shap_background=False):
+    """
+    Continue boosting the saved model on rows it hasn't been trained on yet.
+
+    New rows are found by hashing every row (new pages, and pages whose data changed).
+    Training time scales with the number of new rows, not the whole history, so the
+    SHAP sidecars that scan every row are off unless asked for.
+    Returns True if a new model was saved.
+    """
+    try:
+        previous_model = joblib.load(MODEL_FILE_NAME)
+        known_hashes = np.load(get_row_hashes_path(MODEL_FILE_NAME))
+    except FileNotFoundError as e:
+        print(f"ERROR: Incremental training needs an existing model and its row hashes ({e.filename}).")
+        print("Run a full training first: python train_model.py")
+        return False
+
+    with stage('load_data') as record:
+        df = load_training_data(csv_files)
+        row_hashes = compute_row_hashes(df)
+        record['rows'] = len(df)
+    is_new = ~np.isin(row_hashes, known_hashes)
+    df_new = df[is_new]
+    print(f"\nFound {len(df_new)} new or changed rows (out of {len(df)})")
+    if len(df_new) < MIN_INCREMENTAL_ROWS:
+        print(f"Fewer than {MIN_INCREMENTAL_ROWS} new rows, nothing worth boosting on. Model unchanged.")
+        return False
+
+    # Keep the init model's category codes stable; new levels are appended
+    previous_schema = get_schema(previous_model)
+    with stage('build_features'):
+        X_new, y_new, schema = build_features(df_new, category_levels=previous_schema.category_levels)
+        X_new = X_new[previous_schema.columns]
+        schema = FeatureSchema(previous_schema.columns, schema.category_levels)
+
+    trees_before = previous_model.booster_.num_trees()
+    with stage('train', rows=len(X_new)) as record:
+        model, X_test, y_test = train(X_new, y_new, schema.categorical_columns,
+                                      n_estimators=rounds, init_model=previous_model.booster_)
+        record['best_iteration'] = int(model.best_iteration_)
+    print(f"Trees: {trees_before} -> {model.booster_.num_trees()}")
+
+    # 6. Evaluate Model Score (held-out new rows, and a sample of everything for regressions)
+    with stage('evaluate') as record:
+        record['r2'] = float(model.score(X_test, y_test))
+        print(f"Model R-squared score on held-out new rows: {record['r2']:.4f}")
+        X_all, y_all, _ = build_features(df.sample(min(len(df), 5000), random_state=42),
+                                         category_levels=schema.category_levels)
+        X_all = X_all[schema.columns]
+        print(f"R-squared on a sample of all rows: before {previous_model.score(X_all, y_all):.4f}, after {model.score(X_all, y_all):.4f}")
+
+    history = list(getattr(previous_model, 'lineage_', {}).get('history', []))
+    lineage = {'history': history + [_lineage_entry('incremental', csv_files, len(df), len(df_new), model)]}
+    save_model(model, df, np.concatenate([known_hashes, row_hashes[is_new]]), lineage, schema, csv_files,
+               rebuild_cohorts=False, shap_summary=shap_summary, shap_background=shap_background)
+    return True
+
+
+def run_multi(csv_files=None, targets=DEFAULT_TARGETS, use_tuned=False, workers=None, shap_summary=True,
+              shap_background=False):
+    """
+    Train one model per target from a single feature matrix and binned Dataset (see multi_target.py).
+
+    The primary target (SpeedIndex) replaces the main model, with every sidecar; the others are
+    saved next to it. All of them are listed in the bundle manifest aislow.py --target reads.
+    shap_summary applies to every target, shap_background to the primary model (see save_model).
+    Returns True once the models are saved.
+    """
+    params = None
+    if use_tuned:
+        params = load_tuned_params()
+        if params is None:
+            return False
+
+    with stage('load_data') as record:
+        df = load_training_data(csv_files)
+        row_hashes = compute_row_hashes(df)
+        record['rows'] = len(df)
+    with stage('build_features'):
+        X, y, schema = build_features(df)
+
+    labels = {}
+    for target in dict.fromkeys(targets):
+        if target not in df.columns:
+            print(f"  Skipping '{target}': not a column of the training data")
+            continue
+        values = pd.to_numeric(df[target], errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+        measured = int(np.count_nonzero(~np.isnan(values)))
+        if measured < MIN_TARGET_ROWS:
+            print(f"  Skipping '{target}': only {measured} pages have a value (need {MIN_TARGET_ROWS})")
+            continue
+        labels[target] = values
+    if not labels:
+        print("ERROR: None of the targets has enough measured pages to train on.")
+        return False
+
+    print("\nBuilding the binned LightGBM Dataset (shared by every target)...")
+    with stage('build_dataset', rows=len(X)):
+        dataset_path = get_dataset_path(row_hashes, list(X.columns))
+        dataset = build_dataset(X, y, schema.categorical_columns, dataset_path, verbose=True)
+
+    workers = workers or min(len(labels), os.cpu_count() or 1)
+    print(f"\nTraining {len(labels)} target(s) with {workers} worker(s)...")
+    with stage('train', rows=len(X)) as record:
+        results = train_targets(dataset, dataset_path, labels, params=params, workers=workers)
+        record['targets'] = len(results)
+
+    entries = {}
+    for target, result in results.items():
+        model = to_regressor(result['booster'], dataset.pandas_categorical, params)
+        valid_rows = result['valid_rows']
+        with stage('evaluate', rows=len(valid_rows)) as record:
+            score = model.score(X.iloc[valid_rows], labels[target][valid_rows])
+            record['r2'] = float(score)
+        print(f"\n{target} model R-squared score on test data: {score:.4f}")
+
+        entry = _lineage_entry('multi-target', csv_files, len(df), len(df), model)
+        entry['target'] = target
+        lineage = {'history': [entry]}
+        if target == PRIMARY_TARGET:
+            with stage('feature_importance'):
+                report_feature_importance(model, X.columns, df)
+            save_model(model, df, row_hashes, lineage, schema, csv_files, shap_summary=shap_summary,
+                       shap_background=shap_background)
+            model_file = MODEL_FILE_NAME
+        else:
+            model_file = save_target_model(model, target, df, lineage, schema, csv_files, shap_summary=shap_summary)
+        entries[target] = {'model_file': os.path.basename(model_file), 'rows': len(result['train_rows']) + len(valid_rows),
+                           'r2': float(score), 'trained_at': entry['trained_at']}
+
+    bundle_file = save_bundle(entries, MODEL_FILE_NAME)
+    print(f"\nSaved the model bundle '{bundle_file}' (targets: {', '.join(load_bundle(MODEL_FILE_NAME))})")
+    return True
+
+
+def run_tune(csv_files=None, strategy='random', n_trials=DEFAULT_RANDOM_TRIALS, n_folds=DEFAULT_FOLDS, workers=1):
+    """
+    Cross-validated hyperparameter search. The binned Dataset is built once and shared by
+    every trial through a binary file. Saves the results; the model itself is left unchanged.
+    """
+    with stage('load_data') as record:
+        df = load_training_data(csv_files)
+        record['rows'] = len(df)
+    with stage('build_features'):
+        X, y, schema = build_features(df)
+
+    print("\nBuilding the binned LightGBM Dataset (shared by every trial)...")
+    with stage('build_dataset', rows=len(X)):
+        dataset_path = get_dataset_path(compute_row_hashes(df), list(X.columns))
+        dataset = build_dataset(X, y, schema.categorical_columns, dataset_path, verbose=True)
+
+    with stage('search') as record:
+        results = search(dataset, dataset_path, strategy=strategy, n_trials=n_trials,
+                         n_folds=n_folds, workers=workers)
+        record['trials'] = len(results['trials'])
+    print_search_report(results)
+    results_file = save_search_results(results, get_tuning_path(MODEL_FILE_NAME))
+    print(f"\nSaved search results to '{results_file}'")
+    print("Train with the best config: python train_model.py --tuned")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    telemetry = reset_telemetry()
+    if args.format == 'json':
+        # stdout carries only the JSON document; the training log goes to stderr
+        json_out = sys.stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            mode, saved = run(args)
+        json.dump({'mode': mode, 'saved': saved, 'telemetry': telemetry.to_dict()}, json_out, indent=1)
+        json_out.write('\n')
+        return
+
+    run(args)
+    print_stage_timings(telemetry)
+
+
+def run(args):
+    """Run the command selected by the arguments. Returns (mode, whether a model was saved)."""
+    if args.tune:
+        print(f"Starting hyperparameter search...")
+        run_tune(args.csv, strategy=args.tune, n_trials=args.trials, n_folds=args.folds, workers=args.workers or 1)
+        return 'tune', False
+    print(f"Starting model training process...")
+    if args.targets is not None:
+        mode = 'multi-target'
+        saved = run_multi(args.csv, targets=args.targets or DEFAULT_TARGETS, use_tuned=args.tuned,
+                          workers=args.workers, shap_summary=args.shap_summary is not False,
+                          shap_background=args.shap_background)
+    elif args.incremental:
+        mode = 'incremental'
+        saved = run_incremental(args.csv, rounds=args.rounds, shap_summary=bool(args.shap_summary),
+                                shap_background=args.shap_background)
+    else:
+        mode = 'full'
+        saved = run_full(args.csv, use_tuned=args.tuned, stream=args.stream, batch_rows=args.batch_rows,
+                         compact=args.compact, r2_tolerance=args.r2_tolerance,
+                         shap_summary=args.shap_summary is not False, shap_background=args.shap_background)
+    if saved:
+        print("---")
+        print("Success! Trained model saved.")
+    return mode, saved
 
-# 8. Save the Trained Model
-print(f"\nSaving trained model to '{MODEL_FILE_NAME}'...")
-joblib.dump(model, MODEL_FILE_NAME)
 
-print("---")
-print("Success! Trained model saved.")
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,309 @@
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+from feature_schema import FeatureSchema, get_schema
+
+# Flattened tree ensemble for fast predictions without the LightGBM/sklearn wrapper
+# The booster is exported once into contiguous NumPy arrays (one entry per split node, one per
+# leaf); predict() walks every row through every tree at once, one tree level per step.
+#
+# Child pointers: a value >= 0 is the next split node, a negative value v is leaf ~v.
+# Decisions follow LightGBM's Tree::NumericalDecision / Tree::CategoricalDecision.
+
+MODEL_FILE_NAME = 'aislow_desktop.pkl'
+MISSING_NONE, MISSING_ZERO, MISSING_NAN = 0, 1, 2
+MISSING_TYPES = {'None': MISSING_NONE, 'Zero': MISSING_ZERO, 'NaN': MISSING_NAN}
+K_ZERO_THRESHOLD = 1e-35  # LightGBM's kZeroThreshold
+
+
+def get_trees_path(model_file=MODEL_FILE_NAME):
+    """Exported trees next to the model, e.g. aislow_desktop.pkl -> aislow_desktop.trees.npz"""
+    return os.path.splitext(model_file)[0] + '.trees.npz'
+
+
+class FlatTreeEnsemble:
+    """
+    Tree ensemble stored as flat arrays, with a vectorized predict().
+
+    Args:
+        arrays: dict of node/leaf arrays (see from_model())
+        feature_names: Model feature names in training order
+        category_levels: dict feature -> category levels (LightGBM's pandas_categorical)
+    """
+
+    ARRAY_NAMES = ('roots', 'split_feature', 'threshold', 'default_left', 'missing_type',
+                   'cat_index', 'cat_boundaries', 'cat_bitset', 'left_child', 'right_child', 'leaf_value')
+
+    def __init__(self, arrays, feature_names, category_levels):
+        for name in self.ARRAY_NAMES:
+            setattr(self, name, np.ascontiguousarray(arrays[name]))
+        self.schema = FeatureSchema(feature_names, category_levels)
+        self.feature_names = self.schema.columns
+        self.category_levels = self.schema.category_levels
+        self.children = np.column_stack([self.left_child, self.right_child]).ravel()
+
+        # Where a NaN goes at each split: the default child for NaN-aware splits, otherwise
+        # LightGBM treats it as 0.0 (and a 0.0 at a Zero-missing split takes the default child)
+        is_numeric = self.cat_index < 0
+        nan_as_zero_left = np.where(self.missing_type == MISSING_ZERO, self.default_left, 0.0 <= self.threshold)
+        self.nan_left = np.where(is_numeric & (self.missing_type == MISSING_NAN), self.default_left,
+                                 is_numeric & nan_as_zero_left)
+        self.has_zero_missing = bool(np.any(is_numeric & (self.missing_type == MISSING_ZERO)))
+        self.has_categorical = bool(np.any(~is_numeric))
+
+    @classmethod
+    def from_model(cls, model):
+        """
+        Flatten a trained LGBMRegressor (up to its best iteration).
+
+        Args:
+            model: Trained LGBMRegressor
+
+        Returns:
+            FlatTreeEnsemble
+        """
+        num_iteration = model.best_iteration_ or None
+        dump = model.booster_.dump_model(num_iteration=num_iteration)
+        nodes = {name: [] for name in ('split_feature', 'threshold', 'default_left', 'missing_type',
+                                       'cat_index', 'left_child', 'right_child')}
+        cat_boundaries, cat_bitset, leaf_values, roots = [0], [], [], []
+
+        def add(node):
+            """Append a subtree, returning its pointer (node index, or ~leaf index)."""
+            if 'split_index' not in node:
+                leaf_values.append(node['leaf_value'])
+                return ~(len(leaf_values) - 1)
+            index = len(nodes['split_feature'])
+            nodes['split_feature'].append(node['split_feature'])
+            nodes['default_left'].append(node['default_left'])
+            nodes['missing_type'].append(MISSING_TYPES[node['missing_type']])
+            if node['decision_type'] == '==':
+                categories = [int(c) for c in str(node['threshold']).split('||')]
+                words = np.zeros(max(categories) // 32 + 1, dtype=np.uint32)
+                for c in categories:
+                    words[c // 32] |= np.uint32(1 << (c % 32))
+                nodes['cat_index'].append(len(cat_boundaries) - 1)
+                nodes['threshold'].append(np.nan)
+                cat_bitset.extend(words)
+                cat_boundaries.append(len(cat_bitset))
+            else:
+                nodes['cat_index'].append(-1)
+                nodes['threshold'].append(node['threshold'])
+            nodes['left_child'].append(0)
+            nodes['right_child'].append(0)
+            nodes['left_child'][index] = add(node['left_child'])
+            nodes['right_child'][index] = add(node['right_child'])
+            return index
+
+        for tree in dump['tree_info']:
+            roots.append(add(tree['tree_structure']))
+
+        arrays = {
+            'roots': np.array(roots, dtype=np.int32),
+            'split_feature': np.array(nodes['split_feature'], dtype=np.int32),
+            'threshold': np.array(nodes['threshold'], dtype=np.float64),
+            'default_left': np.array(nodes['default_left'], dtype=bool),
+            'missing_type': np.array(nodes['missing_type'], dtype=np.int8),
+            'cat_index': np.array(nodes['cat_index'], dtype=np.int32),
+            'cat_boundaries': np.array(cat_boundaries, dtype=np.int64),
+            'cat_bitset': np.array(cat_bitset, dtype=np.uint32),
+            'left_child': np.array(nodes['left_child'], dtype=np.int32),
+            'right_child': np.array(nodes['right_child'], dtype=np.int32),
+            'leaf_value': np.array(leaf_values, dtype=np.float64),
+        }
+        return cls(arrays, dump['feature_names'], get_schema(model).category_levels)
+
+    def save(self, path, model_sha256=None):
+        """Write the arrays to an .npz file, tagged with the model's hash."""
+        from model_artifacts import json_default
+
+        meta = {'feature_names': self.feature_names, 'category_levels': self.category_levels,
+                'model_sha256': model_sha256}
+        np.savez(path, meta=np.array(json.dumps(meta, default=json_default)),
+                 **{name: getattr(self, name) for name in self.ARRAY_NAMES})
+        return path
+
+    @classmethod
+    def load(cls, path, model_sha256=None):
+        """
+        Load exported trees, rejecting them if they were built for a different model.
+
+        Returns:
+            FlatTreeEnsemble or None
+        """
+        try:
+            with np.load(path) as data:
+                meta = json.loads(str(data['meta']))
+                arrays = {name: data[name] for name in cls.ARRAY_NAMES}
+        except (FileNotFoundError, KeyError, ValueError):
+            return None
+        if model_sha256 is not None and meta.get('model_sha256') != model_sha256:
+            return None
+        return cls(arrays, meta['feature_names'], meta['category_levels'])
+
+    def to_matrix(self, X):
+        """
+        Encode features the way LightGBM sees them (see FeatureSchema.to_matrix).
+
+        Args:
+            X: DataFrame with the model's features (any column order), or an already
+               encoded 2-D array in feature order
+
+        Returns:
+            np.ndarray: C-contiguous (n_rows, n_features) float64 matrix
+        """
+        if not isinstance(X, pd.DataFrame):
+            return np.ascontiguousarray(X, dtype=np.float64)
+        return self.schema.to_matrix(X)
+
+    def encode_values(self, col, values):
+        """Encode raw values of one feature (e.g. what-if targets) like to_matrix() does."""
+        return self.schema.encode_values(col, values)
+
+    def _go_left(self, nodes, values):
+        """Vectorized split decisions for (node, feature value) pairs."""
+        with np.errstate(invalid='ignore'):
+            go_left = values <= self.threshold[nodes]
+        is_nan = np.isnan(values)
+        if is_nan.any():
+            go_left[is_nan] = self.nan_left[nodes[is_nan]]
+        if self.has_zero_missing:
+            is_zero = (np.abs(values) <= K_ZERO_THRESHOLD) & (self.missing_type[nodes] == MISSING_ZERO)
+            go_left[is_zero] = self.default_left[nodes[is_zero]]
+
+        cat_nodes = np.flatnonzero(self.cat_index[nodes] >= 0) if self.has_categorical else ()
+        if len(cat_nodes):
+            cat = self.cat_index[nodes[cat_nodes]]
+            cat_values = values[cat_nodes]
+            valid = ~np.isnan(cat_values) & (cat_values >= 0)
+            codes = np.where(valid, cat_values, 0).astype(np.int64)
+            word = self.cat_boundaries[cat] + codes // 32
+            in_range = valid & (word < self.cat_boundaries[cat + 1])
+            bits = self.cat_bitset[np.where(in_range, word, 0)] >> (codes % 32).astype(np.uint32)
+            go_left[cat_nodes] = in_range & (bits & 1).astype(bool)
+        return go_left
+
+    def predict(self, X):
+        """
+        Predict every row with all trees at once.
+
+        Args:
+            X: DataFrame of model features, or an encoded matrix from to_matrix()
+
+        Returns:
+            np.ndarray: Prediction per row
+        """
+        matrix = self.to_matrix(X)
+        n_rows, n_trees = len(matrix), len(self.roots)
+        flat_matrix = matrix.ravel()
+        pointers = np.tile(self.roots, n_rows)  # row-major: row i, tree t at i * n_trees + t
+        row_offsets = np.repeat(np.arange(n_rows) * matrix.shape[1], n_trees)
+        active = np.flatnonzero(pointers >= 0)
+        while active.size:
+            nodes = pointers[active]
+            values = flat_matrix[row_offsets[active] + self.split_feature[nodes]]
+            # children holds (left, right) pairs: index 2 * node + 1 when going right
+            next_pointers = self.children[2 * nodes + ~self._go_left(nodes, values)]
+            pointers[active] = next_pointers
+            active = active[next_pointers >= 0]
+        return self.leaf_value[~pointers].reshape(n_rows, n_trees).sum(axis=1)
+
+
+def export_trees(model, model_file=MODEL_FILE_NAME):
+    """
+    Flatten a model and save it next to its model file.
+
+    Args:
+        model: Trained LGBMRegressor
+        model_file: Path of the saved model (hashed to tie the export to it)
+
+    Returns:
+        str: Path of the .npz file
+    """
+    from model_artifacts import hash_file
+    return FlatTreeEnsemble.from_model(model).save(get_trees_path(model_file), hash_file(model_file))
+
+
+def load_flat_model(model_file=MODEL_FILE_NAME):
+    """
+    Load the exported trees of a model file.
+
+    Returns:
+        FlatTreeEnsemble or None: None if there is no export or it belongs to another model
+            (flattening on the fly costs more than it saves for a single page)
+    """
+    from model_artifacts import hash_file
+    return FlatTreeEnsemble.load(get_trees_path(model_file), hash_file(model_file))
+
+
+def _best_time(func, repeats):
+    """Fastest of several runs, in seconds."""
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def benchmark(model, flat_model, X, repeats=20):
+    """
+    Compare LGBMRegressor.predict with the flat predictor on one row and on all of X.
+
+    Args:
+        model: Trained LGBMRegressor
+        flat_model: FlatTreeEnsemble of the same model
+        X: Model-ready feature DataFrame
+        repeats: Runs per measurement (the fastest is reported)
+
+    Returns:
+        dict: Max absolute difference and timings per case
+    """
+    max_abs_diff = float(np.max(np.abs(model.predict(X) - flat_model.predict(X))))
+    results = {'rows': len(X), 'max_abs_diff': max_abs_diff, 'cases': {}}
+    for label, X_case in (('1 row', X.head(1)), (f"{len(X)} rows", X)):
+        matrix = flat_model.to_matrix(X_case)
+        results['cases'][label] = {
+            'lightgbm': _best_time(lambda: model.predict(X_case), repeats),
+            'flat': _best_time(lambda: flat_model.predict(X_case), repeats),
+            'flat_encoded': _best_time(lambda: flat_model.predict(matrix), repeats),
+        }
+    return results
+
+
+if __name__ == '__main__':
+    # Benchmark the exported trees of the current model against LightGBM. Read-only unless
+    # --export: without a current export the model is flattened in memory
+    import argparse
+    import joblib
+    from data_loader import load_and_concat_csvs
+    from batch_explain import prepare_features
+
+    parser = argparse.ArgumentParser(description='Benchmark the flat tree predictor against LightGBM.')
+    parser.add_argument('--export', action='store_true',
+                        help=f"(Re)write '{get_trees_path(MODEL_FILE_NAME)}' from the current model first")
+    args = parser.parse_args()
+
+    model = joblib.load(MODEL_FILE_NAME)
+    if args.export:
+        print(f"Saved '{export_trees(model, MODEL_FILE_NAME)}'")
+    flat_model = load_flat_model(MODEL_FILE_NAME)
+    if flat_model is None:
+        flat_model = FlatTreeEnsemble.from_model(model)
+        source = f"flattened in memory ('{get_trees_path(MODEL_FILE_NAME)}' is missing or outdated)"
+    else:
+        source = f"loaded from '{get_trees_path(MODEL_FILE_NAME)}'"
+    print(f"{len(flat_model.roots)} trees ({len(flat_model.split_feature)} splits, "
+          f"{len(flat_model.leaf_value)} leaves) {source}")
+
+    df = load_and_concat_csvs(remove_duplicates=True)
+    X = prepare_features(df.sample(min(len(df), 10000), random_state=42), get_schema(model))
+    results = benchmark(model, flat_model, X)
+    print(f"\nMax |LightGBM - flat| over {results['rows']} rows: {results['max_abs_diff']:.3g} ms")
+    print(f"\n{'Case':<12} {'LightGBM':>12} {'Flat':>12} {'Flat (encoded)':>16} {'Speedup':>9}")
+    print("-" * 65)
+    for label, timing in results['cases'].items():
+        print(f"{label:<12} {timing['lightgbm'] * 1000:>10.3f}ms {timing['flat'] * 1000:>10.3f}ms "
+              f"{timing['flat_encoded'] * 1000:>14.3f}ms {timing['lightgbm'] / timing['flat']:>8.1f}x")
@@ -0,0 +1,281 @@
+import hashlib
+import itertools
+import json
+import math
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import lightgbm as lgb
+from data_loader import CACHE_DIR_NAME
+
+# Hyperparameter search used by `train_model.py --tune`
+# The binned lgb.Dataset is constructed once and saved as a LightGBM binary file; every trial
+# (in this process or in a pool worker) reuses it, so CSV -> histogram binning never repeats.
+# Only parameters that don't change the binning can be searched (max_bin etc. are fixed).
+
+SEARCH_STRATEGIES = ('grid', 'random', 'halving')
+DEFAULT_FOLDS = 5
+DEFAULT_RANDOM_TRIALS = 20
+MAX_ROUNDS = 500              # Boosting rounds per trial (early stopping usually ends sooner)
+EARLY_STOPPING_ROUNDS = 10
+HALVING_MIN_ROUNDS = 50       # Budget of the first successive-halving rung
+HALVING_ETA = 3               # Keep 1/eta of the configs per rung, multiply their budget by eta
+SEED = 42
+
+# sklearn-style names so the best config can be passed straight to LGBMRegressor
+PARAM_GRID = {
+    'learning_rate': [0.03, 0.05, 0.1],
+    'num_leaves': [15, 31, 63],
+    'min_child_samples': [10, 20, 50],
+    'colsample_bytree': [0.8, 1.0],
+    'reg_lambda': [0.0, 1.0],
+}
+
+# Shared by every trial; feature_pre_filter=False lets min_child_samples vary on one Dataset
+BASE_PARAMS = {
+    'objective': 'regression',
+    'metric': 'l2',
+    'verbosity': -1,
+    'seed': SEED,
+}
+DATASET_PARAMS = {'verbosity': -1, 'feature_pre_filter': False}
+
+# Per-worker state, set by _init_worker
+_worker_dataset = None
+
+
+def get_tuning_path(model_file):
+    """Search results saved next to the model, e.g. aislow_desktop.pkl -> aislow_desktop.tuning.json"""
+    return os.path.splitext(model_file)[0] + '.tuning.json'
+
+
+def get_dataset_path(row_hashes, columns):
+    """
+    Binary Dataset path, content-addressed by the training rows and feature columns.
+
+    Args:
+        row_hashes: uint64 hash per training row (data_loader.compute_row_hashes)
+        columns: Feature names in training order
+
+    Returns:
+        str: Path inside the .aislow_cache directory
+    """
+    sha = hashlib.sha256(np.ascontiguousarray(row_hashes).tobytes())
+    sha.update('\0'.join(columns).encode('utf-8'))
+    return os.path.join(CACHE_DIR_NAME, f"train_{sha.hexdigest()[:16]}.bin")
+
+
+def build_dataset(X, y, categorical_features, dataset_path, verbose=False):
+    """
+    Construct the binned Dataset once and save it as a binary file for the trials.
+
+    Args:
+        X: Feature DataFrame (categorical columns already converted)
+        y: Target series
+        categorical_features: Categorical feature names
+        dataset_path: Binary file to write (reused as-is if it already exists)
+        verbose: If True, print construction timing
+
+    Returns:
+        lgb.Dataset: Constructed Dataset (raw data kept, free_raw_data=False)
+    """
+    start = time.perf_counter()
+    dataset = lgb.Dataset(X, y, categorical_feature=categorical_features,
+                          free_raw_data=False, params=DATASET_PARAMS).construct()
+    if not os.path.exists(dataset_path):
+        os.makedirs(os.path.dirname(dataset_path) or '.', exist_ok=True)
+        tmp_path = f"{dataset_path}.{os.getpid()}.tmp"
+        dataset.save_binary(tmp_path)
+        os.replace(tmp_path, dataset_path)
+        if verbose:
+            print(f"  Saved binned Dataset to '{dataset_path}'")
+        # Binaries of earlier training data are never read again
+        for name in os.listdir(os.path.dirname(dataset_path) or '.'):
+            if name.startswith('train_') and name.endswith('.bin') and name != os.path.basename(dataset_path):
+                os.remove(os.path.join(os.path.dirname(dataset_path), name))
+    if verbose:
+        print(f"  Dataset constructed in {time.perf_counter() - start:.2f}s")
+    return dataset
+
+
+def grid_configs():
+    """Every combination in PARAM_GRID."""
+    names = list(PARAM_GRID)
+    return [dict(zip(names, values)) for values in itertools.product(*PARAM_GRID.values())]
+
+
+def random_configs(n_trials, seed=SEED):
+    """n_trials distinct combinations sampled from PARAM_GRID."""
+    configs = grid_configs()
+    return random.Random(seed).sample(configs, min(n_trials, len(configs)))
+
+
+def run_trial(dataset, params, n_folds, num_boost_round, num_threads):
+    """
+    K-fold cross-validate one config.
+
+    Args:
+        dataset: Constructed lgb.Dataset
+        params: Config to evaluate (merged over BASE_PARAMS)
+        n_folds: Number of CV folds
+        num_boost_round: Most boosting rounds
+        num_threads: LightGBM threads for this trial
+
+    Returns:
+        dict: cv_rmse, cv_rmse_std, best_iteration and seconds
+    """
+    start = time.perf_counter()
+    results = lgb.cv(
+        dict(BASE_PARAMS, num_threads=num_threads, **params),
+        dataset,
+        num_boost_round=num_boost_round,
+        nfold=n_folds,
+        stratified=False,
+        seed=SEED,
+        callbacks=[lgb.early_stopping(stopping_rounds=EARLY_STOPPING_ROUNDS, verbose=False)],
+    )
+    l2_mean = results['valid l2-mean']
+    l2_std = results['valid l2-stdv']
+    rmse = math.sqrt(l2_mean[-1])
+    return {
+        'cv_rmse': float(rmse),
+        'cv_rmse_std': float(l2_std[-1] / (2 * rmse)),  # Spread of the fold MSEs, on the RMSE scale
+        'best_iteration': len(l2_mean),
+        'seconds': time.perf_counter() - start,
+    }
+
+
+def _init_worker(dataset_path):
+    """Pool initializer: load the binary Dataset once per worker process."""
+    global _worker_dataset
+    _worker_dataset = lgb.Dataset(dataset_path, params=DATASET_PARAMS).construct()
+
+
+def _run_trial_in_worker(params, n_folds, num_boost_round, num_threads):
+    return run_trial(_worker_dataset, params, n_folds, num_boost_round, num_threads)
+
+
+def _run_rung(configs, num_boost_round, dataset, dataset_path, n_folds, workers, rung, trial_offset, verbose):
+    """Evaluate a list of configs at one budget, serially or in a process pool."""
+    num_threads = max(1, (os.cpu_count() or 1) // workers)
+    if workers > 1 and len(configs) > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(dataset_path,)) as executor:
+            futures = [executor.submit(_run_trial_in_worker, params, n_folds, num_boost_round, num_threads)
+                       for params in configs]
+            outcomes = [future.result() for future in futures]
+    else:
+        outcomes = [run_trial(dataset, params, n_folds, num_boost_round, num_threads) for params in configs]
+
+    trials = []
+    for i, (params, outcome) in enumerate(zip(configs, outcomes)):
+        trial = dict(trial=trial_offset + i + 1, rung=rung, rounds=num_boost_round, params=params, **outcome)
+        trials.append(trial)
+        if verbose:
+            print(f"  Trial {trial['trial']:>3} (rung {rung}, {num_boost_round} rounds): "
+                  f"RMSE {trial['cv_rmse']:8.1f} ms, {trial['best_iteration']:>3} iters, "
+                  f"{trial['seconds']:6.2f}s  {_format_params(params)}")
+    return trials
+
+
+def _format_params(params):
+    return ', '.join(f"{name}={value}" for name, value in params.items())
+
+
+def search(dataset, dataset_path, strategy='random', n_trials=DEFAULT_RANDOM_TRIALS, n_folds=DEFAULT_FOLDS,
+           workers=1, max_rounds=MAX_ROUNDS, verbose=True):
+    """
+    Run a hyperparameter search over PARAM_GRID with K-fold cross-validation.
+
+    'grid' tries every combination, 'random' samples n_trials of them, and 'halving' starts
+    n_trials sampled configs at HALVING_MIN_ROUNDS rounds, keeping the best 1/HALVING_ETA
+    for each next rung with HALVING_ETA times the budget, until max_rounds.
+
+    Args:
+        dataset: Constructed lgb.Dataset (used by in-process trials)
+        dataset_path: Its binary file (loaded by pool workers)
+        strategy: One of SEARCH_STRATEGIES
+        n_trials: Configs sampled by 'random' and 'halving'
+        n_folds: Number of CV folds
+        workers: Trials run in parallel (1 = in this process)
+        max_rounds: Most boosting rounds per trial
+        verbose: If True, print every trial as it finishes
+
+    Returns:
+        dict: strategy, folds, seconds, best (trial) and trials (all, in run order)
+    """
+    if strategy not in SEARCH_STRATEGIES:
+        raise ValueError(f"Unknown search strategy '{strategy}', expected one of {SEARCH_STRATEGIES}")
+
+    start = time.perf_counter()
+    configs = grid_configs() if strategy == 'grid' else random_configs(n_trials)
+    if verbose:
+        print(f"Searching {len(configs)} configs ({strategy}, {n_folds}-fold CV, {workers} worker(s))...")
+
+    trials = []
+    if strategy == 'halving':
+        rung, budget = 0, min(HALVING_MIN_ROUNDS, max_rounds)
+        while True:
+            rung_trials = _run_rung(configs, budget, dataset, dataset_path, n_folds, workers,
+                                    rung, len(trials), verbose)
+            trials += rung_trials
+            if len(configs) <= 1 or budget >= max_rounds:
+                break
+            survivors = sorted(rung_trials, key=lambda t: t['cv_rmse'])[:max(1, len(configs) // HALVING_ETA)]
+            configs = [t['params'] for t in survivors]
+            rung, budget = rung + 1, min(budget * HALVING_ETA, max_rounds)
+        candidates = rung_trials
+    else:
+        trials = _run_rung(configs, max_rounds, dataset, dataset_path, n_folds, workers, 0, 0, verbose)
+        candidates = trials
+
+    return {
+        'strategy': strategy,
+        'folds': n_folds,
+        'seconds': time.perf_counter() - start,
+        'best': min(candidates, key=lambda t: t['cv_rmse']),
+        'trials': trials,
+    }
+
+
+def print_search_report(results, top=10):
+    """Print the best trials, per-trial timing summary and the winning config."""
+    trials = results['trials']
+    final_rung = max(t['rung'] for t in trials)
+    ranked = sorted((t for t in trials if t['rung'] == final_rung), key=lambda t: t['cv_rmse'])
+
+    print(f"\n--- Hyperparameter Search ({results['strategy']}, {results['folds']}-fold CV) ---")
+    print(f"{'Trial':<7} {'RMSE (ms)':<12} {'± std':<9} {'Iters':<7} {'Time (s)':<10} Params")
+    print("-" * 95)
+    for t in ranked[:top]:
+        print(f"{t['trial']:<7} {t['cv_rmse']:<12.1f} {t['cv_rmse_std']:<9.1f} {t['best_iteration']:<7} "
+              f"{t['seconds']:<10.2f} {_format_params(t['params'])}")
+
+    seconds = [t['seconds'] for t in trials]
+    print(f"\n{len(trials)} trials in {results['seconds']:.1f}s wall time "
+          f"(trial time: total {sum(seconds):.1f}s, mean {np.mean(seconds):.2f}s, max {max(seconds):.2f}s)")
+    best = results['best']
+    print(f"Best config (trial {best['trial']}, CV RMSE {best['cv_rmse']:.1f} ms): {_format_params(best['params'])}")
+
+
+def save_search_results(results, path):
+    """Write the search results as JSON. Returns the path."""
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=1)
+    return path
+
+
+def load_best_params(path):
+    """
+    Best config from a saved search.
+
+    Returns:
+        dict or None: Params for LGBMRegressor, or None if there is no usable results file
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)['best']['params']
+    except (FileNotFoundError, ValueError, KeyError):
+        return None
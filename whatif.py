@@ -0,0 +1,226 @@
+import itertools
+import numpy as np
+import pandas as pd
+from model_config import WHAT_IF_CATEGORICAL_OPTIONS
+
+# Vectorized "what-if" optimizer
+# Builds every candidate scenario for a chunk of pages into one matrix and scores it with a
+# single model.predict call, then scores the cumulative improvement plans with one more call.
+
+PRIMARY_LEVEL = 'p25'                    # Level used for pairwise combinations
+WHAT_IF_LEVELS = ('p25', 'p10', 'p50')  # Benchmarks a numeric problem can be moved to (p25 first so it wins ties)
+MAX_CANDIDATE_FEATURES = 5               # Top problems considered per page
+MAX_PLAN_STEPS = 5
+TOP_SCENARIOS = 10
+
+
+def _scalar(value):
+    """Plain Python value for JSON output (NaN becomes None)."""
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+def _candidate_moves(raw_row, feature_indices, columns, percentile_metrics):
+    """
+    List the single-feature changes worth simulating for one page.
+
+    Numeric problems are moved to each benchmark level that is better (lower) than the
+    current value, since most metrics follow "higher = worse". Features listed in
+    WHAT_IF_CATEGORICAL_OPTIONS are also set to each of their 'good' options.
+
+    Returns:
+        list: (feature index, new value, level) tuples, without duplicate changes
+    """
+    moves = []
+    seen = set()
+    for j in feature_indices:
+        col = columns[j]
+        current = raw_row[j]
+        numeric_current = pd.to_numeric(current, errors='coerce') if not isinstance(current, (bool, np.bool_)) else np.nan
+        for level in WHAT_IF_LEVELS:
+            target = percentile_metrics.get(level, {}).get(col)
+            if target is not None and numeric_current > target and (j, target) not in seen:
+                seen.add((j, target))
+                moves.append((j, target, level))
+        for option in WHAT_IF_CATEGORICAL_OPTIONS.get(col, ()):
+            if (pd.isna(current) or current != option) and (j, option) not in seen:
+                seen.add((j, option))
+                moves.append((j, option, 'set'))
+    return moves
+
+
+def _assign_column(X, col, positions, values):
+    """Write values into X[col] at the given row positions, keeping categorical dtypes intact."""
+    col_position = X.columns.get_loc(col)
+    if isinstance(X[col].dtype, pd.CategoricalDtype):
+        missing = [v for v in pd.unique(pd.Series(values, dtype=object)) if v not in X[col].cat.categories]
+        if missing:
+            X[col] = X[col].cat.add_categories(missing)
+    elif X[col].dtype.kind in 'iub':
+        X[col] = X[col].astype('float64')
+    X.iloc[positions, col_position] = values
+
+
+def _score_scenarios(model, X, page_index, scenario_changes):
+    """
+    Predict every scenario with one model.predict call.
+
+    Args:
+        model: Trained model, or its tree_predictor.FlatTreeEnsemble
+        X: Model-ready feature DataFrame of the pages
+        page_index: Array with the page (row of X) each scenario starts from
+        scenario_changes: List of [(feature index, value), ...] per scenario
+
+    Returns:
+        np.ndarray: Prediction per scenario
+    """
+    if not scenario_changes:
+        return np.array([])
+    by_column = {}
+    for scenario, changes in enumerate(scenario_changes):
+        for j, value in changes:
+            by_column.setdefault(j, ([], []))
+            by_column[j][0].append(scenario)
+            by_column[j][1].append(value)
+    if hasattr(model, 'encode_values'):
+        # Flat trees (tree_predictor.py): edit the encoded matrix directly, no pandas round-trip
+        matrix = model.to_matrix(X)[page_index]
+        for j, (positions, values) in by_column.items():
+            matrix[positions, model.feature_names.index(X.columns[j])] = model.encode_values(X.columns[j], values)
+        return model.predict(matrix)
+    X_candidates = X.iloc[page_index].reset_index(drop=True)
+    for j, (positions, values) in by_column.items():
+        _assign_column(X_candidates, X.columns[j], np.array(positions), values)
+    return model.predict(X_candidates)
+
+
+def _change_record(columns, raw_row, j, value, level):
+    return {'feature': columns[j], 'from': _scalar(raw_row[j]), 'to': _scalar(value), 'level': level}
+
+
+def plan_improvements(model, X, raw_values, candidate_features, predictions, percentile_metrics,
+                      max_plan_steps=MAX_PLAN_STEPS, top_scenarios=TOP_SCENARIOS):
+    """
+    Score what-if scenarios for many pages and build a ranked improvement plan for each.
+
+    Scenarios per page: each top problem moved to p10/p25/p50, categorical 'good' options,
+    and every pair of p25/option moves. All scenarios of all pages are scored in one predict
+    call. The plan then orders features by their best single-move savings and scores the
+    cumulative combinations (step 1, steps 1+2, ...) in a second predict call.
+
+    Args:
+        model: Trained model
+        X: Model-ready feature DataFrame (one row per page)
+        raw_values: Object array of the same features before category conversion
+        candidate_features: Per page, column indices of its problems in impact order
+        predictions: Current prediction per page
+        percentile_metrics: dict level ('p10', 'p25', ...) -> {feature: benchmark value}, or a list
+            with one such dict per page (cohort benchmarks, see cohorts.py)
+        max_plan_steps: Most features combined in a plan
+        top_scenarios: Scenarios kept per page, best first
+
+    Returns:
+        list: Per page, a dict with 'what_if' (top problem moved to its best benchmark level, or None),
+              'scenarios' (ranked) and 'plan' (cumulative steps)
+    """
+    columns = list(X.columns)
+    n_pages = len(X)
+    predictions = np.asarray(predictions, dtype=float)
+
+    # --- 1. Single and pairwise scenarios for every page, scored together ---
+    scenario_page, scenario_changes, scenario_moves = [], [], []
+    page_bounds = []  # (first, last + 1) scenario of each page; scenarios are appended page by page
+    per_page_metrics = isinstance(percentile_metrics, list)
+    for i in range(n_pages):
+        moves = _candidate_moves(raw_values[i], candidate_features[i][:MAX_CANDIDATE_FEATURES], columns,
+                                 percentile_metrics[i] if per_page_metrics else percentile_metrics)
+        first_scenario = len(scenario_changes)
+        for move in moves:
+            scenario_page.append(i)
+            scenario_changes.append([move[:2]])
+            scenario_moves.append((move,))
+        primary = [move for move in moves if move[2] in (PRIMARY_LEVEL, 'set')]
+        for first, second in itertools.combinations(primary, 2):
+            if first[0] != second[0]:
+                scenario_page.append(i)
+                scenario_changes.append([first[:2], second[:2]])
+                scenario_moves.append((first, second))
+        page_bounds.append((first_scenario, len(scenario_changes)))
+
+    scenario_page = np.array(scenario_page, dtype=int)
+    scenario_predictions = _score_scenarios(model, X, scenario_page, scenario_changes)
+    scenario_savings = predictions[scenario_page] - scenario_predictions if len(scenario_page) else np.array([])
+
+    # --- 2. Cumulative plan per page: features ordered by their best single-move savings ---
+    page_plans = []
+    plan_page, plan_changes = [], []
+    for i in range(n_pages):
+        best_by_feature = {}
+        for s in range(*page_bounds[i]):
+            moves = scenario_moves[s]
+            if len(moves) == 1 and scenario_savings[s] > 0:
+                j = moves[0][0]
+                if j not in best_by_feature or scenario_savings[s] > scenario_savings[best_by_feature[j]]:
+                    best_by_feature[j] = s
+        steps = sorted(best_by_feature.values(), key=lambda s: -scenario_savings[s])[:max_plan_steps]
+        page_plans.append([scenario_moves[s][0] for s in steps])
+        for k in range(1, len(steps) + 1):
+            plan_page.append(i)
+            plan_changes.append([scenario_moves[s][0][:2] for s in steps[:k]])
+
+    plan_page = np.array(plan_page, dtype=int)
+    plan_predictions = _score_scenarios(model, X, plan_page, plan_changes)
+
+    # --- 3. Assemble results ---
+    results = []
+    plan_offset = 0
+    for i in range(n_pages):
+        raw_row = raw_values[i]
+        page_scenarios = np.arange(*page_bounds[i])
+        ranked = page_scenarios[np.argsort(-scenario_savings[page_scenarios], kind='stable')]
+
+        # Classic what-if: the top problem moved to the benchmark level that saves the most,
+        # as the plan picks it (levels are listed in WHAT_IF_LEVELS order, so p25 wins ties)
+        what_if = None
+        top = candidate_features[i][0] if len(candidate_features[i]) else None
+        best = None
+        for s in page_scenarios:
+            move = scenario_moves[s][0]
+            if (len(scenario_moves[s]) == 1 and move[0] == top and move[2] in WHAT_IF_LEVELS
+                    and (best is None or scenario_savings[s] > scenario_savings[best])):
+                best = s
+        if best is not None:
+            _, value, level = scenario_moves[best][0]
+            what_if = {
+                'feature': columns[top],
+                'from': _scalar(raw_row[top]),
+                'to': _scalar(value),
+                'level': level,
+                'predicted_after': float(scenario_predictions[best]),
+                'savings_ms': float(scenario_savings[best]),
+            }
+
+        plan = []
+        previous = predictions[i]
+        for move in page_plans[i]:
+            predicted_after = plan_predictions[plan_offset]
+            plan_offset += 1
+            plan.append(dict(_change_record(columns, raw_row, *move),
+                             predicted_after=float(predicted_after),
+                             step_savings_ms=float(previous - predicted_after),
+                             cumulative_savings_ms=float(predictions[i] - predicted_after)))
+            previous = predicted_after
+
+        results.append({
+            'what_if': what_if,
+            'scenarios': [{
+                'changes': [_change_record(columns, raw_row, *move) for move in scenario_moves[s]],
+                'predicted_after': float(scenario_predictions[s]),
+                'savings_ms': float(scenario_savings[s]),
+            } for s in ranked[:top_scenarios]],
+            'plan': plan,
+        })
+    return results
@@ -0,0 +1,545 @@
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit
+import numpy as np
+import pandas as pd
+
+try:
+    import orjson  # Several times faster on large HARs; the standard library parser is the fallback
+except ImportError:
+    orjson = None
+
+# Local WebPageTest extractor: results.json / HAR files -> the feature rows bq.sql produces
+# Turns local test runs into a CSV (or Parquet) file with the training data's columns, so they
+# can be explained by `aislow.py --mode batch --input` or trained on with `train_model.py --csv`,
+# without BigQuery.
+#
+# Inputs (optionally gzipped, detected by content rather than extension):
+#   * WebPageTest results.json ({"data": {"median"/"runs": ... "firstView": {...}}}): the median
+#     run's first view (or the first run's if there is no median)
+#   * HAR files (WebPageTest / HTTP Archive exports, page data in "_"-prefixed fields): the first
+#     page that isn't a repeat view, with its entries
+#
+# Columns follow bq.sql. The page-level metrics are the WebPageTest fields HTTP Archive stores in
+# `payload`; the `summary` fields (request counts, bytes per type, cache lifetimes) are recomputed
+# from the requests the way HTTP Archive derives them. Like the query, a field the test doesn't
+# have stays empty (e.g. LargestContentfulPaint, which bq.sql reads from an array and so is always
+# empty in the training data).
+
+DEFAULT_FILES_PER_TASK = 32   # Test files parsed per process pool task
+DEFAULT_BUFFER_ROWS = 5000    # Rows buffered before being appended to the output file
+TEST_FILE_SUFFIXES = ('.json', '.json.gz', '.har', '.har.gz')
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Column order of bq.sql (and the training CSVs)
+OUTPUT_COLUMNS = [
+    'page', 'SpeedIndex', 'totalBytes', 'TTFB', 'renderStart', 'numConnections', 'numDomElements', 'numDomains',
+    'numRedirects', 'uses_cdn', 'bytesCss', 'reqCss', 'bytesJS', 'reqJS', 'bytesImg', 'reqImg', 'bytesFont',
+    'reqFont', 'bytesHtml', 'reqHtml', 'bytesJSON', 'reqJSON', 'reqTotal', 'gzipSavings', 'maxDomainReqs',
+    'maxage0', 'maxage1', 'maxage30', 'maxage365', 'maxageMore', 'maxageNull', 'num_long_tasks',
+    'TotalBlockingTime', 'EvaluateScript', 'FunctionCall', 'Layout', 'image_savings', 'renderBlockingCSS',
+    'renderBlockingJS', 'FirstContentfulPaint', 'FirstImagePaint', 'FirstMeaningfulPaint', 'FirstPaint',
+    'LargestContentfulPaint', 'layout_shifts_count', 'loadEventDuration', 'dclDuration', '_responses_200',
+    '_responses_404', '_responses_other', 'analytics', 'ads', 'marketing', 'fonts_scripts', 'tagman', 'chat',
+    'img_missing_width', 'img_missing_height', 'img_lazy_count', 'svg_count', 'is_lcp_preloaded',
+    'scripts_total', 'scripts_inline', 'scripts_async', 'scripts_defer',
+]
+BOOLEAN_COLUMNS = ('uses_cdn', 'is_lcp_preloaded')
+
+# Page-level WebPageTest fields copied as-is: output column -> field (without HAR's "_" prefix)
+PAGE_FIELDS = {
+    'SpeedIndex': 'SpeedIndex',
+    'TTFB': 'TTFB',
+    'renderStart': 'render',
+    'numConnections': 'connections',
+    'numDomElements': 'domElements',
+    'TotalBlockingTime': 'TotalBlockingTime',
+    'image_savings': 'image_savings',
+    'renderBlockingCSS': 'renderBlockingCSS',
+    'renderBlockingJS': 'renderBlockingJS',
+    'FirstContentfulPaint': 'firstContentfulPaint',
+    'FirstImagePaint': 'firstImagePaint',
+    'FirstMeaningfulPaint': 'firstMeaningfulPaint',
+    'FirstPaint': 'firstPaint',
+    '_responses_200': 'responses_200',
+    '_responses_404': 'responses_404',
+    '_responses_other': 'responses_other',
+}
+CPU_TIME_COLUMNS = ('EvaluateScript', 'FunctionCall', 'Layout')
+
+# Wappalyzer categories counted by bq.sql (number of detected technologies in each)
+TECHNOLOGY_CATEGORIES = {
+    'analytics': 'Analytics',
+    'ads': 'Advertising',
+    'marketing': 'Marketing automation',
+    'fonts_scripts': 'Font scripts',
+    'tagman': 'Tag managers',
+    'chat': 'Live chat',
+}
+
+# Custom metrics: output column -> (custom metric, path inside it)
+CUSTOM_METRICS = {
+    'img_missing_width': ('markup', ('images', 'img', 'dimensions', 'missing_width')),
+    'img_missing_height': ('markup', ('images', 'img', 'dimensions', 'missing_height')),
+    'img_lazy_count': ('markup', ('images', 'img', 'loading', 'lazy')),
+    'svg_count': ('markup', ('svgs', 'svg_img_total')),
+    'is_lcp_preloaded': ('performance', ('is_lcp_preloaded',)),
+    'scripts_total': ('javascript', ('script_tags', 'total')),
+    'scripts_inline': ('javascript', ('script_tags', 'inline')),
+    'scripts_async': ('javascript', ('script_tags', 'async')),
+    'scripts_defer': ('javascript', ('script_tags', 'defer')),
+}
+
+# Request type by MIME type, first match wins: (type, substrings)
+CONTENT_TYPES = (
+    ('JSON', ('json',)),
+    ('Css', ('css',)),
+    ('JS', ('javascript', 'ecmascript')),
+    ('Html', ('html',)),
+    ('Font', ('font', 'woff', 'opentype', 'truetype')),
+    ('Img', ('image',)),
+)
+DAY_SECONDS = 86400
+MAXAGE_BUCKETS = ((0, 'maxage0'), (DAY_SECONDS, 'maxage1'), (30 * DAY_SECONDS, 'maxage30'),
+                  (365 * DAY_SECONDS, 'maxage365'))  # Upper bound (inclusive) -> column; beyond: maxageMore
+
+
+def _loads(data):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def read_test_file(path):
+    """
+    Parse a results.json or HAR file, gunzipping it if needed.
+
+    Raises:
+        ValueError: If the file isn't valid (gzipped) JSON
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:2] == GZIP_MAGIC:
+        data = gzip.decompress(data)
+    return _loads(data)
+
+
+def _dig(value, path):
+    """value[path[0]][path[1]]..., or None where a step is missing (like BigQuery's JSON_VALUE)."""
+    for key in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def _number(value):
+    """Numeric value as float, None for anything else (like SAFE_CAST)."""
+    if isinstance(value, bool) or value is None:
+        return None
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if np.isfinite(value) else None
+
+
+def _custom_metric(page, name):
+    """A custom metric as a dict (WebPageTest stores them as JSON strings)."""
+    value = page.get(name)
+    if isinstance(value, str):
+        try:
+            value = _loads(value)
+        except ValueError:
+            return None
+    return value if isinstance(value, dict) else None
+
+
+def _header_dict(headers):
+    """Response headers (HAR name/value list, or results.json 'name: value' lines) -> lowercase dict."""
+    result = {}
+    for header in headers or ():
+        if isinstance(header, dict):
+            name, value = header.get('name'), header.get('value')
+        elif isinstance(header, str) and ':' in header:
+            name, value = header.split(':', 1)
+        else:
+            continue
+        if name:
+            result[name.strip().lower()] = str(value).strip()
+    return result
+
+
+def _cache_seconds(cache_time, headers):
+    """Cache lifetime in seconds: WebPageTest's cache_time, else Cache-Control max-age. None if not cacheable."""
+    seconds = _number(cache_time)
+    if seconds is not None:
+        return seconds if seconds >= 0 else None
+    for directive in headers.get('cache-control', '').split(','):
+        name, _, value = directive.strip().partition('=')
+        if name.lower() == 'max-age':
+            return _number(value.strip('"'))
+    return None
+
+
+def _normalize_request(request, har):
+    """One request as (host, status, mime type, bytes, gzip savings, cache seconds)."""
+    if har:
+        response = request.get('response') or {}
+        url = (request.get('request') or {}).get('url', '')
+        host = request.get('_host') or urlsplit(url).hostname or ''
+        status = _number(request.get('_responseCode', response.get('status')))
+        mime = request.get('_contentType') or (response.get('content') or {}).get('mimeType') or ''
+        size = _number(request.get('_bytesIn'))
+        if size is None:
+            size = _number(response.get('_transferSize', response.get('bodySize')))
+        headers = _header_dict(response.get('headers'))
+        return host, status, mime, size, _number(request.get('_gzip_save')), _cache_seconds(request.get('_cache_time'), headers)
+
+    host = request.get('host') or urlsplit(request.get('url', '') or request.get('full_url', '')).hostname or ''
+    size = _number(request.get('bytesIn'))
+    if size is None:
+        size = _number(request.get('objectSize'))
+    headers = _header_dict((request.get('headers') or {}).get('response'))
+    return (host, _number(request.get('responseCode')), request.get('contentType') or '', size,
+            _number(request.get('gzip_save')), _cache_seconds(request.get('cache_time'), headers))
+
+
+def _select_view(test):
+    """
+    The page data, its requests and the tested URL of one test.
+
+    Returns:
+        tuple: (page dict with HAR's "_" prefixes removed, list of normalized requests, URL)
+
+    Raises:
+        ValueError: If the file is neither a HAR nor a results.json with a first view
+    """
+    log = test.get('log') if isinstance(test, dict) else None
+    if isinstance(log, dict):
+        pages = log.get('pages') or []
+        if not pages:
+            raise ValueError('HAR without pages')
+        page = next((p for p in pages if not p.get('_cached')), pages[0])
+        entries = [e for e in log.get('entries') or () if e.get('pageref', page.get('id')) == page.get('id')]
+        data = {key[1:] if key.startswith('_') else key: value for key, value in page.items()}
+        return data, [_normalize_request(e, har=True) for e in entries], data.get('URL') or data.get('url') or page.get('title')
+
+    data = test.get('data', test) if isinstance(test, dict) else None
+    if not isinstance(data, dict):
+        raise ValueError('not a WebPageTest result')
+    view = _dig(data, ('median', 'firstView'))
+    if not isinstance(view, dict):
+        runs = data.get('runs') or {}
+        run_ids = sorted(runs, key=lambda run: int(run) if str(run).isdigit() else 0)
+        view = next((runs[run].get('firstView') for run in run_ids if isinstance(runs[run], dict)
+                     and isinstance(runs[run].get('firstView'), dict)), None)
+    if not isinstance(view, dict):
+        raise ValueError('results.json without a first view')
+    requests = view.get('requests')
+    requests = requests if isinstance(requests, list) else []
+    return view, [_normalize_request(r, har=False) for r in requests], view.get('URL') or data.get('testUrl') or data.get('url')
+
+
+def _technology_counts(page):
+    """Detected technologies per bq.sql category, from WebPageTest's Wappalyzer results."""
+    counts = dict.fromkeys(TECHNOLOGY_CATEGORIES, 0)
+    detected = page.get('detected')
+    if isinstance(detected, dict):
+        # {"Analytics": "Google Analytics,Hotjar", ...}
+        for column, category in TECHNOLOGY_CATEGORIES.items():
+            apps = detected.get(category) or ''
+            counts[column] = len([app for app in str(apps).split(',') if app.strip()])
+    technologies = page.get('technologies')
+    if isinstance(technologies, list):
+        # HTTP Archive layout: [{"technology": ..., "categories": [...]}, ...]
+        for column, category in TECHNOLOGY_CATEGORIES.items():
+            counts[column] = sum(1 for t in technologies if isinstance(t, dict) and category in (t.get('categories') or ()))
+    return counts
+
+
+def extract_row(test):
+    """
+    Compute the bq.sql columns for one parsed test.
+
+    Args:
+        test: Parsed results.json or HAR (see read_test_file)
+
+    Returns:
+        dict: Column -> value (None where the test doesn't have the field)
+    """
+    page, requests, url = _select_view(test)
+    row = dict.fromkeys(OUTPUT_COLUMNS)
+    row['page'] = url
+
+    for column, field in PAGE_FIELDS.items():
+        row[column] = _number(page.get(field))
+    cpu_times = page.get('cpuTimes')
+    for column in CPU_TIME_COLUMNS:
+        row[column] = _number(_dig(cpu_times, (column,)))
+    long_tasks = page.get('longTasks')
+    row['num_long_tasks'] = len(long_tasks) if isinstance(long_tasks, list) else None
+    cdn = page.get('base_page_cdn')
+    row['uses_cdn'] = cdn is not None and cdn != ''
+
+    # bq.sql reads this as a field of _chromeUserTiming, which WebPageTest stores as a list
+    # of {name, time} events; only a dict (or the flattened results.json key) has it
+    user_timing = page.get('chromeUserTiming')
+    row['LargestContentfulPaint'] = _number(user_timing.get('LargestContentfulPaint')
+                                            if isinstance(user_timing, dict)
+                                            else page.get('chromeUserTiming.LargestContentfulPaint'))
+
+    shifts = page.get('LayoutShifts')
+    if isinstance(shifts, list) and shifts:
+        row['layout_shifts_count'] = sum(len(s.get('rects') or ()) for s in shifts if isinstance(s, dict))
+    for column, (start, end) in (('loadEventDuration', ('loadEventStart', 'loadEventEnd')),
+                                 ('dclDuration', ('domContentLoadedEventStart', 'domContentLoadedEventEnd'))):
+        start_value, end_value = _number(page.get(start)), _number(page.get(end))
+        if start_value is not None and end_value is not None:
+            row[column] = int(end_value) - int(start_value)
+
+    row.update(_technology_counts(page))
+    custom_metrics = {}
+    for column, (metric, path) in CUSTOM_METRICS.items():
+        if metric not in custom_metrics:
+            custom_metrics[metric] = _custom_metric(page, metric)
+        value = _dig(custom_metrics[metric], path)
+        if column in BOOLEAN_COLUMNS:
+            row[column] = value if isinstance(value, bool) else None
+        else:
+            row[column] = _number(value)
+
+    row.update(summarize_requests(requests))
+    bytes_in = _number(page.get('bytesIn'))
+    if bytes_in is not None:
+        row['totalBytes'] = bytes_in
+    return row
+
+
+def summarize_requests(requests):
+    """
+    The HTTP Archive `summary` fields computed from a page's requests.
+
+    Args:
+        requests: List of (host, status, mime type, bytes, gzip savings, cache seconds)
+
+    Returns:
+        dict: Request counts and bytes per type, domains, redirects, gzip savings and cache lifetimes
+    """
+    summary = {f"{prefix}{content_type}": 0 for content_type, _ in CONTENT_TYPES for prefix in ('bytes', 'req')}
+    summary.update({column: 0 for _, column in MAXAGE_BUCKETS}, maxageMore=0, maxageNull=0)
+    per_host = {}
+    total_bytes = gzip_savings = redirects = 0
+    for host, status, mime, size, gzip_save, cache_seconds in requests:
+        size = size or 0
+        total_bytes += size
+        gzip_savings += gzip_save or 0
+        per_host[host] = per_host.get(host, 0) + 1
+        if status is not None and 300 <= status < 400 and status != 304:
+            redirects += 1
+        mime = mime.lower()
+        for content_type, patterns in CONTENT_TYPES:
+            if any(pattern in mime for pattern in patterns):
+                summary[f"bytes{content_type}"] += size
+                summary[f"req{content_type}"] += 1
+                break
+        if cache_seconds is None:
+            summary['maxageNull'] += 1
+        else:
+            summary[next((column for bound, column in MAXAGE_BUCKETS if cache_seconds <= bound), 'maxageMore')] += 1
+
+    summary.update(
+        reqTotal=len(requests),
+        totalBytes=total_bytes,
+        gzipSavings=gzip_savings,
+        numDomains=len(per_host),
+        maxDomainReqs=max(per_host.values(), default=0),
+        numRedirects=redirects,
+    )
+    return summary
+
+
+def extract_file(path):
+    """Read one test file and compute its row."""
+    return extract_row(read_test_file(path))
+
+
+def _extract_files(paths):
+    """
+    Process pool task: extract a group of files.
+
+    Returns:
+        tuple: (rows, [(path, error message), ...] for files that couldn't be extracted)
+    """
+    rows, failures = [], []
+    for path in paths:
+        try:
+            rows.append(extract_file(path))
+        except (OSError, ValueError, TypeError, AttributeError, EOFError) as e:
+            failures.append((path, f"{type(e).__name__}: {e}"))
+    return rows, failures
+
+
+def find_test_files(inputs):
+    """
+    Expand files and directories (searched recursively) into test files, in sorted order.
+
+    Returns:
+        list: Paths ending in one of TEST_FILE_SUFFIXES (files given explicitly are always kept)
+    """
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, _, names in os.walk(item):
+                paths.extend(os.path.join(root, name) for name in names if name.lower().endswith(TEST_FILE_SUFFIXES))
+        else:
+            paths.append(item)
+    return sorted(paths)
+
+
+def iter_extracted(paths, workers=1, files_per_task=DEFAULT_FILES_PER_TASK):
+    """
+    Extract files across a process pool, yielding (rows, failures) per group, in input order.
+
+    At most 2 groups per worker are in flight, so memory stays bounded however many files there are.
+    """
+    groups = (paths[start:start + files_per_task] for start in range(0, len(paths), files_per_task))
+    if workers <= 1:
+        for group in groups:
+            yield _extract_files(group)
+        return
+    max_pending = workers * 2
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for group in groups:
+            pending.append(executor.submit(_extract_files, group))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def rows_to_frame(rows):
+    """Rows -> DataFrame with the output columns and stable dtypes (float64 numbers, nullable booleans)."""
+    df = pd.DataFrame(rows, columns=OUTPUT_COLUMNS)
+    for col in OUTPUT_COLUMNS:
+        if col == 'page':
+            df[col] = df[col].astype(object)
+        elif col in BOOLEAN_COLUMNS:
+            df[col] = df[col].astype('boolean')
+        else:
+            df[col] = pd.to_numeric(df[col], errors='coerce').astype('float64')
+    return df
+
+
+class TableWriter:
+    """
+    Appends row batches to a CSV or Parquet file (by extension), writing the header/schema once.
+
+    CSV numbers are written without a trailing '.0', like the training CSVs.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.parquet = path.lower().endswith('.parquet')
+        self._writer = None
+        self._started = False
+        self.rows = 0
+
+    def write(self, df):
+        if self.parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(self.path, table.schema)
+            self._writer.write_table(table)
+        else:
+            df.to_csv(self.path, mode='a' if self._started else 'w', header=not self._started, index=False,
+                      float_format='%.15g')
+        self._started = True
+        self.rows += len(df)
+
+    def close(self):
+        if self.parquet:
+            if self._writer is None:  # No rows: still write a valid, empty file
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+
+                pq.write_table(pa.Table.from_pandas(rows_to_frame([]), preserve_index=False), self.path)
+            else:
+                self._writer.close()
+        elif not self._started:
+            rows_to_frame([]).to_csv(self.path, index=False)
+
+
+def extract_to_file(paths, output_path, workers=1, files_per_task=DEFAULT_FILES_PER_TASK,
+                    buffer_rows=DEFAULT_BUFFER_ROWS, verbose=False):
+    """
+    Extract test files into one CSV/Parquet file, streaming rows out in bounded batches.
+
+    Args:
+        paths: Test files (see find_test_files)
+        output_path: .csv or .parquet file to write
+        workers: Worker processes (1 = extract in this process)
+        files_per_task: Files per process pool task
+        buffer_rows: Rows held in memory before they are appended to the output
+        verbose: If True, print progress and every file that failed
+
+    Returns:
+        dict: files, rows, failed, seconds
+    """
+    start = time.perf_counter()
+    writer = TableWriter(output_path)
+    buffer, failed = [], 0
+    for rows, failures in iter_extracted(paths, workers=workers, files_per_task=files_per_task):
+        buffer.extend(rows)
+        failed += len(failures)
+        if verbose:
+            for path, message in failures:
+                print(f"  Skipped '{path}': {message}")
+        if len(buffer) >= buffer_rows:
+            writer.write(rows_to_frame(buffer))
+            buffer = []
+            if verbose:
+                print(f"  Extracted {writer.rows} pages...")
+    if buffer:
+        writer.write(rows_to_frame(buffer))
+    writer.close()
+    return {'files': len(paths), 'rows': writer.rows, 'failed': failed, 'seconds': time.perf_counter() - start}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Extract feature rows (the bq.sql columns) from local '
+                                                 'WebPageTest results.json / HAR files.')
+    parser.add_argument('inputs', nargs='+', help='Test files or directories (searched recursively for '
+                                                  '.json, .har and their .gz versions)')
+    parser.add_argument('--output', default='wpt_pages.csv', help='.csv or .parquet file to write. Default: wpt_pages.csv')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Worker processes. Default: one per CPU')
+    parser.add_argument('--files-per-task', type=int, default=DEFAULT_FILES_PER_TASK,
+                        help=f'Files parsed per process pool task. Default: {DEFAULT_FILES_PER_TASK}')
+    parser.add_argument('--buffer-rows', type=int, default=DEFAULT_BUFFER_ROWS,
+                        help=f'Rows buffered before appending to the output. Default: {DEFAULT_BUFFER_ROWS}')
+    args = parser.parse_args(argv)
+
+    paths = find_test_files(args.inputs)
+    if not paths:
+        print("ERROR: No test files found.")
+        return 1
+    print(f"Extracting {len(paths)} test files with {args.workers} worker(s)...")
+    stats = extract_to_file(paths, args.output, workers=args.workers, files_per_task=args.files_per_task,
+                            buffer_rows=args.buffer_rows, verbose=True)
+    rate = stats['files'] / stats['seconds'] * 3600 if stats['seconds'] > 0 else float('inf')
+    print(f"Wrote {stats['rows']} pages to '{args.output}' in {stats['seconds']:.1f}s "
+          f"({rate:,.0f} files/hour), {stats['failed']} files skipped")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())